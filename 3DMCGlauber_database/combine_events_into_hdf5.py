@@ -10,14 +10,22 @@ from glob import glob
 
 import numpy as np
 
+# the hdf5 storage profiles are defined in utilities/hdf5_storage_profiles.py
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "utilities"))
+from hdf5_storage_profiles import create_dataset_with_profile
+
 def print_help():
-    print("{0} results_folder".format(sys.argv[0]))
+    print("{0} results_folder [storage_profile]".format(sys.argv[0]))
 
 try:
     results_folder = str(sys.argv[1])
 except IndexError:
     print_help()
     exit(1)
+storage_profile = "legacy"
+if len(sys.argv) > 2:
+    storage_profile = str(sys.argv[2])
 
 results_name = results_folder.split("/")[-1]
 if results_name == "":
@@ -28,8 +36,9 @@ hf = h5py.File("{0}.h5".format(results_name), "w")
 
 # save events summary
 event_summary = np.loadtxt(path.join(results_path, "events_summary.dat"))
-dset          = hf.create_dataset("events_summary.dat", data = event_summary,
-                                  compression="gzip", compression_opts=9)
+dset = create_dataset_with_profile(
+    hf, "events_summary.dat", event_summary, storage_profile,
+    "initial_state")
 # save input file
 inputfile = np.genfromtxt(path.join(results_path, "input"), dtype='str')
 for para_name, para_val in inputfile:
@@ -42,8 +51,9 @@ for ievent, event_path in enumerate(event_list):
                                                    results_path))
     file_name = event_path.split("/")[-1]
     dtemp     = np.loadtxt(event_path)
-    dset      = hf.create_dataset("{0}".format(file_name), data = dtemp,
-                                  compression="gzip", compression_opts=9)
+    dset = create_dataset_with_profile(
+        hf, "{0}".format(file_name), dtemp, storage_profile,
+        "initial_state")
     f = open(event_path)
     header = f.readline().strip('\n')
     dset.attrs.create("header", np.string_(header))
@@ -11,10 +11,16 @@ from multiprocessing import Pool
 
 import numpy as np
 
+# the hdf5 storage profiles are defined in utilities/hdf5_storage_profiles.py
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "utilities"))
+from hdf5_storage_profiles import create_dataset_with_profile
+
 def print_help():
-    print("{0} results_folder".format(sys.argv[0]))
+    print("{0} results_folder [storage_profile]".format(sys.argv[0]))
 
-def collect_one_IPGlasma_event(results_path, event_path, hf):
+def collect_one_IPGlasma_event(results_path, event_path, hf,
+                               storage_profile="legacy"):
     event_id = event_path.split("/")[-1].split("Parameters")[-1].split(".")[0]
     gtemp = hf.create_group("event-{0}".format(event_id))
     
@@ -29,15 +35,17 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
     if path.isfile(filepath):
         dtemp = np.loadtxt(filepath)
         dtemp = np.nan_to_num(dtemp).reshape(-1, 2)
-        dset = gtemp.create_dataset("{0}".format(file_name), data=dtemp,
-                                    compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(file_name), dtemp, storage_profile,
+            "initial_state")
     file_name = "NpartList{0}.dat".format(event_id)
     filepath = path.join(results_path, file_name)
     if path.isfile(filepath):
         dtemp = np.loadtxt(path.join(results_path, file_name))
         dtemp = np.nan_to_num(dtemp).reshape(-1, 4)
-        dset = gtemp.create_dataset("{0}".format(file_name), data=dtemp,
-                                    compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(file_name), dtemp, storage_profile,
+            "initial_state")
     
     file_name_pattern = "NpartdNdy-t"
     filelist = glob(path.join(results_path, "{0}*-{1}.dat".format(
@@ -51,8 +59,9 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
                 data[idx] = float(dtemp[idx])
             else:
                 data[idx] = 0.0
-        dset = gtemp.create_dataset("{0}".format(filename), data = data,
-                                    compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(filename), data, storage_profile,
+            "initial_state")
     
     file_name_pattern = "epsilon-u-Hydro-t"
     filelist = glob(path.join(results_path, "{0}*-{1}.dat".format(
@@ -64,9 +73,9 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
         x_size   = abs(dtemp[0, 1])*2.
         y_size   = abs(dtemp[0, 2])*2.
         data_cut = dtemp[:, 3:]
-        dset     = gtemp.create_dataset("{0}".format(filename),
-                                        data = data_cut,
-                                        compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(filename), data_cut, storage_profile,
+            "initial_state")
         f = open(filepath)
         header = f.readline().strip('\n')
         dset.attrs.create("header", np.string_(header))
@@ -92,9 +101,9 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
         x_size   = abs(dtemp[0, 1])*2.
         y_size   = abs(dtemp[0, 2])*2.
         data_cut = dtemp[:, 2:]
-        dset     = gtemp.create_dataset("{0}".format(filename),
-                                        data=data_cut,
-                                        compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(filename), data_cut, storage_profile,
+            "initial_state")
         f = open(filepath)
         header = f.readline().strip('\n')
         dset.attrs.create("header", np.string_(header))
@@ -111,7 +120,7 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
         dset.attrs.create("ny", ny)
 
 
-def collect_IPGlasma_events(results_folder):
+def collect_IPGlasma_events(results_folder, storage_profile="legacy"):
     results_name = results_folder.split("/")[-1]
     if results_name == "":
         results_name = results_folder.split("/")[-2]
@@ -124,12 +133,16 @@ def collect_IPGlasma_events(results_folder):
 
     for ievent, event_path in enumerate(event_list):
         print("processing {0:d}/{1:d} ... ".format(ievent+1, nev))
-        collect_one_IPGlasma_event(results_path, event_path, hf)
+        collect_one_IPGlasma_event(results_path, event_path, hf,
+                                   storage_profile)
 
 if __name__ == "__main__":
     try:
         results_folder = str(sys.argv[1])
-        collect_IPGlasma_events(results_folder)
+        storage_profile = "legacy"
+        if len(sys.argv) > 2:
+            storage_profile = str(sys.argv[2])
+        collect_IPGlasma_events(results_folder, storage_profile)
     except IndexError:
         print_help()
         exit(1)
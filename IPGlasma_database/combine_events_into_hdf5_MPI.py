@@ -11,11 +11,17 @@ from mpi4py import MPI
 
 import numpy as np
 
+# the hdf5 storage profiles are defined in utilities/hdf5_storage_profiles.py
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "utilities"))
+from hdf5_storage_profiles import create_dataset_with_profile
+
 def print_help():
     """This function prints out help message"""
-    print("{0} results_folder".format(sys.argv[0]))
+    print("{0} results_folder [storage_profile]".format(sys.argv[0]))
 
-def collect_one_IPGlasma_event(results_path, event_path, hf):
+def collect_one_IPGlasma_event(results_path, event_path, hf,
+                               storage_profile="legacy"):
     """This function collects one IPGlasma event"""
     event_id = event_path.split("/")[-1].split("Parameters")[-1].split(".")[0]
     gtemp = hf.create_group("event-{0}".format(event_id))
@@ -31,15 +37,17 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
     if path.isfile(filepath):
         dtemp = np.loadtxt(filepath)
         dtemp = np.nan_to_num(dtemp).reshape(-1, 2)
-        dset = gtemp.create_dataset("{0}".format(file_name), data=dtemp,
-                                    compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(file_name), dtemp, storage_profile,
+            "initial_state")
     file_name = "NpartList{0}.dat".format(event_id)
     filepath = path.join(results_path, file_name)
     if path.isfile(filepath):
         dtemp = np.loadtxt(path.join(results_path, file_name))
         dtemp = np.nan_to_num(dtemp).reshape(-1, 4)
-        dset = gtemp.create_dataset("{0}".format(file_name), data=dtemp,
-                                    compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(file_name), dtemp, storage_profile,
+            "initial_state")
 
     file_name_pattern = "NpartdNdy-t"
     filelist = glob(path.join(results_path, "{0}*-{1}.dat".format(
@@ -53,8 +61,9 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
                 data[idx] = float(dtemp[idx])
             else:
                 data[idx] = 0.0
-        dset = gtemp.create_dataset("{0}".format(filename), data=data,
-                                    compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(filename), data, storage_profile,
+            "initial_state")
 
     file_name_pattern = "epsilon-u-Hydro-t"
     filelist = glob(path.join(results_path, "{0}*-{1}.dat".format(
@@ -66,9 +75,9 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
         x_size   = abs(dtemp[0, 1])*2.
         y_size   = abs(dtemp[0, 2])*2.
         data_cut = dtemp[:, 3:]
-        dset     = gtemp.create_dataset("{0}".format(filename),
-                                        data=data_cut,
-                                        compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(filename), data_cut, storage_profile,
+            "initial_state")
         f = open(filepath)
         header = f.readline().strip('\n')
         dset.attrs.create("header", np.string_(header))
@@ -94,9 +103,9 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
         x_size   = abs(dtemp[0, 1])*2.
         y_size   = abs(dtemp[0, 2])*2.
         data_cut = dtemp[:, 2:]
-        dset     = gtemp.create_dataset("{0}".format(filename),
-                                        data=data_cut,
-                                        compression="gzip", compression_opts=9)
+        dset = create_dataset_with_profile(
+            gtemp, "{0}".format(filename), data_cut, storage_profile,
+            "initial_state")
         f = open(filepath)
         header = f.readline().strip('\n')
         dset.attrs.create("header", np.string_(header))
@@ -113,7 +122,7 @@ def collect_one_IPGlasma_event(results_path, event_path, hf):
         dset.attrs.create("ny", ny)
 
 
-def collect_IPGlasma_events(results_folder):
+def collect_IPGlasma_events(results_folder, storage_profile="legacy"):
     """This function collects IPGlasma events in results_folder"""
     mpi_comm = MPI.COMM_WORLD
     mpi_rank = mpi_comm.Get_rank()
@@ -141,7 +150,8 @@ def collect_IPGlasma_events(results_folder):
             event_path = event_list[ievent]
             print("MPI rank {0:d} processing {1:d}/{2:d} ... ".format(
                 mpi_rank, ievent, nev))
-            collect_one_IPGlasma_event(results_path, event_path, hf)
+            collect_one_IPGlasma_event(results_path, event_path, hf,
+                                       storage_profile)
     hf.close()
     mpi_comm.Barrier()
 
@@ -164,7 +174,10 @@ def collect_IPGlasma_events(results_folder):
 if __name__ == "__main__":
     try:
         RESULTS_FOLDER = str(sys.argv[1])
-        collect_IPGlasma_events(RESULTS_FOLDER)
+        STORAGE_PROFILE = "legacy"
+        if len(sys.argv) > 2:
+            STORAGE_PROFILE = str(sys.argv[2])
+        collect_IPGlasma_events(RESULTS_FOLDER, STORAGE_PROFILE)
     except IndexError:
         print_help()
         exit(1)
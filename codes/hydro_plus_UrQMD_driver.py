@@ -2,18 +2,177 @@
 """This is a drive script to run hydro + hadronic cascade simulation"""
 
 from multiprocessing import Pool
-from subprocess import call
-from os import path, mkdir, remove, makedirs, stat
+from subprocess import call, Popen
+import os
+import errno
+from os import path, mkdir, remove, makedirs, stat, fstat, replace, listdir
 import tarfile
+import gzip
+import zlib
 from glob import glob
 import sys
 import time
 import shutil
 import re
+import queue
+import threading
+import resource
+import json
+import socket
+import tempfile
+import hashlib
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import h5py
 import numpy as np
 from fetch_IPGlasma_event_from_hdf5_database import fecth_an_IPGlasma_event, fecth_an_IPGlasma_event_Tmunu
 from fetch_3DMCGlauber_event_from_hdf5_database import fecth_an_3DMCGlauber_event
+from hdf5_storage_profiles import create_dataset_with_profile
+from hdf5_columnar_layout import write_columnar_event
+from hydro_archive import archive_folder
+from particle_list_frames import write_particle_list_frames
+
+# optional driver settings, they can be changed by passing key=value pairs
+# after the positional arguments
+driver_options_dict = {
+    'pipeline_depth': 0,    # number of hydro events allowed to finish ahead
+                            # of the hadronic afterburner (0: run serially)
+    'n_cores': 0,           # total number of cores for the job
+                            # (0: use n_threads)
+    'core_packing': False,  # share the cores between the hydro and the
+                            # afterburner stages of the pipelined events
+    'stage_graph': False,   # run the stages of an event concurrently by
+                            # their data dependencies, with a stage
+                            # manifest and telemetry (False: one stage at
+                            # a time in the order of the event loop)
+    'afterburner_n_samples': 0,     # number of hadronic afterburner samples
+                                    # per hydro event (0: 10*n_UrQMD)
+    'afterburner_n_particles': 0,   # stop sampling after this many
+                                    # particles (0: only use n_samples)
+    'afterburner_min_samples': 0,   # minimum number of samples before the
+                                    # adaptive stop criterion applies
+    'afterburner_v2_error': 0.,     # stop sampling once the error of v2{2}
+                                    # reaches this value (0: off)
+    'afterburner_mult_error': 0.,   # stop sampling once the relative error
+                                    # of <N_ch> reaches this value (0: off)
+    'spvn_sharded': False,          # analyze every afterburner sample as soon
+                                    # as it finishes and merge the results
+    'hdf5_storage_profile': "legacy",   # storage profile for the hdf5
+                                        # results (hdf5_storage_profiles.py)
+    'hdf5_layout': "files",     # files: one dataset per result file
+                                # columnar: stack the particle tables
+                                # (hdf5_columnar_layout.py)
+    'checkpoint_time': 12.,     # hours after which the driver writes a
+                                # checkpoint and exits with code 85
+    'checkpoint_walltime': 0.,  # job walltime in hours, if > 0 the
+                                # checkpoint is written checkpoint_margin
+                                # hours before the walltime ends
+    'checkpoint_margin': 1.,    # hours reserved to write the checkpoint
+    'checkpoint_codec': "gz",   # gz: gzip level 1, none: uncompressed
+    'prefetch_initial_condition': False,    # fetch the next initial
+                                            # condition from the database
+                                            # in the background
+    'staging_folder': "",       # node-local folder for the intermediate
+                                # files, e.g. $TMPDIR or /dev/shm ("": off)
+    'surface_cache_folder': "",     # node-local folder, e.g. /dev/shm, to
+                                    # share one copy of the hydro surface
+                                    # among the samplers ("": off)
+    'ipglasma_producer_threads': 0,     # threads of the IPGlasma runs
+                                        # ahead of hydro with
+                                        # database = self (0: off)
+    'ipglasma_queue_depth': 1,  # number of IPGlasma events generated ahead
+    'afterburner_memory_limit_MB': 0,   # start new afterburner samples
+                                        # only below this memory (0: off)
+    'memory_telemetry': False,  # record the peak memory of every stage
+    'hydro_archive_level': 0,   # zlib level of the float32 archives of the
+                                # saved hydro results (0: keep the files)
+    'particle_list_compression': 0,     # gzip level of the frame-indexed
+                                        # saved particle lists (0: off)
+    'photon_streaming': False,  # run the photon emission at the same time
+                                # as hydro, reading the evolution through
+                                # a named pipe
+    'glauber_pool_folder': "",  # folder of the pre-generated 3D
+                                # MC-Glauber events ("": off, one 3dMCGlb
+                                # run per event)
+    'glauber_pool_size': 0,     # number of 3D MC-Glauber events generated
+                                # per centrality bin in one run
+                                # (0: only the events of the job)
+}
+
+# number of 3dMCGlb batches a job generates for one event before it gives
+# up, when other jobs keep drawing the new events from the shared pool
+glauber_pool_max_batches = 3
+
+# how the spvn results of the shards are merged, as (file name pattern,
+# [(rows, columns, rule, count cell of the ratios)]) in the output format
+# of the hadronic_afterburner_toolkit. The rules are
+#   "first": taken from the first shard, e.g. the pT or eta grid
+#   "average": event average, averaged with the number of events
+#   "sum": raw count over all events, summed
+#   "ratio": ratio to the count cell (row None: the same row), e.g.
+#            vn = Qn/dN, averaged with the merged counts
+spvn_merge_rules = [
+    # pT differential: <pT>, dN, vn = Qn/dN (real, imag) ..., total N
+    (r"_vndata_diff_(y|eta)_", [
+        (slice(None), slice(0, 1), "ratio", (None, -1)),
+        (slice(None), slice(1, 2), "average", None),
+        (slice(None), slice(2, -1), "ratio", (None, -1)),
+        (slice(None), slice(-1, None), "sum", None),
+    ]),
+    # pT integrated: dN in the first row, vn = Qn/dN (real, imag) for
+    # every order n, and the number of events in the last row
+    (r"_vndata_(y|eta)_", [
+        (slice(None), slice(0, 1), "first", None),
+        (slice(0, 1), slice(1, None), "average", None),
+        (slice(1, -1), slice(1, None), "ratio", (0, 1)),
+        (slice(-1, None), slice(1, None), "sum", None),
+    ]),
+    # rapidity distributions: y or eta, dN, ET, vn = Qn/dN ..., total N
+    (r"_dN(dy|deta)_pT_", [
+        (slice(None), slice(0, 1), "first", None),
+        (slice(None), slice(1, 3), "average", None),
+        (slice(None), slice(3, -1), "ratio", (None, 1)),
+        (slice(None), slice(-1, None), "sum", None),
+    ]),
+    # pT-eta distribution: eta, <pT>, dN, Qn (real, imag) ...
+    (r"_pTeta_distribution", [
+        (slice(None), slice(0, 1), "first", None),
+        (slice(None), slice(1, 2), "ratio", (None, 2)),
+        (slice(None), slice(2, None), "average", None),
+    ]),
+]
+
+# name of the manifest of the incremental checkpoints in the results folder
+checkpoint_manifest_name = "checkpoint_manifest.json"
+
+# name of the append-only stage manifest in the job folder
+stage_manifest_name = "stage_manifest.jsonl"
+
+# layout of one particle record in the binary particle lists
+particle_list_record_fields = ['pid', 'mass', 't', 'x', 'y', 'z',
+                               'E', 'px', 'py', 'pz']
+
+# charged hadrons and the reference window for the running statistics of
+# the adaptive afterburner sampling
+charged_hadron_pids = [211, 321, 2212, 3112, 3222, 3312, 3334]
+afterburner_reference_window = {'eta_max': 1.0, 'pT_min': 0.2, 'pT_max': 3.0}
+
+# resident memory of the child processes and of the afterburner samples
+# (the process trees of run_afterburner*.sh), sampled every
+# memory_monitor_interval seconds, and the peaks of the running stages
+memory_monitor = {'rss_MB': 0., 'afterburner_MB': 0., 'n_afterburner': 0,
+                  'stages': {}, 'lock': threading.Lock(), 'thread': None}
+memory_monitor_interval = 2.
+
+# number of threads compressing the frames of the saved particle lists
+particle_list_compression_threads = 2
+
+# the hydro evolution is relayed to the streaming photon emission in
+# chunks, at most photon_stream_buffer_chunks of them are held in memory
+photon_stream_chunk_bytes = 4*1024*1024
+photon_stream_buffer_chunks = 16
+# photon emission streams of the running hydro events, by event id
+photon_streams = {}
 
 
 def print_usage():
@@ -23,7 +182,25 @@ def print_usage():
           + "n_hydro_events hydro_event_id n_UrQMD n_threads "
           + "save_ipglasma_flag save_kompost_flag save_hydro_flag "
           + "save_urqmd_flag seed_add tau0 compute_polarization_flag "
-          + "compute_photons_flag enableCheckPoint")
+          + "compute_photons_flag enableCheckPoint afterburner_type "
+          + "[option=value ...]")
+    print("Available options: {}".format(driver_options_dict))
+
+
+def parse_driver_options(option_list):
+    """This function parses the optional key=value driver settings"""
+    options = dict(driver_options_dict)
+    for option_i in option_list:
+        key, _, value = option_i.partition("=")
+        if key not in driver_options_dict:
+            print("\U000026A0  Unknown driver option {}, ignored".format(key),
+                  flush=True)
+            continue
+        if isinstance(driver_options_dict[key], bool):
+            options[key] = (value.lower() == "true")
+        else:
+            options[key] = type(driver_options_dict[key])(value)
+    return options
 
 
 def fecth_an_3DMCGlauber_smooth_event(database_path, iev):
@@ -50,9 +227,135 @@ def mapEventIdToCentrality(event_id):
     return(centrality)
 
 
+def get_3DMCGlauber_pool_path(glauber_pool, initial_type, centrality):
+    """This function returns the pool folder of the 3D MC-Glauber events
+       for one centrality bin. The pool is keyed by the 3dMCGlauber input
+       file, so different productions never share their events.
+    """
+    with open(path.join("3dMCGlauber", "input"), "rb") as f:
+        input_hash = hashlib.md5(f.read()).hexdigest()[:12]
+    return path.join(glauber_pool['folder'],
+                     "{}_{}".format(initial_type, input_hash),
+                     "cen_{}".format(centrality))
+
+
+def generate_3DMCGlauber_events(n_events, seed, cenMin, pool_path,
+                                event_type):
+    """This function runs 3dMCGlb once for n_events events and moves them
+       into the pool. cenMin is None for the fixed centrality runs.
+    """
+    cen_args = ""
+    if cenMin is not None:
+        cen_args = " cenMin={} cenMax={}".format(cenMin, cenMin + 1)
+    print("\U0001F3B2  Generate {} 3D MC-Glauber events in {} ...".format(
+        n_events, pool_path), flush=True)
+    call("(cd 3dMCGlauber; ./3dMCGlb.e {} input {}{};)".format(
+        n_events, seed, cen_args), shell=True)
+    makedirs(pool_path, exist_ok=True)
+    for ievent in range(n_events):
+        event_file = path.join("3dMCGlauber",
+                               "{}_event_{}.dat".format(event_type, ievent))
+        spec_file = path.join("3dMCGlauber",
+                              "spectators_event_{}.dat".format(ievent))
+        if not (path.exists(event_file) and path.exists(spec_file)):
+            continue
+        pool_name = "{}_{}.dat".format(seed, ievent)
+        # the spectators go first and the event file appears last in one
+        # rename, so other jobs only draw complete events
+        shutil.move(spec_file,
+                    path.join(pool_path, "spectators_" + pool_name))
+        shutil.move(event_file, path.join(pool_path, pool_name + ".part"))
+        replace(path.join(pool_path, pool_name + ".part"),
+                path.join(pool_path, "{}_{}".format(event_type, pool_name)))
+    # the initial-state estimators of a batch can not be assigned to the
+    # events, they are kept next to the pool
+    estimator_list = []
+    for pattern_i in ["ed_etas_*.dat", "nB_etas_*.dat", "ecc_ed*.dat"]:
+        estimator_list += glob(path.join("3dMCGlauber", pattern_i))
+    if estimator_list != []:
+        estimator_folder = path.join(pool_path, "estimators_{}".format(seed))
+        makedirs(estimator_folder, exist_ok=True)
+        for file_i in estimator_list:
+            shutil.move(file_i, estimator_folder)
+
+
+def draw_3DMCGlauber_event(pool_path, event_type, file_name, specFilename):
+    """This function takes one event out of the pool and saves it as
+       file_name and specFilename. It returns False if the pool is empty.
+    """
+    claim_suffix = ".{}_{}".format(socket.gethostname(), os.getpid())
+    pool_list = sorted(glob(path.join(pool_path,
+                                      "{}_*.dat".format(event_type))))
+    for pool_file in pool_list:
+        # claim the event with an atomic rename, another job may be faster
+        try:
+            replace(pool_file, pool_file + claim_suffix)
+        except OSError:
+            continue
+        pool_name = path.basename(pool_file)[len(event_type) + 1:]
+        shutil.move(pool_file + claim_suffix, file_name)
+        shutil.move(path.join(pool_path, "spectators_" + pool_name),
+                    specFilename)
+        return True
+    return False
+
+
+def get_3DMCGlauber_event(glauber_pool, database, initial_type, event_id,
+                          seed, file_name, specFilename):
+    """This function draws the event_id-th 3D MC-Glauber event from the
+       pre-generated pool of its centrality bin. When the pool is empty,
+       3dMCGlb runs once for all the remaining events of the job in the
+       same centrality bin, so the start-up and rejection cost of the
+       Glauber model is paid once per bin instead of once per event. If
+       other jobs draw all the new events first, a new batch is generated.
+       It returns False if no event could be generated.
+    """
+    event_type = "strings"
+    if initial_type == "3DMCGlauber_participants":
+        event_type = "participants"
+    cenMin = None
+    centrality = "all"
+    if database == "self":
+        cenMin = mapEventIdToCentrality(event_id)
+        centrality = int(cenMin)
+    pool_path = get_3DMCGlauber_pool_path(glauber_pool, initial_type,
+                                          centrality)
+    if draw_3DMCGlauber_event(pool_path, event_type, file_name, specFilename):
+        return True
+    n_events = len([
+        event_i for event_i in glauber_pool['event_ids']
+        if event_i >= event_id and (
+            cenMin is None or mapEventIdToCentrality(event_i) == cenMin)])
+    n_events = max(1, n_events, glauber_pool['size'])
+    for ibatch in range(glauber_pool_max_batches):
+        generate_3DMCGlauber_events(n_events, seed + ibatch, cenMin,
+                                    pool_path, event_type)
+        if draw_3DMCGlauber_event(pool_path, event_type, file_name,
+                                  specFilename):
+            return True
+    return False
+
+
+def thread_arg(n_threads):
+    """This function returns the optional number-of-threads argument for
+       the generated run scripts (empty to use the default in the script)
+    """
+    if n_threads > 0:
+        return str(n_threads)
+    return ""
+
+
 def get_initial_condition(database, initial_type, iev, event_id, seed_add,
-                          final_results_folder, time_stamp_str="0.4"):
-    """This funciton get initial conditions"""
+                          final_results_folder, time_stamp_str="0.4",
+                          n_threads=0, prefetched=None,
+                          glauber_pool=None):
+    """This funciton get initial conditions
+
+       prefetched is the background fetch of the event from the IPGlasma
+       database, see start_initial_condition_prefetch
+       glauber_pool is the pool of pre-generated 3D MC-Glauber events,
+       see get_3DMCGlauber_event
+    """
     status = True
     if "IPGlasma" in initial_type:
         ipglasma_local_folder = "ipglasma/ipglasma_results"
@@ -66,8 +369,12 @@ def get_initial_condition(database, initial_type, iev, event_id, seed_add,
         if database == "self":
             # check existing events ...
             if not path.exists(path.join(res_path, file_name)):
-                run_ipglasma(event_id)
-                collect_ipglasma_event(res_path)
+                if prefetched is not None:
+                    # generated ahead by the IPGlasma producer
+                    collect_ipglasma_event(res_path, prefetched.result())
+                else:
+                    run_ipglasma(event_id, n_threads)
+                    collect_ipglasma_event(res_path)
                 if not path.exists(path.join(res_path, file_name)):
                     # IPGlasma event failed
                     print("IPGlasma event failed ... ")
@@ -76,7 +383,9 @@ def get_initial_condition(database, initial_type, iev, event_id, seed_add,
                 print("IPGlasma event exists ...")
                 print("No need to rerun ...")
         else:
-            if "KoMPoST" in initial_type:
+            if prefetched is not None:
+                file_temp = prefetched.result()
+            elif "KoMPoST" in initial_type:
                 file_temp = fecth_an_IPGlasma_event_Tmunu(
                                             database, time_stamp_str, event_id)
             else:
@@ -93,7 +402,14 @@ def get_initial_condition(database, initial_type, iev, event_id, seed_add,
             file_name = "strings_event_{}.dat".format(event_id)
             specFilename = "spectators_event_{}.dat".format(event_id)
             ran = np.random.default_rng().integers(1e8)
-            if not path.exists(file_name):
+            if not path.exists(file_name) and glauber_pool is not None:
+                if not get_3DMCGlauber_event(glauber_pool, database,
+                                             initial_type, event_id,
+                                             seed_add+iev*ran, file_name,
+                                             specFilename):
+                    print("3D MC-Glauber event failed ... ")
+                    return False, file_name
+            elif not path.exists(file_name):
                 if database == "self":
                     cenMin = mapEventIdToCentrality(event_id)
                     call("(cd 3dMCGlauber; ./3dMCGlb.e 1 input "
@@ -131,7 +447,13 @@ def get_initial_condition(database, initial_type, iev, event_id, seed_add,
         file_name = "participants_event_{}.dat".format(event_id)
         specFilename = "spectators_event_{}.dat".format(event_id)
         ran = np.random.default_rng().integers(1e8)
-        if not path.exists(file_name):
+        if not path.exists(file_name) and glauber_pool is not None:
+            if not get_3DMCGlauber_event(glauber_pool, database, initial_type,
+                                         event_id, seed_add + iev*ran,
+                                         file_name, specFilename):
+                print("3D MC-Glauber event failed ... ")
+                return False, file_name
+        elif not path.exists(file_name):
             if database == "self":
                 cenMin = mapEventIdToCentrality(event_id)
                 call("(cd 3dMCGlauber; ./3dMCGlb.e 1 input "
@@ -164,17 +486,115 @@ def get_initial_condition(database, initial_type, iev, event_id, seed_add,
         sys.exit(1)
 
 
-def run_ipglasma(event_id):
+def generate_ipglasma_event(event_id, n_threads, queue_folder):
+    """This function runs IPGlasma for an upcoming event and keeps its
+       results in queue_folder until the event starts
+    """
+    makedirs(path.dirname(queue_folder), exist_ok=True)
+    run_ipglasma(event_id, n_threads)
+    collect_ipglasma_event(queue_folder)
+    return queue_folder
+
+
+def ipglasma_event_is_needed(prefetcher, para_dict, event_id):
+    """This function checks whether IPGlasma needs to run for event_id,
+       i.e. the event has not finished and its initial condition has not
+       been generated by a previous run
+    """
+    res_path = path.join("EVENT_RESULTS_{}".format(event_id),
+                         "ipglasma_results_{}".format(event_id))
+    file_name = "epsilon-u-Hydro-t{0:s}-{1}.dat".format(
+                                    para_dict['time_stamp_str'], event_id)
+    if "KoMPoST" in para_dict['initial_type']:
+        file_name = "Tmunu-t{0:s}-{1}.dat".format(para_dict['time_stamp_str'],
+                                                  event_id)
+    if path.exists(path.join(res_path, file_name)):
+        return False
+    if path.exists(path.join("EVENT_RESULTS_{}".format(event_id),
+                             "spvn_results_{}.h5".format(event_id))):
+        return False
+    return not stage_is_finished(prefetcher.get('stage_manifest', None),
+                                 str(event_id), "event")
+
+
+def start_initial_condition_prefetch(prefetcher, para_dict, iev):
+    """This function starts fetching the initial condition of the iev-th
+       event from the IPGlasma database in the background. The event is
+       written to the job folder while the previous events run.
+       With database = self, IPGlasma runs ahead of hydro on
+       ipglasma_producer_threads threads instead.
+       It returns the future of the fetch, or None if the initial
+       condition is not produced in the background.
+    """
+    initial_type = para_dict['initial_type']
+    database = para_dict['initial_condition']
+    if (prefetcher is None or iev >= para_dict['n_hydro']
+            or "IPGlasma" not in initial_type):
+        return None
+    event_id = para_dict['hydro_id0'] + iev
+    if database == "self":
+        n_producer_threads = para_dict.get('ipglasma_producer_threads', 0)
+        if n_producer_threads <= 0:
+            return None
+        if (iev not in prefetcher['futures']
+                and ipglasma_event_is_needed(prefetcher, para_dict,
+                                             event_id)):
+            prefetcher['futures'][iev] = prefetcher['executor'].submit(
+                generate_ipglasma_event, event_id, n_producer_threads,
+                path.join("ipglasma_queue",
+                          "ipglasma_results_{}".format(event_id)))
+        return prefetcher['futures'].get(iev, None)
+    if iev not in prefetcher['futures']:
+        fetch_function = fecth_an_IPGlasma_event
+        if "KoMPoST" in initial_type:
+            fetch_function = fecth_an_IPGlasma_event_Tmunu
+        prefetcher['futures'][iev] = prefetcher['executor'].submit(
+            fetch_function, database, para_dict['time_stamp_str'], event_id)
+    return prefetcher['futures'][iev]
+
+
+def get_prefetched_initial_condition(prefetcher, para_dict, iev):
+    """This function returns the background fetch of the iev-th initial
+       condition and starts fetching the next ones. The self-generated
+       IPGlasma events run up to ipglasma_queue_depth events ahead.
+    """
+    prefetched = start_initial_condition_prefetch(prefetcher, para_dict, iev)
+    n_ahead = 1
+    if para_dict['initial_condition'] == "self":
+        n_ahead = max(1, para_dict.get('ipglasma_queue_depth', 1))
+    for iev_next in range(iev + 1, iev + 1 + n_ahead):
+        start_initial_condition_prefetch(prefetcher, para_dict, iev_next)
+    if prefetched is not None:
+        prefetcher['futures'].pop(iev)
+    return prefetched
+
+
+def discard_prefetched_initial_condition(prefetcher, iev):
+    """This function removes the prefetched initial condition of an event
+       that does not need to run
+    """
+    if prefetcher is None or iev not in prefetcher['futures']:
+        return
+    file_temp = prefetcher['futures'].pop(iev).result()
+    if path.isdir(file_temp):
+        shutil.rmtree(file_temp)
+    elif path.exists(file_temp):
+        remove(file_temp)
+
+
+def run_ipglasma(event_id, n_threads=0):
     """This functions run IPGlasma"""
     print("\U0001F3B6  Run IPGlasma ... ")
-    call("bash ./run_ipglasma.sh {}".format(event_id), shell=True)
+    call("bash ./run_ipglasma.sh {} {}".format(event_id, thread_arg(n_threads)),
+         shell=True)
 
 
-def collect_ipglasma_event(final_results_folder):
+def collect_ipglasma_event(final_results_folder,
+                           ipglasma_results="ipglasma/ipglasma_results"):
     """This function collects the ipglasma results"""
     if path.exists(final_results_folder):
         shutil.rmtree(final_results_folder)
-    shutil.move("ipglasma/ipglasma_results", final_results_folder)
+    shutil.move(ipglasma_results, final_results_folder)
 
 
 def connect_ipglasma_event(res_path, initial_type, filename):
@@ -194,8 +614,12 @@ def connect_ipglasma_event(res_path, initial_type, filename):
              shell=True)
 
 
-def run_hydro_event(final_results_folder, event_id):
-    """This functions run hydro"""
+def run_hydro_event(final_results_folder, event_id, n_threads=0,
+                    evolution_fifo=""):
+    """This functions run hydro
+       If evolution_fifo is given, MUSIC writes the evolution history into
+       this named pipe instead of evolution_all_xyeta.dat
+    """
     logo = "\U0001F3B6"
     hydro_folder_name = "hydro_results_{}".format(event_id)
     results_folder = path.join(final_results_folder, hydro_folder_name)
@@ -227,7 +651,11 @@ def run_hydro_event(final_results_folder, event_id):
     if not hydro_success:
         curr_time = time.asctime()
         print("{}  [{}] Playing MUSIC ... ".format(logo, curr_time), flush=True)
-        call("bash ./run_hydro.sh", shell=True)
+        env_arg = ""
+        if evolution_fifo != "":
+            env_arg = "EVOLUTION_FIFO={} ".format(evolution_fifo)
+        call("{}bash ./run_hydro.sh {}".format(env_arg, thread_arg(n_threads)),
+             shell=True)
 
         # check hydro finishes properly
         ftmp = open("MUSIC/hydro_results/run.log", 'r', encoding="utf-8")
@@ -241,7 +669,7 @@ def run_hydro_event(final_results_folder, event_id):
     return (hydro_success, hydro_folder_name)
 
 
-def run_kompost(final_results_folder, event_id):
+def run_kompost(final_results_folder, event_id, n_threads=0):
     """This functions run KoMPoST simulation"""
     logo = "\U0001F3B6"
     kompost_folder_name = "kompost_results_{}".format(event_id)
@@ -264,7 +692,8 @@ def run_kompost(final_results_folder, event_id):
     if not kompost_success:
         curr_time = time.asctime()
         print("\U0001F3B6  [{}] Run KoMPoST ... ".format(curr_time), flush=True)
-        call("bash ./run_kompost.sh", shell=True)
+        call("bash ./run_kompost.sh {}".format(thread_arg(n_threads)),
+             shell=True)
 
         kompost_success = True
         if kompost_success:
@@ -291,7 +720,7 @@ def prepare_evolution_files_for_photon(final_results_folder, hydro_folder_name):
                 photonFolderPath)
 
 
-def run_photon(final_results_folder, event_id):
+def run_photon(final_results_folder, event_id, n_threads=0):
     """This functions run photon radiation"""
     logo = "\U0001F3B6"
     photon_folder_name = "photon_results_{}".format(event_id)
@@ -314,7 +743,8 @@ def run_photon(final_results_folder, event_id):
     if not photon_success:
         curr_time = time.asctime()
         print("\U0001F3B6  [{}] Run photon ... ".format(curr_time), flush=True)
-        call("bash ./run_photon.sh", shell=True)
+        call("bash ./run_photon.sh {}".format(thread_arg(n_threads)),
+             shell=True)
 
         photon_success = True
         if photon_success:
@@ -325,9 +755,180 @@ def run_photon(final_results_folder, event_id):
     return (photon_success, photon_folder_name)
 
 
+def photon_streaming_is_supported():
+    """This function checks whether run_hydro.sh can write the evolution
+       history into a named pipe (job folders generated before the
+       streaming mode can not)
+    """
+    with open("run_hydro.sh", "r") as f:
+        return "EVOLUTION_FIFO" in f.read()
+
+
+def open_fifo_for_writing(fifo_path, process):
+    """This function opens a named pipe for writing once the reader process
+       has opened it. It returns None if the process exits before.
+    """
+    while True:
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            os.set_blocking(fd, True)
+            return os.fdopen(fd, "wb")
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if process.poll() is not None:
+            return None
+        time.sleep(0.1)
+
+
+def start_photon_stream(final_results_folder, event_id, save_flag,
+                        n_threads=0):
+    """This function starts the photon emission for the upcoming hydro run.
+       MUSIC writes the evolution history into a named pipe, and a relay
+       thread passes it through a bounded buffer to the named pipe
+       evolution_all_xyeta.dat that the photon code reads. If save_flag is
+       True, the relay also writes a copy to disk, which is moved into the
+       hydro results by close_hydro_stream. The photon results are
+       collected into the results folder as soon as the photon code
+       finishes.
+       It returns the named pipe for MUSIC.
+    """
+    for stream_i in list(photon_streams.values()):
+        # the photon code of the previous event uses the same folder
+        stream_i['photon_thread'].join()
+    evoFileName = "evolution_all_xyeta.dat"
+    photonFolderPath = path.join('photonEmission_hydroInterface', 'results')
+    if path.exists(photonFolderPath):
+        shutil.rmtree(photonFolderPath)
+    mkdir(photonFolderPath)
+    shutil.copyfile("MUSIC/music_input_mode_2",
+                    path.join(photonFolderPath, "music_input"))
+    photon_fifo = path.join(photonFolderPath, evoFileName)
+    os.mkfifo(photon_fifo)
+    hydro_fifo = path.abspath(path.join("MUSIC", "evolution_all_xyeta.fifo"))
+    if path.exists(hydro_fifo):
+        remove(hydro_fifo)
+    os.mkfifo(hydro_fifo)
+    copy_file = ""
+    if save_flag:
+        copy_file = path.join(final_results_folder,
+                              "{}_{}.part".format(evoFileName, event_id))
+
+    curr_time = time.asctime()
+    print("\U0001F3B6  [{}] Run photon with the hydro stream ... ".format(
+        curr_time), flush=True)
+    process = Popen("bash ./run_photon.sh {}".format(thread_arg(n_threads)),
+                    shell=True)
+    chunks = queue.Queue(maxsize=photon_stream_buffer_chunks)
+    stream = {'hydro_fifo': hydro_fifo, 'copy_file': copy_file,
+              'n_bytes': 0, 'photon_success': False}
+
+    def read_evolution():
+        f_copy = open(copy_file, "wb") if copy_file != "" else None
+        with open(hydro_fifo, "rb") as f:
+            for chunk in iter(lambda: f.read(photon_stream_chunk_bytes), b""):
+                stream['n_bytes'] += len(chunk)
+                if f_copy is not None:
+                    f_copy.write(chunk)
+                chunks.put(chunk)
+        if f_copy is not None:
+            f_copy.close()
+        chunks.put(None)
+
+    def write_evolution():
+        f = open_fifo_for_writing(photon_fifo, process)
+        broken_flag = f is None
+        for chunk in iter(chunks.get, None):
+            if broken_flag:
+                # keep draining the stream, so MUSIC never blocks
+                continue
+            try:
+                f.write(chunk)
+            except BrokenPipeError:
+                broken_flag = True
+        if f is not None:
+            try:
+                f.close()
+            except BrokenPipeError:
+                broken_flag = True
+        process.wait()
+        remove(photon_fifo)
+        results_folder = path.join(final_results_folder,
+                                   "photon_results_{}".format(event_id))
+        if path.exists(results_folder):
+            shutil.rmtree(results_folder)
+        shutil.move(photonFolderPath, results_folder)
+        stream['photon_success'] = not broken_flag and stream['n_bytes'] > 0
+
+    stream['hydro_thread'] = threading.Thread(target=read_evolution,
+                                              daemon=True)
+    stream['photon_thread'] = threading.Thread(target=write_evolution,
+                                               daemon=True)
+    stream['hydro_thread'].start()
+    stream['photon_thread'].start()
+    photon_streams[event_id] = stream
+    return hydro_fifo
+
+
+def close_hydro_stream(final_results_folder, event_id):
+    """This function closes the hydro end of the photon stream after MUSIC
+       exits and moves the copy of the evolution history into the hydro
+       results
+    """
+    stream = photon_streams[event_id]
+    while stream['hydro_thread'].is_alive():
+        # an open for writing ends the read if MUSIC never opened the pipe
+        try:
+            os.close(os.open(stream['hydro_fifo'],
+                             os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        stream['hydro_thread'].join(0.1)
+    remove(stream['hydro_fifo'])
+    hydro_folder = path.join(final_results_folder,
+                             "hydro_results_{}".format(event_id))
+    if stream['copy_file'] != "":
+        if stream['n_bytes'] > 0 and path.exists(hydro_folder):
+            shutil.move(stream['copy_file'],
+                        path.join(hydro_folder, "evolution_all_xyeta.dat"))
+        else:
+            remove(stream['copy_file'])
+
+
+def finish_photon_stream(event_id):
+    """This function waits for the photon emission of the hydro stream.
+       It returns True if the photon code read the whole evolution.
+    """
+    stream = photon_streams[event_id]
+    stream['photon_thread'].join()
+    del photon_streams[event_id]
+    return stream['photon_success']
+
+
+def cache_surface_file(surface_file, cache_path):
+    """This function copies the hydro surface into the node-local cache
+       folder, replacing the surface of the previous event. All the
+       samplers then read the same copy from memory.
+       It returns the cached file, or the original surface file if it does
+       not fit into the cache folder.
+    """
+    for file_i in listdir(cache_path):
+        remove(path.join(cache_path, file_i))
+    if stat(surface_file).st_size > shutil.disk_usage(cache_path).free:
+        print("\U000026A0  Not enough space in {} ".format(cache_path)
+              + "for the surface cache", flush=True)
+        return surface_file
+    cached_file = path.join(cache_path, path.basename(surface_file))
+    shutil.copyfile(surface_file, cached_file)
+    return cached_file
+
+
 def prepare_surface_files_for_urqmd(final_results_folder, hydro_folder_name,
-                                    n_urqmd):
-    """This function prepares hydro surface for hadronic casade"""
+                                    n_urqmd, cache_path=""):
+    """This function prepares hydro surface for hadronic casade
+       If cache_path is given, the surface is read once from the results
+       folder and all the samplers share its copy in cache_path.
+    """
     surface_file = glob(
         path.join(final_results_folder, hydro_folder_name, "surface*.dat"))
     spectatorFileList = glob(path.join(final_results_folder, "spectator*.dat"))
@@ -336,6 +937,8 @@ def prepare_surface_files_for_urqmd(final_results_folder, hydro_folder_name,
         spectatorFile = spectatorFileList[0]
     if stat(surface_file[0]).st_size == 0:
         return False
+    if cache_path != "":
+        surface_file[0] = cache_surface_file(surface_file[0], cache_path)
     for iev in range(n_urqmd):
         hydro_surface_folder = "UrQMDev_{0:d}/hydro_event".format(iev)
         if path.exists(hydro_surface_folder):
@@ -354,14 +957,505 @@ def prepare_surface_files_for_urqmd(final_results_folder, hydro_folder_name,
     return True
 
 
-def run_urqmd_event(event_id):
-    """This function runs hadornic afterburner"""
-    call("bash ./run_afterburner.sh {0:d}".format(event_id), shell=True)
+def run_urqmd_event(sub_event_id, sample_id):
+    """This function runs one hadronic afterburner sample in the folder
+       UrQMDev_{sub_event_id} and returns the path of its particle list
+    """
+    call("bash ./run_afterburner.sh {0:d} {1:d}".format(sub_event_id,
+                                                        sample_id),
+         shell=True)
+    return path.join("UrQMDev_{}".format(sub_event_id), "UrQMD_results",
+                     "particle_list_{}.bin".format(sample_id))
+
+
+def run_urqmd_HBT(sub_event_id):
+    """This function runs the HBT analysis in the folder
+       UrQMDev_{sub_event_id}
+    """
+    call("bash ./run_afterburner_HBT.sh {0:d}".format(sub_event_id),
+         shell=True)
+
+
+def open_particle_list(filename):
+    """This function opens a binary particle list, which can be gzipped"""
+    with open(filename, "rb") as f:
+        magic_number = f.read(2)
+    if magic_number == b"\x1f\x8b":
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def read_particle_list_binary(filename):
+    """This function reads in a binary particle list event by event
+
+       Every event in the list starts with its number of particles (int32),
+       followed by one record of particle_list_record_fields (four bytes
+       each) for every particle. It yields one array of shape
+       (n_particles, n_fields) per event with the particle id in the
+       first column.
+    """
+    n_fields = len(particle_list_record_fields)
+    with open_particle_list(filename) as f:
+        data = f.read()
+    offset = 0
+    while offset + 4 <= len(data):
+        n_particles = int(np.frombuffer(data, dtype=np.int32, count=1,
+                                        offset=offset)[0])
+        offset += 4
+        n_particles = min(n_particles, (len(data) - offset)//(4*n_fields))
+        records = np.frombuffer(data, dtype=np.float32,
+                                count=n_particles*n_fields,
+                                offset=offset).reshape(-1, n_fields)
+        offset += 4*n_fields*n_particles
+        particles = records.astype(np.float64)
+        pids = records[:, 0].view(np.int32)
+        if np.all(np.abs(pids) < 10**8):
+            # the particle id is stored as an integer
+            particles[:, 0] = pids
+        yield particles
+
+
+def analyze_afterburner_sample(filename):
+    """This function computes the charged hadron multiplicity and the
+       flow vector Q_2 in the reference window for every oversampled
+       event in the particle list
+       It returns (n_particles_total, n_ch array, Q_2 array)
+    """
+    i_pid = particle_list_record_fields.index('pid')
+    i_px = particle_list_record_fields.index('px')
+    i_py = particle_list_record_fields.index('py')
+    i_pz = particle_list_record_fields.index('pz')
+    n_particles_total = 0
+    n_ch_list = []
+    Q2_list = []
+    for particles in read_particle_list_binary(filename):
+        n_particles_total += len(particles)
+        pT = np.sqrt(particles[:, i_px]**2 + particles[:, i_py]**2)
+        p_mag = np.sqrt(pT**2 + particles[:, i_pz]**2)
+        eta = np.arctanh(particles[:, i_pz]/np.maximum(p_mag, 1e-16))
+        charged = np.isin(np.abs(particles[:, i_pid]).astype(np.int64),
+                          charged_hadron_pids)
+        in_window = (charged
+                     & (np.abs(eta) < afterburner_reference_window['eta_max'])
+                     & (pT > afterburner_reference_window['pT_min'])
+                     & (pT < afterburner_reference_window['pT_max']))
+        phi = np.arctan2(particles[in_window, i_py],
+                         particles[in_window, i_px])
+        n_ch_list.append(np.count_nonzero(in_window))
+        Q2_list.append(np.sum(np.exp(2j*phi)))
+    return n_particles_total, np.array(n_ch_list), np.array(Q2_list)
+
+
+def update_afterburner_statistics(stats, n_ch, Q2):
+    """This function adds the oversampled events of one sample to the
+       running statistics of charged multiplicity and v2{2}
+    """
+    stats['n_events'] += len(n_ch)
+    stats['sum_Nch'] += np.sum(n_ch)
+    stats['sum_Nch2'] += np.sum(n_ch**2)
+    M = n_ch[n_ch > 1].astype(np.float64)
+    Q2 = Q2[n_ch > 1]
+    weight = M*(M - 1.)
+    c2 = (np.abs(Q2)**2 - M)/np.maximum(weight, 1.)
+    stats['sum_w'] += np.sum(weight)
+    stats['sum_w2'] += np.sum(weight**2)
+    stats['sum_wc2'] += np.sum(weight*c2)
+    stats['sum_wc2sq'] += np.sum(weight*c2**2)
+
+
+def get_afterburner_errors(stats):
+    """This function returns the relative statistical error of the mean
+       charged multiplicity and the statistical error of v2{2}
+       from the running statistics
+    """
+    mult_err = np.inf
+    v2_err = np.inf
+    n_events = stats['n_events']
+    if n_events > 1 and stats['sum_Nch'] > 0:
+        mean_Nch = stats['sum_Nch']/n_events
+        var_Nch = max(stats['sum_Nch2']/n_events - mean_Nch**2, 0.)
+        mult_err = np.sqrt(var_Nch/(n_events - 1))/mean_Nch
+    if stats['sum_w'] > 0:
+        c2 = stats['sum_wc2']/stats['sum_w']
+        var_c2 = max(stats['sum_wc2sq']/stats['sum_w'] - c2**2, 0.)
+        n_eff = stats['sum_w']**2/stats['sum_w2']
+        if c2 > 0 and n_eff > 1:
+            v2_err = np.sqrt(var_c2/(n_eff - 1))/(2.*np.sqrt(c2))
+    return mult_err, v2_err
+
+
+def run_afterburner_samples(n_urqmd, para_dict,
+                            finished_sample_queues=(), n_threads=0):
+    """This function runs the hadronic afterburner samples with a task queue
+
+       Every UrQMDev folder has a worker, which takes the next sample as soon
+       as its previous one finishes, until afterburner_n_samples samples are
+       done or afterburner_n_particles particles are collected. Skewed UrQMD
+       run times no longer leave idle cores at the end of the event.
+       When afterburner_v2_error or afterburner_mult_error is set, the
+       sampling stops as soon as the statistical errors of v2{2} and of the
+       charged multiplicity in the reference window reach these values,
+       but not before afterburner_min_samples samples are finished.
+       The particle list of every finished sample is also put into every
+       queue in finished_sample_queues.
+       With afterburner_memory_limit_MB, a new sample only starts while the
+       resident memory of the running samples leaves room for one more.
+       The memory of a sample is measured from the process trees of the
+       running samples only, without the other stages of the job.
+       If the stage is granted only n_threads < n_urqmd cores from a shared
+       core budget, the other workers borrow a core from the budget for
+       every sample, so they backfill the cores released by other events.
+       It returns the particle lists of the finished samples sorted by
+       their sample id.
+    """
+    n_samples_max = para_dict['afterburner_n_samples']
+    if n_samples_max <= 0:
+        n_samples_max = 10*n_urqmd
+    n_samples_min = min(max(para_dict['afterburner_min_samples'], 1),
+                        n_samples_max)
+    n_particles_target = para_dict['afterburner_n_particles']
+    v2_err_target = para_dict['afterburner_v2_error']
+    mult_err_target = para_dict['afterburner_mult_error']
+    adaptive_flag = (v2_err_target > 0 or mult_err_target > 0)
+    if ((n_particles_target > 0 or adaptive_flag)
+            and para_dict['afterburner_type'] != "UrQMD"):
+        print("\U000026A0  Adaptive sampling needs UrQMD particle lists, "
+              + "use afterburner_n_samples = {}".format(n_samples_max),
+              flush=True)
+        n_particles_target = 0
+        adaptive_flag = False
+
+    sampler = {'n_issued': 0, 'n_particles': 0, 'sample_files': {},
+               'converged': False}
+    stats = {'n_events': 0, 'sum_Nch': 0., 'sum_Nch2': 0., 'sum_w': 0.,
+             'sum_w2': 0., 'sum_wc2': 0., 'sum_wc2sq': 0.}
+    sampler_lock = threading.Lock()
+
+    core_budget = para_dict.get('core_budget', None)
+    memory_limit = para_dict.get('afterburner_memory_limit_MB', 0)
+    sampler['n_running'] = 0
+
+    def sampling_is_done():
+        with sampler_lock:
+            return (sampler['n_issued'] >= n_samples_max
+                    or sampler['converged']
+                    or 0 < n_particles_target <= sampler['n_particles'])
+
+    def get_next_sample():
+        with sampler_lock:
+            if sampler['n_issued'] >= n_samples_max or sampler['converged']:
+                return None
+            if 0 < n_particles_target <= sampler['n_particles']:
+                return None
+            sample_id = sampler['n_issued']
+            sampler['n_issued'] += 1
+            return sample_id
+
+    def admit_sample():
+        # wait until the memory of the running samples leaves room for one
+        # more sample of the same size
+        waiting = False
+        while True:
+            with memory_monitor['lock']:
+                sample_rss = memory_monitor['afterburner_MB']
+                n_measured = memory_monitor['n_afterburner']
+            with sampler_lock:
+                n_running = sampler['n_running']
+                if (memory_limit <= 0 or n_running == 0 or n_measured == 0
+                        or (sample_rss + sample_rss/n_measured
+                            <= memory_limit)):
+                    sampler['n_running'] += 1
+                    return
+            if sampling_is_done():
+                with sampler_lock:
+                    sampler['n_running'] += 1
+                return
+            if not waiting:
+                print("\U000026A0  {:.0f} MB used by {} samples, ".format(
+                    sample_rss, n_measured)
+                      + "wait for memory", flush=True)
+                waiting = True
+            time.sleep(memory_monitor_interval)
+
+    def run_sample(sub_event_id, sample_id):
+        sample_file = run_urqmd_event(sub_event_id, sample_id)
+        if not path.exists(sample_file):
+            print("\U000026A0  afterburner sample {} failed".format(
+                sample_id),
+                  flush=True)
+            return
+        n_particles = 0
+        if n_particles_target > 0 or adaptive_flag:
+            n_particles, n_ch, Q2 = analyze_afterburner_sample(
+                                                            sample_file)
+        for queue_i in finished_sample_queues:
+            queue_i.put(sample_file)
+        with sampler_lock:
+            sampler['sample_files'][sample_id] = sample_file
+            sampler['n_particles'] += n_particles
+            if not adaptive_flag or sampler['converged']:
+                return
+            update_afterburner_statistics(stats, n_ch, Q2)
+            mult_err, v2_err = get_afterburner_errors(stats)
+            mult_converged = (mult_err_target <= 0
+                              or mult_err <= mult_err_target)
+            v2_converged = v2_err_target <= 0 or v2_err <= v2_err_target
+            if (len(sampler['sample_files']) >= n_samples_min
+                    and mult_converged and v2_converged):
+                sampler['converged'] = True
+                print("\U0001F5FF  Sampling converged after "
+                      + "{} samples: ".format(
+                          len(sampler['sample_files']))
+                      + "rel. err(Nch) = {:.3g}, ".format(mult_err)
+                      + "err(v2{{2}}) = {:.3g}".format(v2_err),
+                      flush=True)
+
+    def sample_worker(sub_event_id):
+        borrow_flag = core_budget is not None and 0 < n_threads <= sub_event_id
+        while True:
+            if borrow_flag and not borrow_core(core_budget, sampling_is_done):
+                return
+            admit_sample()
+            sample_id = get_next_sample()
+            try:
+                if sample_id is not None:
+                    run_sample(sub_event_id, sample_id)
+            finally:
+                with sampler_lock:
+                    sampler['n_running'] -= 1
+                if borrow_flag:
+                    release_cores(core_budget, 1)
+            if sample_id is None:
+                return
+
+    workers = [threading.Thread(target=sample_worker, args=(iev,),
+                                daemon=True)
+               for iev in range(n_urqmd)]
+    for worker_i in workers:
+        worker_i.start()
+    for worker_i in workers:
+        worker_i.join()
+
+    curr_time = time.asctime()
+    print("\U0001F5FF  [{}] Finished {} afterburner samples".format(
+        curr_time, len(sampler['sample_files'])),
+          flush=True)
+    return [sampler['sample_files'][sample_id]
+            for sample_id in sorted(sampler['sample_files'])]
+
+
+def append_file(src_filename, dst_file):
+    """This function appends the file src_filename to the unbuffered open
+       file dst_file. It copies inside the kernel with copy_file_range
+       when it is available and falls back to large buffered copies.
+    """
+    with open(src_filename, "rb") as src_file:
+        n_bytes = fstat(src_file.fileno()).st_size
+        offset = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < n_bytes:
+                    n_copied = os.copy_file_range(src_file.fileno(),
+                                                  dst_file.fileno(),
+                                                  n_bytes - offset,
+                                                  offset_src=offset)
+                    if n_copied == 0:
+                        break
+                    offset += n_copied
+            except OSError:
+                pass
+        if offset < n_bytes:
+            src_file.seek(offset)
+            shutil.copyfileobj(src_file, dst_file, 16*1024*1024)
+
+
+def merge_particle_lists(finished_samples, merged_filename, remove_flag):
+    """This function appends the particle lists from the queue
+       finished_samples to merged_filename as soon as they arrive, until
+       it gets None. The merged list is written to a temporary file and
+       renamed to merged_filename at the end, so an incomplete list never
+       looks finished.
+       It returns the number of merged particle lists.
+    """
+    tmp_filename = "{}.tmp".format(merged_filename)
+    n_merged = 0
+    with open(tmp_filename, "wb", buffering=0) as merged_file:
+        while True:
+            sample_file = finished_samples.get()
+            if sample_file is None:
+                break
+            append_file(sample_file, merged_file)
+            n_merged += 1
+            if remove_flag:
+                remove(sample_file)
+    if n_merged > 0:
+        replace(tmp_filename, merged_filename)
+    else:
+        remove(tmp_filename)
+    return n_merged
+
+
+def run_spvn_analysis_shard(sample_file, shard_id, weight_flag):
+    """This function runs the spvn analysis on one afterburner sample in
+       the folder hadronic_afterburner_toolkit/shard_{shard_id}
+       It returns the results folder of the shard and its weight, the
+       number of oversampled events in the sample (1 if weight_flag is
+       False).
+    """
+    call("bash ./run_analysis_spvn_shard.sh {0:d} {1:s}".format(
+        shard_id, path.abspath(sample_file)),
+         shell=True)
+    weight = 1
+    if weight_flag:
+        weight = sum(1 for _ in read_particle_list_binary(sample_file))
+    return (path.join("hadronic_afterburner_toolkit",
+                      "shard_{}".format(shard_id), "results"), weight)
+
+
+def analyze_spvn_shards(finished_samples, n_workers, shard_results,
+                        weight_flag):
+    """This function analyzes the afterburner samples from the queue
+       finished_samples in parallel as soon as they arrive, until it gets
+       None. The results folders and weights of the shards are appended
+       to shard_results.
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        while True:
+            sample_file = finished_samples.get()
+            if sample_file is None:
+                break
+            futures.append(executor.submit(run_spvn_analysis_shard,
+                                           sample_file, len(futures),
+                                           weight_flag))
+        for future in futures:
+            shard_results.append(future.result())
+
+
+def get_spvn_merge_rule(filename):
+    """This function returns the column rules of spvn_merge_rules for the
+       results file filename, or None
+    """
+    for pattern_i, column_rules in spvn_merge_rules:
+        if re.search(pattern_i, filename):
+            return column_rules
+    return None
+
+
+def merge_spvn_shards(shard_results, output_folder):
+    """This function merges the spvn results of the shards into
+       output_folder
+
+       Every file is merged cell by cell with its column rules in
+       spvn_merge_rules: event averages, e.g. dN and Qn, are averaged with
+       the number of events in every shard, raw counts, e.g. total N and
+       the number of events, are summed, and ratios, e.g. vn = Qn/dN, are
+       averaged with the merged counts (the event average times the
+       number of events, or the raw count), so that the merged results
+       are the same as the results of the analysis of all the samples at
+       once. Files without rules, e.g. the multi-particle correlators, or
+       that can not be read as tables of the same shape are not merged.
+       It returns the list of files that are not merged.
+    """
+    weights = np.array([weight for _, weight in shard_results],
+                       dtype=np.float64)
+    first_folder = shard_results[0][0]
+    failed_files = []
+    for filename in sorted(listdir(first_folder)):
+        column_rules = get_spvn_merge_rule(filename)
+        if column_rules is None:
+            print("\U000026A0  can not merge {}, ".format(filename)
+                  + "no merge rule for the file", flush=True)
+            failed_files.append(filename)
+            continue
+        file_list = [path.join(folder, filename)
+                     for folder, _ in shard_results]
+        header_lines = []
+        with open(file_list[0], "r") as f:
+            for line in f:
+                if line.startswith("#"):
+                    header_lines.append(line)
+        try:
+            data = np.array([np.loadtxt(file_i, ndmin=2)
+                             for file_i in file_list], dtype=np.float64)
+        except (ValueError, OSError) as err:
+            print("\U000026A0  can not merge {}: {}".format(filename, err),
+                  flush=True)
+            failed_files.append(filename)
+            continue
+        if data.size == 0:
+            shutil.copy(file_list[0], output_folder)
+            continue
+
+        # the sums over the events of every shard
+        totals = np.array(data)
+        for rows, cols, rule, _ in column_rules:
+            if rule == "average":
+                totals[:, rows, cols] *= weights[:, np.newaxis, np.newaxis]
+        merged_data = np.array(data[0])
+        for rows, cols, rule, count_cell in column_rules:
+            if rule == "average":
+                merged_data[rows, cols] = (
+                    np.sum(totals[:, rows, cols], axis=0)
+                    / max(np.sum(weights), 1e-16))
+            elif rule == "sum":
+                merged_data[rows, cols] = np.sum(data[:, rows, cols], axis=0)
+            elif rule == "ratio":
+                count_row, count_col = count_cell
+                if count_row is None:
+                    counts = totals[:, rows][:, :, [count_col]]
+                else:
+                    counts = np.broadcast_to(
+                        totals[:, [count_row]][:, :, [count_col]],
+                        data[:, rows, :1].shape)
+                merged_data[rows, cols] = (
+                    np.sum(counts*data[:, rows, cols], axis=0)
+                    / np.maximum(np.sum(counts, axis=0), 1e-16))
+        with open(path.join(output_folder, filename), "w") as f:
+            f.write("".join(header_lines))
+            np.savetxt(f, merged_data, fmt="%.8e")
+    return failed_files
+
+
+def run_spin_polarization(n_urqmd, final_results_folder, event_id,
+                          para_dict, startTime, checkPointFileName):
+    """This function runs the spin polarization calculation in the
+       UrQMDev_{n_urqmd} folder
+    """
+    logo = "\U0001F5FF"
+    spin_folder_name = "spin_results_{}".format(event_id)
+    spin_folder = path.join(final_results_folder, spin_folder_name)
+    if path.exists(spin_folder):
+        print("{} spin results {} exist ... ".format(logo, spin_folder),
+              flush=True)
+        return True
+
+    curr_time = time.asctime()
+    print("{}  [{}] Running spin calculations ... ".format(logo, curr_time),
+          flush=True)
+    call("bash ./run_spinPol.sh {}".format(n_urqmd), shell=True)
+    shutil.move("UrQMDev_{}/iSS/results".format(n_urqmd), spin_folder)
+    if para_dict["check_point_flag"]:
+        checkPoint(startTime, checkPointFileName, final_results_folder,
+                   para_dict, "spin")
+    return True
 
 
 def run_urqmd_shell(n_urqmd, final_results_folder, event_id, para_dict,
-                    startTime, checkPointFileName):
-    """This function runs urqmd events in parallel"""
+                    shard_results=None, n_threads=0):
+    """This function runs urqmd events in parallel
+
+       If shard_results is a list, the spvn analysis runs on every sample as
+       soon as it finishes and the results of the shards are appended to
+       shard_results. The merged particle list is then only kept with
+       save_urqmd.
+       n_threads is the number of cores granted to the samplers, see
+       run_afterburner_samples
+       With particle_list_compression > 0 and save_urqmd, the saved
+       particle list particle_list_{event_id}.gz is compressed frame by
+       frame from the samples at the same time, see
+       utilities/particle_list_frames.py
+    """
     logo = "\U0001F5FF"
     urqmdResults = "particle_list_{}.bin".format(event_id)
     results_folder = path.join(final_results_folder, urqmdResults)
@@ -374,45 +1468,88 @@ def run_urqmd_shell(n_urqmd, final_results_folder, event_id, para_dict,
 
     if not urqmd_success:
         curr_time = time.asctime()
-        if para_dict["compute_polarization"]:
-            spin_folder_name = "spin_results_{}".format(event_id)
-            spin_folder = path.join(final_results_folder, spin_folder_name)
-            if path.exists(spin_folder):
-                print("{} spin results {} exist ... ".format(logo,
-                                                             spin_folder),
-                      flush=True)
-            else:
-                print("{}  [{}] Running spin calculations ... ".format(logo,
-                                                                   curr_time),
-                      flush=True)
-                call("bash ./run_spinPol.sh {}".format(n_urqmd), shell=True)
-                shutil.move("UrQMDev_{}/iSS/results".format(n_urqmd),
-                            spin_folder)
-                if para_dict["check_point_flag"]:
-                    checkPoint(startTime, checkPointFileName,
-                               final_results_folder)
-
         print("{}  [{}] Running UrQMD ... ".format(logo, curr_time),
               flush=True)
-        with Pool(processes=n_urqmd) as pool1:
-            pool1.map(run_urqmd_event, range(n_urqmd))
-
-        urqmdResFile = "particle_list.bin"
-        for iev in range(1, n_urqmd):
-            call("cat UrQMDev_{}/UrQMD_results/{} ".format(iev, urqmdResFile)
-                 + ">> UrQMDev_0/UrQMD_results/{}".format(urqmdResFile),
-                 shell=True)
-            remove("UrQMDev_{}/UrQMD_results/{}".format(iev, urqmdResFile))
-        urqmd_success = True
-        shutil.move("UrQMDev_0/UrQMD_results/{}".format(urqmdResFile),
-                    results_folder)
+        for iev in range(n_urqmd):
+            urqmd_results_folder = "UrQMDev_{}/UrQMD_results".format(iev)
+            shutil.rmtree(urqmd_results_folder, ignore_errors=True)
+            mkdir(urqmd_results_folder)
+
+        HBT_flag = path.exists("run_afterburner_HBT.sh")
+        shard_flag = shard_results is not None
+        compress_level = para_dict.get('particle_list_compression', 0)
+        compress_flag = compress_level > 0 and para_dict['save_urqmd']
+        merge_flag = (not shard_flag) or (para_dict['save_urqmd']
+                                          and not compress_flag)
+        remove_flag = HBT_flag or shard_flag or compress_flag
+        consumers = []
+        merge_results = []
+        compress_results = []
+        if merge_flag:
+            # merge the particle lists while the other samples are running
+            merge_queue = queue.Queue()
+            consumers.append((merge_queue, threading.Thread(
+                target=lambda: merge_results.append(
+                    merge_particle_lists(merge_queue, results_folder,
+                                         not remove_flag)),
+                daemon=True)))
+        if compress_flag:
+            # compress the saved particle list while it is being merged
+            compress_queue = queue.Queue()
+            consumers.append((compress_queue, threading.Thread(
+                target=lambda: compress_results.append(
+                    write_particle_list_frames(
+                        iter(compress_queue.get, None),
+                        path.join(final_results_folder,
+                                  "particle_list_{}.gz".format(event_id)),
+                        compress_level, particle_list_compression_threads)),
+                daemon=True)))
+        if shard_flag:
+            shard_queue = queue.Queue()
+            consumers.append((shard_queue, threading.Thread(
+                target=analyze_spvn_shards,
+                args=(shard_queue, n_urqmd, shard_results,
+                      para_dict['afterburner_type'] == "UrQMD"),
+                daemon=True)))
+        for _, consumer_i in consumers:
+            consumer_i.start()
+        try:
+            sample_files = run_afterburner_samples(
+                n_urqmd, para_dict,
+                [queue_i for queue_i, _ in consumers], n_threads)
+        finally:
+            for queue_i, consumer_i in consumers:
+                queue_i.put(None)
+                consumer_i.join()
+        if merge_flag:
+            urqmd_success = merge_results != [] and merge_results[0] > 0
+        else:
+            urqmd_success = (sample_files != []
+                             and len(shard_results) == len(sample_files))
+        if compress_flag:
+            urqmd_success = (urqmd_success and compress_results != []
+                             and compress_results[0] == len(sample_files))
+
+        if HBT_flag:
+            with Pool(processes=n_urqmd) as pool1:
+                pool1.map(run_urqmd_HBT, range(n_urqmd))
+        if remove_flag:
+            for sample_file in sample_files:
+                remove(sample_file)
+        for iev in range(n_urqmd):
+            shutil.rmtree("UrQMDev_{}/hydro_event".format(iev),
+                          ignore_errors=True)
 
     return (urqmd_success, results_folder)
 
 
 def run_spvn_analysis(urqmd_file_path, n_threads, final_results_folder,
-                      event_id):
-    """This function runs analysis"""
+                      event_id, shard_results=None):
+    """This function runs analysis
+
+       If the results of the shards are given, it merges them instead of
+       analyzing the particle list.
+    """
     final_results_folder = path.join(final_results_folder,
                                      "spvn_results_{0:s}".format(event_id))
     if path.exists(final_results_folder):
@@ -421,6 +1558,21 @@ def run_spvn_analysis(urqmd_file_path, n_threads, final_results_folder,
     if path.exists(spvn_folder):
         shutil.rmtree(spvn_folder)
     mkdir(spvn_folder)
+    if shard_results:
+        curr_time = time.asctime()
+        print(f"\U0001F3CD  [{curr_time}] Merging spvn results from "
+              + f"{len(shard_results)} shards ... ", flush=True)
+        failed_files = merge_spvn_shards(shard_results, spvn_folder)
+        if failed_files != []:
+            print("\U000026A0  {} spvn results are not merged ".format(
+                len(failed_files)) + "and missing in the event results",
+                  flush=True)
+        call("bash ./run_analysis_spvn.sh merged", shell=True)
+        for shard_folder, _ in shard_results:
+            shutil.rmtree(path.dirname(shard_folder), ignore_errors=True)
+        shutil.move(spvn_folder, final_results_folder)
+        return
+
     call("ln -s {0:s} {1:s}".format(path.abspath(urqmd_file_path),
                                     path.join(spvn_folder,
                                               "particle_list.bin")),
@@ -457,8 +1609,42 @@ def check_an_event_is_good(event_folder):
     return True
 
 
-def zip_results_into_hdf5(final_results_folder, event_id, para_dict):
-    """This function combines all the results into hdf5"""
+def read_results_file(file_path):
+    """This function reads one results table and its header line in a
+       single pass. The data are returned with the same shape as
+       np.loadtxt(file_path, dtype="float32"). Tables that the fast
+       tokenizer can not handle are read by np.loadtxt.
+       It returns (data, header_text)
+    """
+    with open(file_path, "r") as f:
+        text = f.read()
+    header_text = ""
+    if text.startswith("#"):
+        header_text = text[:text.find("\n") + 1] if "\n" in text else text
+    data_rows = []
+    for line in text.splitlines():
+        row = line.split("#", 1)[0].split()
+        if row != []:
+            data_rows.append(row)
+    n_cols = len(data_rows[0]) if data_rows != [] else 0
+    try:
+        if n_cols == 0 or any(len(row) != n_cols for row in data_rows):
+            raise ValueError
+        data = np.array([token for row in data_rows for token in row],
+                        dtype=np.float32).reshape(len(data_rows), n_cols)
+        data = np.squeeze(data)
+    except ValueError:
+        data = np.loadtxt(file_path, dtype="float32")
+    return data, header_text
+
+
+def zip_results_into_hdf5(final_results_folder, event_id, para_dict,
+                          n_threads=1):
+    """This function combines all the results into hdf5
+
+       The result files are parsed in parallel with n_threads threads and
+       written into the hdf5 file in one session.
+    """
     results_name = "spvn_results_{}".format(event_id)
     time_stamp = para_dict['time_stamp_str']
     initial_state_filelist1 = [
@@ -569,9 +1755,14 @@ def zip_results_into_hdf5(final_results_folder, event_id, para_dict):
                         shutil.move(ispinfile, spvnfolder)
 
 
+        file_list = glob(path.join(spvnfolder, "*"))
+        table_list = [file_path for file_path in file_list
+                      if "usedParameters" not in file_path.split("/")[-1]]
+        with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+            table_data = list(executor.map(read_results_file, table_list))
+
         hf = h5py.File("{0}.h5".format(results_name), "w")
         gtemp = hf.create_group("{0}".format(results_name))
-        file_list = glob(path.join(spvnfolder, "*"))
         for file_path in file_list:
             file_name = file_path.split("/")[-1]
             if "usedParameters" in file_name:
@@ -580,18 +1771,21 @@ def zip_results_into_hdf5(final_results_folder, event_id, para_dict):
                     paraline = rawline.strip('\n')
                     gtemp.attrs.create("{0}".format(iline),
                                        np.bytes_(paraline))
-            else:
-                dtemp = np.loadtxt(file_path, dtype="float32")
-                h5data = gtemp.create_dataset("{0}".format(file_name),
-                                              data=dtemp,
-                                              compression="gzip",
-                                              compression_opts=9)
-                # save header
-                ftemp = open(file_path, "r")
-                header_text = str(ftemp.readline())
-                ftemp.close()
-                if header_text.startswith("#"):
-                    h5data.attrs.create("header", np.bytes_(header_text))
+        if para_dict['hdf5_layout'] == "columnar":
+            write_columnar_event(
+                gtemp, [file_path.split("/")[-1] for file_path in table_list],
+                [dtemp for dtemp, _ in table_data],
+                [header_text for _, header_text in table_data],
+                para_dict['hdf5_storage_profile'])
+            table_list = []
+        for file_path, (dtemp, header_text) in zip(table_list, table_data):
+            file_name = file_path.split("/")[-1]
+            h5data = create_dataset_with_profile(
+                gtemp, "{0}".format(file_name), dtemp,
+                para_dict['hdf5_storage_profile'])
+            # save header
+            if header_text.startswith("#"):
+                h5data.attrs.create("header", np.bytes_(header_text))
         hf.close()
         shutil.move("{}.h5".format(results_name), final_results_folder)
         shutil.rmtree(spvnfolder, ignore_errors=True)
@@ -626,9 +1820,16 @@ def remove_unwanted_outputs(final_results_folder, event_id, para_dict):
                                "spin_results_{}".format(event_id))
         shutil.rmtree(spinfolder, ignore_errors=True)
 
-    if not para_dict["save_urqmd"]:
-        urqmd_results_name = "particle_list_{}.bin".format(event_id)
-        remove(path.join(final_results_folder, urqmd_results_name))
+    compressed_list_name = path.join(final_results_folder,
+                                     "particle_list_{}.gz".format(event_id))
+    if (not para_dict["save_urqmd"]
+            or (para_dict.get('particle_list_compression', 0) > 0
+                and path.exists(compressed_list_name))):
+        # the compressed particle list is kept instead
+        urqmd_results_name = path.join(final_results_folder,
+                                       "particle_list_{}.bin".format(event_id))
+        if path.exists(urqmd_results_name):
+            remove(urqmd_results_name)
 
     if para_dict["compute_photons"]:
         photonfolder = path.join(final_results_folder,
@@ -636,89 +1837,971 @@ def remove_unwanted_outputs(final_results_folder, event_id, para_dict):
         shutil.rmtree(photonfolder, ignore_errors=True)
 
 
-def checkPoint(startTime, checkPointFileName, finalResultsFolder):
-    checkPointTime = time.time()
-    if checkPointTime - startTime > 43200:
-        # trigger the checkpoint when the simulation runs longer than 12 hours
-        if path.exists(checkPointFileName):
-            remove(checkPointFileName)
-        tar = tarfile.open(checkPointFileName, 'w:gz')
-        tar.add(finalResultsFolder)
-        tar.close()
-        sys.exit(85)
+def archive_hydro_results(final_results_folder, event_id, para_dict,
+                          n_threads=1):
+    """This function converts the saved binary hydro surfaces and
+       evolution to the compact float32 archives, the text tables are kept,
+       see utilities/hydro_archive.py
+    """
+    archive_level = para_dict.get('hydro_archive_level', 0)
+    hydrofolder = path.join(final_results_folder,
+                            "hydro_results_{}".format(event_id))
+    if (archive_level <= 0 or not para_dict["save_hydro"]
+            or not path.isdir(hydrofolder)):
+        return
+    n_bytes_before, n_bytes_after = archive_folder(hydrofolder,
+                                                   archive_level, n_threads)
+    print("\U0001F4E6  Archived {}: {:.1f} MB -> {:.1f} MB".format(
+        hydrofolder, n_bytes_before/1024.**2, n_bytes_after/1024.**2),
+          flush=True)
 
 
-def main(para_dict_):
-    """This is the main function"""
-    startTime = time.time()
-    initial_condition = para_dict_['initial_condition']
-    initial_type = para_dict_['initial_type']
-    num_threads = para_dict_['num_threads']
-    n_urqmd = para_dict_['n_urqmd']
+def get_checkpoint_threshold(para_dict):
+    """This function returns the run time in seconds after which the
+       driver writes a checkpoint and exits. It is the job walltime minus
+       the safety margin if the walltime is given, and checkpoint_time
+       otherwise.
+    """
+    if para_dict.get('checkpoint_walltime', 0.) > 0.:
+        return 3600.*max(0., para_dict['checkpoint_walltime']
+                         - para_dict.get('checkpoint_margin', 1.))
+    return 3600.*para_dict.get('checkpoint_time', 12.)
+
+
+def load_checkpoint_manifest(finalResultsFolder):
+    """This function reads the manifest of the last checkpoint of the
+       results folder. It returns an empty manifest if there is none.
+    """
+    manifest = {'codec': None, 'stages': [], 'folders': [], 'files': {}}
+    manifest_file = path.join(finalResultsFolder, checkpoint_manifest_name)
+    try:
+        with open(manifest_file, "r") as f:
+            manifest.update(json.load(f))
+    except (FileNotFoundError, ValueError):
+        pass
+    return manifest
+
+
+def scan_results_folder(finalResultsFolder):
+    """This function returns the sub-folders and the fingerprints
+       (size, mtime in seconds) of all the files in the results folder,
+       without the half-written .tmp and .part files
+    """
+    folder_list = []
+    file_dict = {}
+    for root, folders, filenames in os.walk(finalResultsFolder):
+        for folder_i in folders:
+            folder_list.append(path.join(root, folder_i))
+        for filename in filenames:
+            file_path = path.join(root, filename)
+            if filename == checkpoint_manifest_name and (
+                    root == finalResultsFolder):
+                continue
+            if filename.endswith((".tmp", ".part")):
+                continue
+            file_stat = os.lstat(file_path)
+            file_dict[file_path] = [file_stat.st_size,
+                                    int(file_stat.st_mtime)]
+    return folder_list, file_dict
+
+
+def write_checkpoint(checkPointFileName, finalResultsFolder, stage_name,
+                     codec="gz"):
+    """This function writes an incremental checkpoint of the results folder
+
+       The checkpoint is a sequence of tar archives, each gzipped with
+       level 1 (codec "gz") or uncompressed (codec "none"). Every
+       checkpoint appends one archive with the files that changed since
+       the previous checkpoint and the updated manifest of the finished
+       stages and file fingerprints. The archive is appended to the
+       checkpoint file in place, so a checkpoint only writes the changed
+       files. If the append fails, the file is cut back to the previous
+       checkpoint. A new checkpoint is written to a temporary file and
+       renamed.
+       It returns the number of archived files.
+    """
+    manifest = load_checkpoint_manifest(finalResultsFolder)
+    append_flag = (manifest['codec'] == codec
+                   and path.exists(checkPointFileName))
+    if not append_flag:
+        # start a new checkpoint
+        manifest = {'codec': codec, 'stages': [], 'folders': [],
+                    'files': {}}
+    folder_list, file_dict = scan_results_folder(finalResultsFolder)
+    new_folders = [folder_i for folder_i in folder_list
+                   if folder_i not in manifest['folders']]
+    changed_files = [file_i for file_i, fingerprint in file_dict.items()
+                     if manifest['files'].get(file_i) != fingerprint]
+    if stage_name not in manifest['stages']:
+        manifest['stages'].append(stage_name)
+    manifest['time'] = time.time()
+    manifest['folders'] = folder_list
+    manifest['files'] = file_dict
+    manifest_file = path.join(finalResultsFolder, checkpoint_manifest_name)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
+
+    filename = checkPointFileName
+    if not append_flag:
+        filename = "{}.tmp".format(checkPointFileName)
+    tar_mode = "w:gz" if codec == "gz" else "w"
+    tar_options = {'compresslevel': 1} if codec == "gz" else {}
+    with open(filename, "ab" if append_flag else "wb") as checkpoint_file:
+        offset = checkpoint_file.tell()
+        try:
+            with tarfile.open(fileobj=checkpoint_file, mode=tar_mode,
+                              **tar_options) as tar:
+                tar.add(finalResultsFolder, recursive=False)
+                for folder_i in new_folders:
+                    tar.add(folder_i, recursive=False)
+                for file_i in changed_files:
+                    tar.add(file_i, recursive=False)
+                # the manifest comes last, an archive cut short keeps the
+                # manifest of the previous checkpoint
+                tar.add(manifest_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        except BaseException:
+            checkpoint_file.truncate(offset)
+            raise
+    if not append_flag:
+        replace(filename, checkPointFileName)
+    return len(changed_files)
+
+
+def results_folder_is_current(finalResultsFolder):
+    """This function checks whether the results folder is at least as new
+       as its last checkpoint, i.e. every file in the manifest of the
+       checkpoint is there and not older than in the manifest
+    """
+    manifest = load_checkpoint_manifest(finalResultsFolder)
+    if manifest['codec'] is None:
+        return False
+    for file_i, (_, mtime) in manifest['files'].items():
+        try:
+            if int(os.lstat(file_i).st_mtime) < mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def restore_checkpoint(checkPointFileName):
+    """This function extracts the incremental checkpoint archives in order,
+       if the results folder is missing or older than the checkpoint.
+       Files on disk that are newer than the archived ones are kept. The
+       files that were removed before the last checkpoint are deleted
+       again, unless they were written after the checkpoint. The
+       checkpoint file is kept, so the next checkpoint only appends the
+       changed files, unless it is cut short.
+    """
+    if not path.exists(checkPointFileName):
+        return
+    finalResultsFolder = checkPointFileName.split(".tar")[0]
+    if results_folder_is_current(finalResultsFolder):
+        print("\U0001F4E6  {} is newer than the checkpoint {}, ".format(
+            finalResultsFolder, checkPointFileName)
+              + "no need to restore", flush=True)
+        return
     curr_time = time.asctime()
-    print("\U0001F3CE  [{}] Number of threads: {}".format(
-        curr_time, num_threads),
+    print("\U0001F4E6  [{}] Restore checkpoint {} ...".format(
+        curr_time, checkPointFileName),
+          flush=True)
+    n_members = 0
+    cut_short = False
+    with open(checkPointFileName, "rb") as f:
+        magic_number = f.read(2)
+    with open(checkPointFileName, "rb") as f:
+        fileobj = f
+        if magic_number == b"\x1f\x8b":
+            fileobj = gzip.GzipFile(fileobj=f, mode="rb")
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r|",
+                              ignore_zeros=True) as tar:
+                for member in tar:
+                    if member.isfile() and path.exists(member.name) and (
+                            os.lstat(member.name).st_mtime > member.mtime):
+                        continue
+                    tar.extract(member)
+                    n_members += 1
+        except (EOFError, tarfile.ReadError, OSError, zlib.error):
+            print("\U000026A0  The checkpoint is cut short, restored "
+                  + "{} files".format(n_members), flush=True)
+            cut_short = True
+
+    if cut_short:
+        # the next checkpoint can not be appended to a broken archive, it
+        # starts a new one from the restored files
+        remove(checkPointFileName)
+    manifest = load_checkpoint_manifest(finalResultsFolder)
+    if manifest['codec'] is None:
+        return
+    _, file_dict = scan_results_folder(finalResultsFolder)
+    for file_i, (_, mtime) in file_dict.items():
+        if (file_i not in manifest['files']
+                and mtime < int(manifest.get('time', 0.))):
+            remove(file_i)
+    print("\U0001F4E6  Restored {} after the stages: {}".format(
+        finalResultsFolder, ", ".join(manifest['stages'])),
           flush=True)
 
-    idx0 = para_dict_['hydro_id0']
-    nev = para_dict_['n_hydro']
-    exitErrorTrigger = False
-    exitErrorTriggerInitial = False
-    for iev in range(nev):
-        curr_time = time.asctime()
 
-        event_id = str(iev + idx0)
-        if (para_dict_['initial_condition'] != "self"
-            and para_dict_['initial_condition'] != "fixCentrality"):
-            initial_database_name = (
-                    initial_condition.split("/")[-1].split(".h5")[0])
-            event_id = initial_database_name + "_" + event_id
+def checkPoint(startTime, checkPointFileName, finalResultsFolder,
+               para_dict, stage_name):
+    """This function exits with code 85 after the stage stage_name once
+       the run time exceeds the checkpoint threshold. The checkpoint is
+       not written here, the stage graph writes it with write_exit_checkpoint
+       once the other stages of the event have finished.
+    """
+    if time.time() - startTime > get_checkpoint_threshold(para_dict):
+        err = SystemExit(85)
+        err.checkpoint = (checkPointFileName, finalResultsFolder,
+                          stage_name, para_dict.get('checkpoint_codec', "gz"))
+        raise err
+
+
+def write_exit_checkpoint(err):
+    """This function writes the checkpoint requested by checkPoint with the
+       exit err and raises err
+    """
+    checkPointFileName, finalResultsFolder, stage_name, codec = (
+        err.checkpoint)
+    checkPointTime = time.time()
+    curr_time = time.asctime()
+    n_files = write_checkpoint(checkPointFileName, finalResultsFolder,
+                               stage_name, codec)
+    print("\U0001F4E6  [{}] Checkpoint after {}: {} files ".format(
+        curr_time, stage_name, n_files)
+          + "archived in {:.1f} s".format(time.time() - checkPointTime),
+          flush=True)
+    raise err
+
+
+def setup_event_folder(iev, para_dict_, stage_manifest=None):
+    """This function prepares the results folder for the iev-th hydro event
+       It returns the event_id and the final results folder. The event_id is
+       None if the event has already finished properly. The stage manifest
+       is checked first, the results on disk are only checked for the
+       events without a record.
+    """
+    initial_condition = para_dict_['initial_condition']
+    event_id = str(iev + para_dict_['hydro_id0'])
+    if (initial_condition != "self" and initial_condition != "fixCentrality"):
+        initial_database_name = (
+                initial_condition.split("/")[-1].split(".h5")[0])
+        event_id = initial_database_name + "_" + event_id
+
+    final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+
+    if stage_is_finished(stage_manifest, event_id, "event"):
+        print("{} finished properly. No need to rerun.".format(event_id),
+              flush=True)
+        return None, final_results_folder
+
+    # setup OSG checkpoint file
+    CHECKPOINT_FILENAME = "{}.tar.gz".format(final_results_folder)
+    restore_checkpoint(CHECKPOINT_FILENAME)
+
+    if path.exists(final_results_folder):
+        print("{} exists ...".format(final_results_folder), flush=True)
+        results_file = path.join(final_results_folder,
+                                 "spvn_results_{}.h5".format(event_id))
+        status = False
+        if path.exists(results_file):
+            status = True
+        else:
+            spvnfolder = path.join(final_results_folder,
+                                   "spvn_results_{}".format(event_id))
+            if path.exists(spvnfolder):
+                status = check_an_event_is_good(spvnfolder)
+        if status:
+            print("{} finished properly. No need to rerun.".format(event_id),
+                  flush=True)
+            return None, final_results_folder
+        print("Rerun {} ...".format(final_results_folder), flush=True)
+    else:
+        mkdir(final_results_folder)
+    return event_id, final_results_folder
 
-        final_results_folder = "EVENT_RESULTS_{}".format(event_id)
 
-        # setup OSG checkpoint file
-        CHECKPOINT_FILENAME = "{}.tar.gz".format(final_results_folder)
+def get_resource_usage():
+    """This function returns a snapshot of the wall time, the CPU time of
+       the driver and its finished child processes, the peak memory of the
+       finished child processes, and the bytes written to storage by the
+       driver and its finished child processes
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {
+        'wall_time': time.time(),
+        'cpu_time_driver': usage_self.ru_utime + usage_self.ru_stime,
+        'cpu_time_children': (usage_children.ru_utime
+                              + usage_children.ru_stime),
+        'max_rss_children_MB': usage_children.ru_maxrss/1024.,
+        'write_bytes': 0,
+    }
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "write_bytes":
+                    usage['write_bytes'] = int(value)
+    except OSError:
+        pass
+    return usage
+
+
+def get_children_rss(pattern="run_afterburner"):
+    """This function returns the total resident memory (MB) of all the
+       processes started by the driver, read from /proc, the resident
+       memory of the process trees started by the driver with pattern in
+       their command line, and the number of these process trees
+    """
+    parent_ids = {}
+    rss_pages = {}
+    try:
+        pid_list = [int(pid_i) for pid_i in listdir("/proc")
+                    if pid_i.isdigit()]
+        page_size = os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0., 0., 0
+    for pid_i in pid_list:
         try:
-            tar = tarfile.open("{}".format(CHECKPOINT_FILENAME), 'r:gz')
-            tar.extractall()
-            tar.close()
-            # remove the tar file to save disk space
-            remove(CHECKPOINT_FILENAME)
-        except FileNotFoundError:
-            pass
+            with open("/proc/{}/stat".format(pid_i), "r") as f:
+                # the process name in brackets may contain spaces
+                parent_ids[pid_i] = int(f.read().rpartition(")")[2].split()[1])
+            with open("/proc/{}/statm".format(pid_i), "r") as f:
+                rss_pages[pid_i] = int(f.read().split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    children = {}
+    for pid_i, parent_id in parent_ids.items():
+        children.setdefault(parent_id, []).append(pid_i)
+
+    def get_tree_rss(pid_i):
+        rss_tree = 0
+        pending = [pid_i]
+        while pending:
+            pid_j = pending.pop()
+            rss_tree += rss_pages.get(pid_j, 0)
+            pending += children.get(pid_j, [])
+        return rss_tree
+
+    rss_total = 0
+    rss_matched = 0
+    n_matched = 0
+    for pid_i in children.get(os.getpid(), []):
+        rss_tree = get_tree_rss(pid_i)
+        rss_total += rss_tree
+        try:
+            with open("/proc/{}/cmdline".format(pid_i), "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode(
+                                                        errors="replace")
+        except OSError:
+            continue
+        if pattern in cmdline:
+            rss_matched += rss_tree
+            n_matched += 1
+    return (rss_total*page_size/1024.**2, rss_matched*page_size/1024.**2,
+            n_matched)
+
+
+def start_memory_monitor():
+    """This function starts a thread that samples the resident memory of
+       the child processes and keeps the peaks of the running stages. It is
+       only needed for afterburner_memory_limit_MB and memory_telemetry.
+    """
+    def monitor():
+        while True:
+            rss, afterburner_rss, n_afterburner = get_children_rss()
+            with memory_monitor['lock']:
+                memory_monitor['rss_MB'] = rss
+                memory_monitor['afterburner_MB'] = afterburner_rss
+                memory_monitor['n_afterburner'] = n_afterburner
+                for key_i, peak_i in memory_monitor['stages'].items():
+                    memory_monitor['stages'][key_i] = max(peak_i, rss)
+            time.sleep(memory_monitor_interval)
+
+    if memory_monitor['thread'] is None:
+        memory_monitor['thread'] = threading.Thread(target=monitor,
+                                                    daemon=True)
+        memory_monitor['thread'].start()
+
+
+def get_stage_telemetry(stage_name, n_threads, usage_start, usage_end):
+    """This function returns the telemetry record of one stage
+       The CPU time and bytes written are differences between the start
+       and the end of the stage, so they include the stages running at the
+       same time. The peak memory is the largest child process so far,
+       the peak resident memory of all the child processes during the
+       stage is added by run_stage_graph.
+    """
+    return {
+        'stage': stage_name,
+        'n_threads': n_threads,
+        'start': usage_start['wall_time'],
+        'end': usage_end['wall_time'],
+        'wall_time': usage_end['wall_time'] - usage_start['wall_time'],
+        'cpu_time_driver': (usage_end['cpu_time_driver']
+                            - usage_start['cpu_time_driver']),
+        'cpu_time_children': (usage_end['cpu_time_children']
+                              - usage_start['cpu_time_children']),
+        'max_rss_children_MB': usage_end['max_rss_children_MB'],
+        'write_bytes': usage_end['write_bytes'] - usage_start['write_bytes'],
+    }
+
+
+def save_event_telemetry(final_results_folder, event_id, telemetry):
+    """This function saves the stage telemetry of one event as a JSON
+       timeline telemetry_{event_id}.json and as attributes of the
+       spvn_results_{event_id} group in the event hdf5 file
+    """
+    if not telemetry:
+        return
+    event_telemetry = {
+        'event_id': event_id,
+        'hostname': socket.gethostname(),
+        'wall_time': (max(record['end'] for record in telemetry)
+                      - min(record['start'] for record in telemetry)),
+        'stages': sorted(telemetry, key=lambda record: record['start']),
+    }
+    with open(path.join(final_results_folder,
+                        "telemetry_{}.json".format(event_id)), "w") as f:
+        json.dump(event_telemetry, f, indent=1)
+
+    results_name = "spvn_results_{}".format(event_id)
+    h5_filename = path.join(final_results_folder, "{}.h5".format(results_name))
+    if not path.exists(h5_filename):
+        return
+    with h5py.File(h5_filename, "a") as hf:
+        if results_name not in hf:
+            return
+        gtemp = hf[results_name]
+        gtemp.attrs.create("telemetry", np.bytes_(json.dumps(event_telemetry)))
+        gtemp.attrs.create("telemetry_wall_time", event_telemetry['wall_time'])
+        for record in telemetry:
+            for key in ['wall_time', 'cpu_time_driver', 'cpu_time_children',
+                        'max_rss_children_MB', 'write_bytes', 'n_threads']:
+                gtemp.attrs.create("telemetry_{}_{}".format(record['stage'],
+                                                            key),
+                                   record[key])
+
+
+def get_output_fingerprint(output_path):
+    """This function returns the fingerprint of a stage output: [size,
+       mtime] for a file and [number of files, total size, latest mtime]
+       for a folder. It returns None if the output does not exist.
+    """
+    if path.isfile(output_path):
+        file_stat = stat(output_path)
+        return [file_stat.st_size, int(file_stat.st_mtime)]
+    if not path.isdir(output_path):
+        return None
+    n_files = 0
+    total_size = 0
+    latest_mtime = 0
+    for root, _, filenames in os.walk(output_path):
+        for filename in filenames:
+            file_stat = os.lstat(path.join(root, filename))
+            n_files += 1
+            total_size += file_stat.st_size
+            latest_mtime = max(latest_mtime, int(file_stat.st_mtime))
+    return [n_files, total_size, latest_mtime]
+
+
+def load_stage_manifest(manifest_filename):
+    """This function reads the append-only stage manifest of the job.
+       Every line is a JSON record of one finished stage, the latest
+       record of an (event, stage) pair wins. A line cut short by a crash
+       is ignored.
+       It returns the manifest as a dictionary.
+    """
+    stage_manifest = {'filename': manifest_filename, 'records': {},
+                      'lock': threading.Lock()}
+    if not path.exists(manifest_filename):
+        return stage_manifest
+    with open(manifest_filename, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            stage_manifest['records'][(record['event_id'],
+                                       record['stage'])] = record
+    return stage_manifest
+
+
+def append_stage_record(stage_manifest, event_id, stage, status,
+                        record=None):
+    """This function appends the record of a finished stage with its data
+       products and the fingerprints of its files to the stage manifest
+    """
+    if stage_manifest is None:
+        return
+    manifest_record = dict(record) if record is not None else {}
+    manifest_record.update({
+        'event_id': event_id,
+        'stage': stage['name'],
+        'status': status,
+        'inputs': stage['inputs'],
+        'products': stage['outputs'],
+        'outputs': {file_i: get_output_fingerprint(file_i)
+                    for file_i in stage.get('fingerprint',
+                                            stage.get('files', []))},
+    })
+    with stage_manifest['lock']:
+        with open(stage_manifest['filename'], "a") as f:
+            f.write(json.dumps(manifest_record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        stage_manifest['records'][(event_id, stage['name'])] = manifest_record
+
+
+def stage_is_finished(stage_manifest, event_id, stage_name):
+    """This function checks whether the stage manifest records the stage
+       as finished, all its outputs are unchanged since then, and none of
+       the stages writing its inputs has run again after it started
+    """
+    if stage_manifest is None:
+        return False
+    record = stage_manifest['records'].get((event_id, stage_name))
+    if record is None or record['status'] != "success":
+        return False
+    if not all(fingerprint is not None
+               and get_output_fingerprint(output_i) == fingerprint
+               for output_i, fingerprint in record['outputs'].items()):
+        return False
+
+    # look through the upstream stages without files, e.g. the hydro
+    # surface links, for the last stages that wrote files
+    event_records = [record_i for (event_i, _), record_i
+                     in stage_manifest['records'].items()
+                     if event_i == event_id]
+    pending_inputs = list(record.get('inputs', []))
+    visited_inputs = set()
+    while pending_inputs:
+        input_i = pending_inputs.pop()
+        if input_i in visited_inputs:
+            continue
+        visited_inputs.add(input_i)
+        for record_i in event_records:
+            if input_i not in record_i.get('products', []):
+                continue
+            if record_i['outputs'] == {}:
+                pending_inputs += record_i.get('inputs', [])
+            elif record_i.get('end', 0.) > record.get('start', 0.):
+                return False
+    return True
+
+
+def record_finished_event(stage_manifest, final_results_folder, event_id,
+                          status):
+    """This function records the event as finished in the stage manifest
+       once its results are collected into the hdf5 file
+    """
+    if status.get("hdf5") != "success":
+        return
+    event_stage = {
+        'name': "event",
+        'inputs': ["spvn_hdf5"],
+        'outputs': [],
+        'files': [path.join(final_results_folder,
+                            "spvn_results_{}.h5".format(event_id))],
+    }
+    append_stage_record(stage_manifest, event_id, event_stage, "success",
+                        {'start': time.time(), 'end': time.time()})
+    # the checkpoint of the event is not needed any more
+    checkpoint_file = "{}.tar.gz".format(final_results_folder)
+    if path.exists(checkpoint_file):
+        remove(checkpoint_file)
+
+
+def make_core_budget(n_cores):
+    """This function returns a core budget, which can be shared by the
+       stage graphs of several events running on the same node
+    """
+    return {'n_free': n_cores, 'n_running': 0,
+            'lock': threading.Condition(), 'listeners': []}
 
-        if path.exists(final_results_folder):
-            print("{} exists ...".format(final_results_folder), flush=True)
-            results_file = path.join(final_results_folder,
-                                     "spvn_results_{}.h5".format(event_id))
-            status = False
-            if path.exists(results_file):
-                status = True
+
+def release_cores(core_budget, n_cores, listener=None):
+    """This function returns n_cores cores to the budget and wakes up the
+       stage graphs (except listener) and the tasks waiting for cores
+    """
+    with core_budget['lock']:
+        core_budget['n_free'] += n_cores
+        for listener_i in core_budget['listeners']:
+            if listener_i is not listener:
+                listener_i.put((None, False, None, None))
+        core_budget['lock'].notify_all()
+
+
+def borrow_core(core_budget, stop_func):
+    """This function takes one core from the budget for a serial task
+       beyond the threads granted to its stage. It waits until a core is
+       released and returns False if stop_func() becomes True first.
+    """
+    with core_budget['lock']:
+        while core_budget['n_free'] < 1:
+            if stop_func():
+                return False
+            core_budget['lock'].wait(timeout=5)
+        core_budget['n_free'] -= 1
+        return True
+
+
+def run_stage_graph(stage_list, n_threads_budget, telemetry=None,
+                    stage_manifest=None, event_id=None, core_budget=None,
+                    serial=False):
+    """This function runs a list of simulation stages as a dependency graph
+
+       Every stage is a dictionary with the keys
+           name: name of the stage
+           func: function called with the number of granted threads,
+                 it returns True if the stage finishes successfully
+           inputs: list of the data products the stage needs
+           outputs: list of the data products the stage produces
+           n_threads: number of threads the stage needs
+           elastic: (optional) True if the stage can run with fewer threads
+           min_threads: (optional) the fewest threads an elastic stage
+                        starts with while other stages are running
+           error_flag: (optional) "initial" or "event", the job exit code
+                       to report if the stage does not succeed
+           files: (optional) list of the files and folders the stage
+                  writes, recorded in the stage manifest
+           fingerprint: (optional) the files of the stage that no later
+                        stage changes, recorded in the stage manifest
+                        instead of files
+       A stage starts as soon as all the stages producing its inputs have
+       finished successfully and its threads fit into n_threads_budget.
+       Inputs that are not produced by any stage in the list are assumed to
+       exist. A stage is skipped if one of its inputs can not be produced.
+       If telemetry is a list, the telemetry record of every finished stage
+       is appended to it.
+       If stage_manifest is given, every finished stage is recorded in it.
+       If core_budget is given, the threads are taken from this shared
+       budget instead of n_threads_budget, so the stages of several events
+       can run side by side without oversubscribing the node.
+       A stage with files that the manifest records as finished with
+       unchanged outputs is not run again. A stage without files is not
+       run again if all the stages that need it are finished. The outputs
+       of a stage with a stale record are left to the stage itself, e.g.
+       hydro reruns only if its run.log does not say "Finished.".
+       A stage that exits for the checkpoint (see checkPoint) stops the
+       graph from starting new stages, and the checkpoint is written once
+       the running stages have finished.
+       If serial is True, the stages run one at a time in the order of
+       stage_list, each with all its threads.
+       It returns a dictionary with the status of every stage
+       ("success", "failed", or "skipped").
+    """
+    producers = {}
+    for stage in stage_list:
+        for output_i in stage['outputs']:
+            producers[output_i] = stage['name']
+    dependencies = {}
+    for stage in stage_list:
+        dependencies[stage['name']] = [producers[input_i]
+                                       for input_i in stage['inputs']
+                                       if input_i in producers]
+    dependents = {stage['name']: [] for stage in stage_list}
+    for stage in stage_list:
+        for dep_i in dependencies[stage['name']]:
+            dependents[dep_i].append(stage)
+    status = {stage['name']: "waiting" for stage in stage_list}
+    stage_dict = {stage['name']: stage for stage in stage_list}
+    finished_stages = queue.Queue()
+    running_stages = {}
+    if core_budget is None:
+        core_budget = make_core_budget(n_threads_budget)
+    with core_budget['lock']:
+        core_budget['listeners'].append(finished_stages)
+
+    def is_finished_before(stage):
+        return (stage.get('files', []) != []
+                and stage_is_finished(stage_manifest, event_id,
+                                      stage['name']))
+
+    # a stage that exits for the checkpoint stops the graph from starting
+    # new stages, the checkpoint is written once the running stages finish
+    checkpoint_err = None
+
+    def run_stage(stage, n_threads):
+        usage_start = get_resource_usage()
+        memory_key = (event_id, stage['name'])
+        memory_flag = memory_monitor['thread'] is not None
+        if memory_flag:
+            with memory_monitor['lock']:
+                memory_monitor['stages'][memory_key] = (
+                    memory_monitor['rss_MB'])
+
+        def get_record():
+            record = get_stage_telemetry(stage['name'], n_threads,
+                                         usage_start, get_resource_usage())
+            if memory_flag:
+                with memory_monitor['lock']:
+                    record['peak_rss_MB'] = memory_monitor['stages'].pop(
+                                                                memory_key)
+            return record
+
+        try:
+            success = stage['func'](n_threads)
+            finished_stages.put((stage['name'], bool(success), None,
+                                 get_record()))
+        except SystemExit as err:
+            # the checkpoint exits after the stage has finished its work
+            finished_stages.put((stage['name'], err.code == 85, err,
+                                 get_record()))
+        except BaseException as err:
+            with memory_monitor['lock']:
+                memory_monitor['stages'].pop(memory_key, None)
+            finished_stages.put((stage['name'], False, err, None))
+
+    while True:
+        # skip the stages whose inputs can no longer be produced
+        changed = True
+        while changed:
+            changed = False
+            for stage in stage_list:
+                if status[stage['name']] != "waiting":
+                    continue
+                if any(status[dep_i] in ("failed", "skipped")
+                       for dep_i in dependencies[stage['name']]):
+                    status[stage['name']] = "skipped"
+                    changed = True
+                elif (all(status[dep_i] == "success"
+                          for dep_i in dependencies[stage['name']])
+                      and is_finished_before(stage)):
+                    print("\U0001F4CB  {} of {} finished before, ".format(
+                        stage['name'], event_id) + "skipped", flush=True)
+                    status[stage['name']] = "success"
+                    changed = True
+                elif (stage.get('files', []) == []
+                      and dependents[stage['name']] != []
+                      and all(status[dep_i] == "success"
+                              for dep_i in dependencies[stage['name']])
+                      and all(is_finished_before(stage_i)
+                              for stage_i in dependents[stage['name']])):
+                    # e.g. the initial condition of a finished hydro run
+                    print("\U0001F4CB  {} of {} is not needed, ".format(
+                        stage['name'], event_id) + "skipped", flush=True)
+                    status[stage['name']] = "success"
+                    changed = True
+
+        # start the ready stages, the ones with a fixed number of threads
+        # first and the elastic ones take the remaining threads
+        ready_stages = [
+            stage for stage in stage_list
+            if status[stage['name']] == "waiting"
+            and all(status[dep_i] == "success"
+                    for dep_i in dependencies[stage['name']])
+        ]
+        if checkpoint_err is not None:
+            ready_stages = []
+        if serial:
+            ready_stages = ready_stages[:1]
+            if running_stages:
+                ready_stages = []
+        ready_stages.sort(key=lambda stage: stage.get('elastic', False))
+        starting_stages = []
+        with core_budget['lock']:
+            for stage in ready_stages:
+                n_threads = stage['n_threads']
+                if stage.get('elastic', False):
+                    n_threads = min(n_threads, core_budget['n_free'])
+                    if n_threads < stage.get('min_threads', 1):
+                        if core_budget['n_running'] > 0:
+                            continue
+                        n_threads = max(n_threads, 1)
+                elif (n_threads > core_budget['n_free']
+                      and core_budget['n_running'] > 0):
+                    continue
+                core_budget['n_free'] -= n_threads
+                core_budget['n_running'] += 1
+                starting_stages.append((stage, n_threads))
+        for stage, n_threads in starting_stages:
+            status[stage['name']] = "running"
+            running_stages[stage['name']] = n_threads
+            threading.Thread(target=run_stage, args=(stage, n_threads),
+                             daemon=True).start()
+
+        if not running_stages and len(starting_stages) == len(ready_stages):
+            break
+        # wait for a stage of this event to finish, or for the stages of
+        # the other events to release their cores
+        stage_name, success, err, record = finished_stages.get()
+        if stage_name is None:
+            continue
+        with core_budget['lock']:
+            core_budget['n_running'] -= 1
+            release_cores(core_budget, running_stages.pop(stage_name),
+                          finished_stages)
+        status[stage_name] = "success" if success else "failed"
+        if record is not None:
+            record['status'] = status[stage_name]
+            if telemetry is not None:
+                telemetry.append(record)
+            append_stage_record(stage_manifest, event_id,
+                                stage_dict[stage_name], status[stage_name],
+                                record)
+        if isinstance(err, SystemExit) and hasattr(err, "checkpoint"):
+            checkpoint_err = err
+        elif err is not None:
+            with core_budget['lock']:
+                core_budget['listeners'].remove(finished_stages)
+            raise err
+    with core_budget['lock']:
+        core_budget['listeners'].remove(finished_stages)
+    if checkpoint_err is not None:
+        write_exit_checkpoint(checkpoint_err)
+    return status
+
+
+def collect_stage_errors(stage_list, status):
+    """This function returns the error flags (initial, event) for the
+       failed or skipped stages
+    """
+    initial_error = False
+    event_error = False
+    for stage in stage_list:
+        if status[stage['name']] == "success":
+            continue
+        if stage.get('error_flag') == "initial":
+            initial_error = True
+        elif stage.get('error_flag') == "event":
+            event_error = True
+    return initial_error, event_error
+
+
+def get_file_crc32(filename):
+    """This function returns the CRC32 checksum of a file"""
+    checksum = 0
+    with open(filename, "rb") as f:
+        while True:
+            data_chunk = f.read(16*1024*1024)
+            if not data_chunk:
+                break
+            checksum = zlib.crc32(data_chunk, checksum)
+    return checksum
+
+
+def stage_in_job_folder(job_folder, staging_path):
+    """This function mirrors the job folder in the node-local staging
+       folder. The sub-folders are created and the files are linked to the
+       job folder, so the simulations write their outputs to the staging
+       folder. The event results of a previous run are copied for the
+       restart.
+    """
+    for root, folders, filenames in os.walk(job_folder):
+        relative_root = path.relpath(root, job_folder)
+        staging_root = path.normpath(path.join(staging_path, relative_root))
+        for folder_i in list(folders):
+            if (relative_root == "." and folder_i.startswith("EVENT_RESULTS_")):
+                sync_results_folder(path.join(root, folder_i),
+                                    path.join(staging_root, folder_i))
+                folders.remove(folder_i)
+            elif path.islink(path.join(root, folder_i)):
+                os.symlink(path.realpath(path.join(root, folder_i)),
+                           path.join(staging_root, folder_i))
             else:
-                spvnfolder = path.join(final_results_folder,
-                                       "spvn_results_{}".format(event_id))
-                if path.exists(spvnfolder):
-                    status = check_an_event_is_good(spvnfolder)
-            if status:
-                print(
-                    "{} finished properly. No need to rerun.".format(event_id),
-                    flush=True)
+                mkdir(path.join(staging_root, folder_i))
+        for filename in filenames:
+            if relative_root == "." and filename == stage_manifest_name:
                 continue
-            print("Rerun {} ...".format(final_results_folder), flush=True)
-        else:
-            mkdir(final_results_folder)
+            os.symlink(path.realpath(path.join(root, filename)),
+                       path.join(staging_root, filename))
+
+
+def sync_results_folder(src_folder, dst_folder, n_retry=3):
+    """This function copies the results folder src_folder to dst_folder.
+       Files that are already in dst_folder with the same size and
+       modification time are skipped, so an interrupted transfer resumes
+       where it stopped. Every file is copied to a temporary name, verified
+       with its size and CRC32 checksum, and renamed. Files in dst_folder
+       that are not in src_folder are removed.
+       It returns True if all the files are copied and verified.
+    """
+    status = True
+    src_files = set()
+    for root, _, filenames in os.walk(src_folder):
+        dst_root = path.join(dst_folder, path.relpath(root, src_folder))
+        makedirs(dst_root, exist_ok=True)
+        for filename in filenames:
+            src_file = path.join(root, filename)
+            dst_file = path.join(dst_root, filename)
+            src_files.add(path.normpath(dst_file))
+            src_stat = stat(src_file)
+            if path.isfile(dst_file):
+                dst_stat = stat(dst_file)
+                if (dst_stat.st_size == src_stat.st_size
+                        and int(dst_stat.st_mtime) == int(src_stat.st_mtime)):
+                    continue
+            tmp_file = "{}.part".format(dst_file)
+            verified = False
+            for _ in range(n_retry):
+                shutil.copy2(src_file, tmp_file)
+                if (stat(tmp_file).st_size == src_stat.st_size
+                        and get_file_crc32(tmp_file)
+                        == get_file_crc32(src_file)):
+                    verified = True
+                    break
+            if verified:
+                replace(tmp_file, dst_file)
+            else:
+                print("\U000026D4  Can not copy {} to {}".format(
+                    src_file, dst_file), flush=True)
+                remove(tmp_file)
+                status = False
+    for root, _, filenames in os.walk(dst_folder):
+        for filename in filenames:
+            dst_file = path.normpath(path.join(root, filename))
+            if dst_file not in src_files:
+                remove(dst_file)
+    return status
+
+
+def stage_out_event(final_results_folder, para_dict_):
+    """This function copies the results of one event from the staging
+       folder back to the job folder. The results folder only keeps the
+       outputs selected by the save flags once the event finishes.
+       It returns False if the results could not be copied.
+    """
+    if 'job_folder' not in para_dict_ or not path.exists(final_results_folder):
+        return True
+    curr_time = time.asctime()
+    print("\U0001F69A  [{}] Copy {} to {} ...".format(
+        curr_time, final_results_folder, para_dict_['job_folder']),
+          flush=True)
+    if not sync_results_folder(final_results_folder,
+                               path.join(para_dict_['job_folder'],
+                                         final_results_folder)):
+        print("\U000026D4  The results of {} are incomplete ".format(
+            final_results_folder) + "in the job folder", flush=True)
+        return False
+    return True
+
+
+def build_hydro_stages(iev, event_id, final_results_folder, para_dict_,
+                       startTime, n_threads, prefetched=None):
+    """This function returns the initial condition, pre-equilibrium, and
+       hydro stages for one event. prefetched is the background fetch of
+       the initial condition from the database.
+    """
+    initial_condition = para_dict_['initial_condition']
+    initial_type = para_dict_['initial_type']
+    CHECKPOINT_FILENAME = "{}.tar.gz".format(final_results_folder)
+
+    def initial_condition_stage(n_threads_i):
+        curr_time = time.asctime()
         print("[{}] Generate initial condition ... ".format(curr_time),
               flush=True)
-
-        initStauts, ifile = get_initial_condition(initial_condition,
-                                                  initial_type, iev,
-                                                  idx0 + iev,
-                                                  para_dict_['seed_add'],
-                                                  final_results_folder,
-                                                  para_dict_['time_stamp_str'])
+        initStauts, ifile = get_initial_condition(
+            initial_condition, initial_type, iev,
+            para_dict_['hydro_id0'] + iev, para_dict_['seed_add'],
+            final_results_folder, para_dict_['time_stamp_str'], n_threads_i,
+            prefetched, para_dict_.get('glauber_pool', None))
         if not initStauts:
-            exitErrorTriggerInitial = True
-            continue
+            return False
 
         if initial_type == "3DMCGlauber_consttau":
             filename = ifile.split("/")[-1]
@@ -727,32 +2810,48 @@ def main(para_dict_):
                         "MUSIC/initial/initial_TA.dat")
             shutil.copy(path.join(filepath, re.sub("TA", "TB", filename)),
                         "MUSIC/initial/initial_TB.dat")
+        return True
+
+    def kompost_stage(n_threads_i):
+        kompost_success, _ = run_kompost(final_results_folder, event_id,
+                                         n_threads_i)
+        return kompost_success
 
+    def hydro_stage(n_threads_i):
         if initial_type == "IPGlasma+KoMPoST":
-            kompost_success, kompost_folder_name = run_kompost(
-                final_results_folder, event_id)
+            # link the KoMPoST results as the hydro initial condition
             hydro_initial_file = "MUSIC/initial/epsilon-u-Hydro.dat"
             if path.islink(hydro_initial_file):
                 remove(hydro_initial_file)
-            call("ln -s {0:s} {1:s}".format(
-                path.join(path.abspath(final_results_folder),
-                          kompost_folder_name,
-                          ("ekt_tIn01_tOut08"
-                           + ".music_init_flowNonLinear_pimunuTransverse.txt")),
-                hydro_initial_file),
+            kompost_file = path.join(
+                path.abspath(final_results_folder),
+                "kompost_results_{}".format(event_id),
+                "ekt_tIn01_tOut08.music_init_flowNonLinear_pimunuTransverse.txt")
+            call("ln -s {0:s} {1:s}".format(kompost_file, hydro_initial_file),
                  shell=True)
-
-        # first run hydro
+        evolution_fifo = ""
+        if (para_dict_['compute_photons']
+                and para_dict_.get('photon_streaming', False)
+                and not path.exists(path.join(
+                    final_results_folder,
+                    "hydro_results_{}".format(event_id)))):
+            # the photon emission takes a quarter of the cores
+            n_photon_threads = max(1, n_threads_i//4)
+            evolution_fifo = start_photon_stream(
+                final_results_folder, event_id, para_dict_["save_hydro"],
+                n_photon_threads)
+            n_threads_i = max(1, n_threads_i - n_photon_threads)
         hydro_success, hydro_folder_name = run_hydro_event(
-            final_results_folder, event_id)
+            final_results_folder, event_id, n_threads_i, evolution_fifo)
+        if evolution_fifo != "":
+            close_hydro_stream(final_results_folder, event_id)
 
         if not hydro_success:
             # if hydro didn't finish properly, just skip this event
             print("\U000026D4  {} did not finsh properly, skipped.".format(
                 hydro_folder_name),
                   flush=True)
-            exitErrorTrigger = True
-            continue
+            return False
 
         if (initial_type == "3DMCGlauber_dynamical"
                 and (initial_condition == "self" or "fixCentrality")):
@@ -762,58 +2861,455 @@ def main(para_dict_):
                                   "strings_{}.dat".format(event_id)))
 
         if para_dict_["check_point_flag"]:
-            checkPoint(startTime, CHECKPOINT_FILENAME, final_results_folder)
-
-        if para_dict_['compute_photons']:
-            # if hydro finishes properly, we continue to do photon radiation
+            checkPoint(startTime, CHECKPOINT_FILENAME, final_results_folder,
+                       para_dict_, "hydro")
+        return True
+
+    stage_list = [{
+        'name': "initial_condition",
+        'func': initial_condition_stage,
+        'inputs': [],
+        'outputs': ["initial_condition"],
+        'n_threads': n_threads,
+        'elastic': True,
+        'error_flag': "initial",
+    }]
+    hydro_inputs = ["initial_condition"]
+    if initial_type == "IPGlasma+KoMPoST":
+        stage_list.append({
+            'name': "kompost",
+            'func': kompost_stage,
+            'inputs': ["initial_condition"],
+            'outputs': ["kompost_results"],
+            'n_threads': n_threads,
+            'elastic': True,
+            'min_threads': max(1, n_threads//2),
+            'error_flag': "event",
+            'files': [path.join(final_results_folder,
+                                "kompost_results_{}".format(event_id))],
+        })
+        hydro_inputs = ["kompost_results"]
+    stage_list.append({
+        'name': "hydro",
+        'func': hydro_stage,
+        'inputs': hydro_inputs,
+        'outputs': ["hydro_results"],
+        'n_threads': n_threads,
+        'elastic': True,
+        'min_threads': max(1, n_threads//2),
+        'error_flag': "event",
+        'files': [path.join(final_results_folder,
+                            "hydro_results_{}".format(event_id))],
+        # the photon and hdf5 stages remove and move the files of the hydro
+        # results later, run.log stays
+        'fingerprint': [path.join(final_results_folder,
+                                  "hydro_results_{}".format(event_id),
+                                  "run.log")],
+    })
+    return stage_list
+
+
+def build_afterburner_stages(event_id, final_results_folder, para_dict_,
+                             startTime, n_threads):
+    """This function returns the stages after hydro for one event:
+       photon emission, spin polarization, hadronic afterburner,
+       spvn analysis, and collecting the results into hdf5.
+       Photon emission, spin polarization, and the hadronic afterburner
+       only depend on the hydro results and can run at the same time.
+    """
+    n_urqmd = para_dict_['n_urqmd']
+    hydro_folder_name = "hydro_results_{}".format(event_id)
+    CHECKPOINT_FILENAME = "{}.tar.gz".format(final_results_folder)
+    urqmd_file_path = path.join(final_results_folder,
+                                "particle_list_{}.bin".format(event_id))
+    compressed_list_files = []
+    if (para_dict_.get('particle_list_compression', 0) > 0
+            and para_dict_['save_urqmd']):
+        compressed_list_files = [
+            path.join(final_results_folder,
+                      "particle_list_{}.{}".format(event_id, suffix_i))
+            for suffix_i in ["gz", "idx"]]
+    shard_results = None
+    if para_dict_['spvn_sharded']:
+        if path.exists("run_analysis_spvn_shard.sh"):
+            shard_results = []
+        else:
+            print("\U000026A0  run_analysis_spvn_shard.sh is missing, "
+                  + "run the spvn analysis without shards", flush=True)
+
+    def photon_stage(n_threads_i):
+        evoFileName = path.join(final_results_folder, hydro_folder_name,
+                                "evolution_all_xyeta.dat")
+        photon_success = False
+        if event_id in photon_streams:
+            photon_success = finish_photon_stream(event_id)
+            if not photon_success:
+                print("\U000026A0  Photon emission with the hydro stream "
+                      + "failed", flush=True)
+                if not path.exists(evoFileName):
+                    return False
+                shutil.rmtree(path.join(final_results_folder,
+                                        "photon_results_{}".format(event_id)),
+                              ignore_errors=True)
+        if not photon_success:
             prepare_evolution_files_for_photon(final_results_folder,
                                                hydro_folder_name)
             photon_success, photon_folder_name = run_photon(
-                                final_results_folder, event_id)
-            if not photon_success:
-                exitErrorTrigger = True
-                continue
-            if not para_dict["save_hydro"]:
-                evoFileName = path.join(final_results_folder,
-                                        hydro_folder_name,
-                                        "evolution_all_xyeta.dat")
-                shutil.rmtree(evoFileName, ignore_errors=True)
-            if para_dict_["check_point_flag"]:
-                checkPoint(startTime, CHECKPOINT_FILENAME,
-                           final_results_folder)
+                                final_results_folder, event_id, n_threads_i)
+        if not photon_success:
+            return False
+        if not para_dict_["save_hydro"] and path.exists(evoFileName):
+            remove(evoFileName)
+        if para_dict_["check_point_flag"]:
+            checkPoint(startTime, CHECKPOINT_FILENAME, final_results_folder,
+                       para_dict_, "photon")
+        return True
 
+    def surface_stage(n_threads_i):
         nUrQMDFolder = n_urqmd
         if para_dict_["compute_polarization"]:
             nUrQMDFolder += 1
-        # if hydro finishes properly, we continue to do hadronic transport
-        status_success = prepare_surface_files_for_urqmd(final_results_folder,
-                                                         hydro_folder_name,
-                                                         nUrQMDFolder)
-        if not status_success:
-            exitErrorTrigger = True
-            continue
+        return prepare_surface_files_for_urqmd(
+            final_results_folder, hydro_folder_name, nUrQMDFolder,
+            para_dict_.get('surface_cache_path', ""))
 
-        # then run UrQMD events in parallel
-        urqmd_success, urqmd_file_path = run_urqmd_shell(
+    def spin_stage(n_threads_i):
+        return run_spin_polarization(n_urqmd, final_results_folder,
+                                     event_id, para_dict_, startTime,
+                                     CHECKPOINT_FILENAME)
+
+    def urqmd_stage(n_threads_i):
+        urqmd_success, urqmd_file = run_urqmd_shell(
             n_urqmd, final_results_folder, event_id, para_dict_,
-            startTime, CHECKPOINT_FILENAME)
+            shard_results, n_threads_i)
         if not urqmd_success:
             print("\U000026D4  {} did not finsh properly, skipped.".format(
-                urqmd_file_path),
+                urqmd_file),
                   flush=True)
-            continue
-
-        # finally collect results
-        run_spvn_analysis(urqmd_file_path, num_threads, final_results_folder,
-                          event_id)
-
+        return urqmd_success
+
+    def spvn_stage(n_threads_i):
+        run_spvn_analysis(urqmd_file_path, n_threads_i,
+                          final_results_folder, event_id, shard_results)
+        if (compressed_list_files != []
+                and path.exists(compressed_list_files[0])
+                and path.exists(urqmd_file_path)):
+            # the compressed particle list is kept instead
+            remove(urqmd_file_path)
+        return True
+
+    def hdf5_stage(n_threads_i):
         # zip results into a hdf5 database
         status = zip_results_into_hdf5(final_results_folder, event_id,
-                                       para_dict_)
+                                       para_dict_, n_threads_i)
 
         # remove the unwanted outputs if event is finished properly
         if status:
-            remove_unwanted_outputs(final_results_folder, event_id, para_dict_)
+            remove_unwanted_outputs(final_results_folder, event_id,
+                                    para_dict_)
+            archive_hydro_results(final_results_folder, event_id, para_dict_,
+                                  n_threads_i)
+        return status
+
+    stage_list = []
+    hdf5_inputs = ["spvn_results"]
+    if para_dict_['compute_photons']:
+        stage_list.append({
+            'name': "photon",
+            'func': photon_stage,
+            'inputs': ["hydro_results"],
+            'outputs': ["photon_results"],
+            # the streaming photon emission already runs with hydro
+            'n_threads': (1 if para_dict_.get('photon_streaming', False)
+                          else n_threads),
+            'elastic': True,
+            'error_flag': "event",
+            'files': [path.join(final_results_folder,
+                                "photon_results_{}".format(event_id))],
+        })
+        hdf5_inputs.append("photon_results")
+    stage_list.append({
+        'name': "hydro_surface",
+        'func': surface_stage,
+        'inputs': ["hydro_results"],
+        'outputs': ["hydro_surface"],
+        'n_threads': 1,
+        'error_flag': "event",
+    })
+    if para_dict_['compute_polarization']:
+        stage_list.append({
+            'name': "spin",
+            'func': spin_stage,
+            'inputs': ["hydro_surface"],
+            'outputs': ["spin_results"],
+            'n_threads': 1,
+            'files': [path.join(final_results_folder,
+                                "spin_results_{}".format(event_id))],
+        })
+        hdf5_inputs.append("spin_results")
+    stage_list += [{
+        'name': "urqmd",
+        'func': urqmd_stage,
+        'inputs': ["hydro_surface"],
+        'outputs': ["particle_list"],
+        'n_threads': n_urqmd,
+        # with a shared core budget, the samplers start with the free cores
+        # and borrow more when they are released
+        'elastic': para_dict_.get('core_budget', None) is not None,
+        # the sharded analysis needs the samples of the same run
+        'files': ([urqmd_file_path] if shard_results is None else [])
+                 + compressed_list_files,
+        # the spvn stage removes the particle list if it is compressed
+        'fingerprint': (compressed_list_files
+                        or ([urqmd_file_path] if shard_results is None
+                            else [])),
+    }, {
+        'name': "spvn",
+        'func': spvn_stage,
+        'inputs': ["particle_list"],
+        'outputs': ["spvn_results"],
+        'n_threads': 1,
+        'files': [path.join(final_results_folder,
+                            "spvn_results_{}".format(event_id))],
+    }, {
+        'name': "hdf5",
+        'func': hdf5_stage,
+        'inputs': hdf5_inputs,
+        'outputs': ["spvn_hdf5"],
+        'n_threads': n_threads,
+        'elastic': True,
+    }]
+    return stage_list
+
+
+def run_events_pipelined(para_dict_, startTime, hydro_threads,
+                         afterburner_threads, stage_manifest=None,
+                         prefetcher=None, core_budget=None):
+    """This function runs the hydro events in a two-stage pipeline.
+       A producer thread runs the initial condition and hydro stages for the
+       upcoming events while the main thread runs the stages after hydro
+       for the events whose hydro has finished. At most pipeline_depth
+       events can finish hydro ahead of the afterburner.
+       With a shared core_budget, both sides take their threads from the
+       same budget instead of fixed shares of the cores.
+       It returns the error flags (exitErrorTriggerInitial, exitErrorTrigger)
+    """
+    finished_hydro_events = queue.Queue(maxsize=para_dict_['pipeline_depth'])
+    error_flags = {'initial': False, 'event': False}
+    serial = not para_dict_.get('stage_graph', False)
+    record_telemetry = (para_dict_.get('stage_graph', False)
+                        or para_dict_.get('memory_telemetry', False))
+
+    def hydro_producer():
+        try:
+            for iev in range(para_dict_['n_hydro']):
+                event_id, final_results_folder = setup_event_folder(
+                                            iev, para_dict_, stage_manifest)
+                if event_id is None:
+                    discard_prefetched_initial_condition(prefetcher, iev)
+                    continue
+                prefetched = get_prefetched_initial_condition(
+                                                prefetcher, para_dict_, iev)
+                stage_list = build_hydro_stages(iev, event_id,
+                                                final_results_folder,
+                                                para_dict_, startTime,
+                                                hydro_threads, prefetched)
+                telemetry = [] if record_telemetry else None
+                status = run_stage_graph(stage_list, hydro_threads,
+                                         telemetry, stage_manifest, event_id,
+                                         core_budget, serial)
+                initial_error, event_error = collect_stage_errors(
+                                                        stage_list, status)
+                error_flags['initial'] |= initial_error
+                error_flags['event'] |= event_error
+                if status["hydro"] == "success":
+                    finished_hydro_events.put(
+                        (event_id, final_results_folder, telemetry))
+                else:
+                    save_event_telemetry(final_results_folder, event_id,
+                                         telemetry)
+                    stage_out_event(final_results_folder, para_dict_)
+        except BaseException as err:
+            finished_hydro_events.put(err)
+        finally:
+            finished_hydro_events.put(None)
+
+    producer = threading.Thread(target=hydro_producer, daemon=True)
+    producer.start()
+    while True:
+        event_i = finished_hydro_events.get()
+        if event_i is None:
+            break
+        if isinstance(event_i, BaseException):
+            raise event_i
+        event_id, final_results_folder, telemetry = event_i
+        curr_time = time.asctime()
+        print("\U0001F3CE  [{}] Running afterburner for {} ...".format(
+            curr_time, event_id),
+              flush=True)
+        stage_list = build_afterburner_stages(event_id, final_results_folder,
+                                              para_dict_, startTime,
+                                              afterburner_threads)
+        status = run_stage_graph(stage_list, afterburner_threads, telemetry,
+                                 stage_manifest, event_id, core_budget,
+                                 serial)
+        error_flags['event'] |= collect_stage_errors(stage_list, status)[1]
+        save_event_telemetry(final_results_folder, event_id, telemetry)
+        if stage_out_event(final_results_folder, para_dict_):
+            record_finished_event(stage_manifest, final_results_folder,
+                                  event_id, status)
+    producer.join()
+    return error_flags['initial'], error_flags['event']
+
+
+def main(para_dict_):
+    """This is the main function"""
+    startTime = time.time()
+    num_threads = para_dict_['num_threads']
+    n_urqmd = para_dict_['n_urqmd']
+    n_cores = para_dict_.get('n_cores', 0)
+    if n_cores <= 0:
+        n_cores = num_threads
+    curr_time = time.asctime()
+    print("\U0001F3CE  [{}] Number of threads: {}".format(
+        curr_time, num_threads),
+          flush=True)
+
+    nev = para_dict_['n_hydro']
+    staging_folder = para_dict_.get('staging_folder', "")
+    if staging_folder != "" and para_dict_["check_point_flag"]:
+        # OSG jobs already run in node-local scratch
+        print("\U000026A0  Staging mode is disabled with checkpointing",
+              flush=True)
+    elif staging_folder != "":
+        job_folder = os.getcwd()
+        staging_path = tempfile.mkdtemp(prefix="iEBE-MUSIC_",
+                                        dir=path.expandvars(staging_folder))
+        print("\U0001F69A  [{}] Staging the job folder in {} ...".format(
+            curr_time, staging_path),
+              flush=True)
+        stage_in_job_folder(job_folder, staging_path)
+        atexit.register(shutil.rmtree, staging_path, True)
+        os.chdir(staging_path)
+        para_dict_['job_folder'] = job_folder
+    if para_dict_.get('surface_cache_folder', "") != "":
+        cache_path = tempfile.mkdtemp(
+            prefix="iEBE-MUSIC_surface_",
+            dir=path.expandvars(para_dict_['surface_cache_folder']))
+        atexit.register(shutil.rmtree, cache_path, True)
+        para_dict_['surface_cache_path'] = cache_path
+    if (para_dict_['compute_photons']
+            and para_dict_.get('photon_streaming', False)
+            and not photon_streaming_is_supported()):
+        print("\U000026A0  run_hydro.sh can not stream the evolution, "
+              + "regenerate the job folder for the photon streaming",
+              flush=True)
+        para_dict_['photon_streaming'] = False
+    stage_manifest = None
+    if para_dict_.get('stage_graph', False):
+        stage_manifest = load_stage_manifest(
+            path.join(para_dict_.get('job_folder', ""), stage_manifest_name))
+    record_telemetry = (para_dict_.get('stage_graph', False)
+                        or para_dict_.get('memory_telemetry', False))
+    if (para_dict_.get('afterburner_memory_limit_MB', 0) > 0
+            or para_dict_.get('memory_telemetry', False)):
+        start_memory_monitor()
+    if (para_dict_['initial_type'] in ("3DMCGlauber_dynamical",
+                                       "3DMCGlauber_participants")
+            and para_dict_.get('glauber_pool_folder', "") != ""):
+        # draw the 3D MC-Glauber events from a pool generated in batches
+        pool_folder = para_dict_['glauber_pool_folder']
+        para_dict_['glauber_pool'] = {
+            'folder': path.abspath(path.expandvars(pool_folder)),
+            'size': para_dict_.get('glauber_pool_size', 0),
+            'event_ids': [para_dict_['hydro_id0'] + iev
+                          for iev in range(nev)],
+        }
+    n_producer_threads = 0
+    if (para_dict_['initial_condition'] == "self" and nev > 1
+            and "IPGlasma" in para_dict_['initial_type']):
+        n_producer_threads = para_dict_.get('ipglasma_producer_threads', 0)
+    prefetcher = None
+    if (para_dict_.get('prefetch_initial_condition', False)
+            or n_producer_threads > 0):
+        # fetch the next initial condition from the database, or run
+        # IPGlasma for the next events, while the current event runs
+        prefetcher = {'executor': ThreadPoolExecutor(max_workers=1),
+                      'futures': {}, 'stage_manifest': stage_manifest}
+    if n_producer_threads > 0:
+        # the IPGlasma producer keeps its share of cores for the whole job
+        print("\U0001F3CE  [{}] IPGlasma runs ahead on {} ".format(
+            curr_time, n_producer_threads)
+              + "threads, {} events deep".format(
+                  para_dict_.get('ipglasma_queue_depth', 1)),
+              flush=True)
+        n_cores = max(1, n_cores - n_producer_threads)
+    pipeline_depth = para_dict_.get('pipeline_depth', 0)
+    if pipeline_depth > 0 and para_dict_["check_point_flag"]:
+        # a checkpoint only archives the folder of the current event
+        print("\U000026A0  Pipelined mode is disabled with checkpointing",
+              flush=True)
+        pipeline_depth = 0
+    if pipeline_depth > 0 and nev > 1:
+        # hydro shares the cores with the afterburner of the previous event
+        hydro_threads = max(1, n_cores - n_urqmd)
+        afterburner_threads = max(1, n_cores - hydro_threads)
+        core_budget = None
+        if para_dict_.get('core_packing', False):
+            # hydro takes the cores left by the serial stages of the
+            # previous event and the afterburner backfills the rest
+            hydro_threads = n_cores
+            afterburner_threads = n_cores
+            core_budget = make_core_budget(n_cores)
+            para_dict_['core_budget'] = core_budget
+            print("\U0001F3CE  [{}] Pipelined mode: depth = {}, ".format(
+                curr_time, pipeline_depth)
+                  + "{} cores shared by hydro and afterburner".format(
+                      n_cores),
+                  flush=True)
+        else:
+            print("\U0001F3CE  [{}] Pipelined mode: depth = {}, ".format(
+                curr_time, pipeline_depth)
+                  + "{} cores, {} threads for hydro".format(n_cores,
+                                                            hydro_threads),
+                  flush=True)
+        para_dict_['pipeline_depth'] = pipeline_depth
+        exitErrorTriggerInitial, exitErrorTrigger = run_events_pipelined(
+            para_dict_, startTime, hydro_threads, afterburner_threads,
+            stage_manifest, prefetcher, core_budget)
+    else:
+        exitErrorTrigger = False
+        exitErrorTriggerInitial = False
+        for iev in range(nev):
+            event_id, final_results_folder = setup_event_folder(
+                                            iev, para_dict_, stage_manifest)
+            if event_id is None:
+                discard_prefetched_initial_condition(prefetcher, iev)
+                continue
+
+            prefetched = get_prefetched_initial_condition(prefetcher,
+                                                          para_dict_, iev)
+            stage_list = (
+                build_hydro_stages(iev, event_id, final_results_folder,
+                                   para_dict_, startTime, n_cores, prefetched)
+                + build_afterburner_stages(event_id, final_results_folder,
+                                           para_dict_, startTime, n_cores))
+            telemetry = [] if record_telemetry else None
+            status = run_stage_graph(stage_list, n_cores, telemetry,
+                                     stage_manifest, event_id,
+                                     serial=not para_dict_.get('stage_graph',
+                                                               False))
+            save_event_telemetry(final_results_folder, event_id, telemetry)
+            if stage_out_event(final_results_folder, para_dict_):
+                record_finished_event(stage_manifest, final_results_folder,
+                                      event_id, status)
+            initial_error, event_error = collect_stage_errors(stage_list,
+                                                              status)
+            exitErrorTriggerInitial |= initial_error
+            exitErrorTrigger |= event_error
+
+    if prefetcher is not None:
+        prefetcher['executor'].shutdown()
 
     if exitErrorTriggerInitial:
         sys.exit(71)
@@ -874,5 +3370,6 @@ if __name__ == "__main__":
         'check_point_flag': CHECK_POINT,
         'afterburner_type': AFTERBURNER_TYPE,
     }
+    para_dict.update(parse_driver_options(sys.argv[17:]))
 
     main(para_dict)
@@ -14,12 +14,79 @@ control_dict = {
     'initial_state_type': "3DMCGlauber_dynamical",  # options: IPGlasma, IPGlasma+KoMPoST,
                                                     #          3DMCGlauber_dynamical, 3DMCGlauber_consttau
     'afterburner_type': "UrQMD",                    # options: UrQMD, decay
+    'afterburner_fifo': False,      # connect iSS, osc2u, UrQMD, and the binary
+                                    # conversion with named pipes (UrQMD)
     'save_ipglasma_results': False,   # flag to save IPGlasma results
     'save_kompost_results': False,    # flag to save kompost results
     'save_hydro_surfaces': False,     # flag to save hydro surfaces
     'save_UrQMD_files': False,        # flag to save UrQMD files
     'compute_photon_emission': False,   # flag to compute EM radiation from hydrodynamic medium
     'compute_polarization': False,       # flag to save spin polarization results
+
+    # options for hydro_plus_UrQMD_driver.py
+    'pipeline_depth': 0,    # number of hydro events allowed to finish ahead of
+                            # the hadronic afterburner (0: run events serially)
+    'n_cores': 0,           # total number of cores for each job (0: n_threads)
+    'core_packing': False,  # share the cores between the hydro and the
+                            # afterburner stages of the pipelined events
+    'stage_graph': False,   # run the photon, spin, and afterburner stages of
+                            # an event at the same time, with a stage
+                            # manifest and telemetry for every job
+                            # (False: one stage at a time)
+    'afterburner_n_samples': 0,     # number of hadronic afterburner samples
+                                    # per hydro event (0: 10*n_urqmd_per_hydro)
+    'afterburner_n_particles': 0,   # stop sampling once this many hadrons
+                                    # are collected, with afterburner_n_samples
+                                    # as the maximum (0: off)
+    'afterburner_min_samples': 0,   # minimum number of afterburner samples
+    'afterburner_v2_error': 0.,     # stop sampling once the statistical error
+                                    # of charged hadron v2{2} reaches this
+                                    # value (0: off)
+    'afterburner_mult_error': 0.,   # stop sampling once the relative error of
+                                    # <N_ch> reaches this value (0: off)
+    'spvn_sharded': False,  # run the spvn analysis on every afterburner sample
+                            # as soon as it finishes and merge the results
+    'hdf5_storage_profile': "legacy",   # compression settings for the hdf5
+                                        # results: legacy, balanced, fast,
+                                        # compact (utilities/hdf5_storage_profiles.py)
+    'hdf5_layout': "files",     # files: one dataset per result file
+                                # columnar: stack same-shaped particle tables
+                                # (utilities/hdf5_columnar_layout.py)
+    'checkpoint_time': 12.,     # hours after which a job with checkpoints
+                                # archives its results and exits (OSG)
+    'checkpoint_walltime': 0.,  # job walltime in hours, if > 0 checkpoint
+                                # checkpoint_margin hours before it ends
+    'checkpoint_margin': 1.,    # hours reserved to write the checkpoint
+    'checkpoint_codec': "gz",   # checkpoint compression: gz (level 1), none
+    'prefetch_initial_condition': False,    # fetch the next initial condition
+                                            # from the database while the
+                                            # current event runs
+    'staging_folder': "",   # run the simulations in a node-local folder,
+                            # e.g. $TMPDIR or /dev/shm, and copy the results
+                            # back to the job folder ("": off)
+    'surface_cache_folder': "",     # node-local folder, e.g. /dev/shm, for
+                                    # one shared copy of the hydro surface
+                                    # per event for all samplers ("": off)
+    'ipglasma_producer_threads': 0,     # threads of the IPGlasma runs
+                                        # ahead of hydro with
+                                        # database = self (0: off)
+    'ipglasma_queue_depth': 1,  # number of IPGlasma events generated ahead
+    'afterburner_memory_limit_MB': 0,   # start new afterburner samples
+                                        # only below this memory (0: off)
+    'memory_telemetry': False,  # record the peak memory of every stage
+    'hydro_archive_level': 0,   # zlib level of the float32 archives of the
+                                # saved hydro results (0: keep the files)
+    'particle_list_compression': 0,     # gzip level of the frame-indexed
+                                        # saved particle lists (0: off)
+    'photon_streaming': False,  # run the photon emission at the same time
+                                # as hydro, reading the evolution through
+                                # a named pipe
+    'glauber_pool_folder': "",  # folder of the pre-generated 3D
+                                # MC-Glauber events ("": off, one 3dMCGlb
+                                # run per event)
+    'glauber_pool_size': 0,     # number of 3D MC-Glauber events generated
+                                # per centrality bin in one run
+                                # (0: only the events of the job)
 }
 
 
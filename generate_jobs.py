@@ -3,12 +3,15 @@
 
 import sys
 import re
-from os import path, mkdir, remove
+from os import (path, mkdir, remove, link, symlink, walk, chmod, lstat,
+                listdir)
 import shutil
 import subprocess
 import argparse
+import time
 from math import ceil
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # I think that if you run min bias, this is not used
 # If you want to use this, I think it probably just weights, and you still calc. centrality later; however, for safety I won't use it
@@ -34,6 +37,31 @@ support_cluster_list = [
     'stampede2', "anvil", 'ucthpc'
 ]
 
+# control_dict options forwarded to hydro_plus_UrQMD_driver.py as key=value
+driver_option_list = [
+    'pipeline_depth', 'n_cores', 'core_packing', 'stage_graph',
+    'afterburner_n_samples', 'afterburner_n_particles',
+    'afterburner_min_samples', 'afterburner_v2_error',
+    'afterburner_mult_error', 'spvn_sharded', 'hdf5_storage_profile',
+    'hdf5_layout', 'checkpoint_time', 'checkpoint_walltime',
+    'checkpoint_margin', 'checkpoint_codec', 'prefetch_initial_condition',
+    'staging_folder', 'surface_cache_folder',
+    'ipglasma_producer_threads', 'ipglasma_queue_depth',
+    'afterburner_memory_limit_MB', 'memory_telemetry', 'hydro_archive_level',
+    'particle_list_compression', 'photon_streaming',
+    'glauber_pool_folder', 'glauber_pool_size',
+]
+
+# the files and folders of the code template that the codes may rewrite,
+# every job gets its own copies instead of hard links, only the executables
+# in these folders stay hard links
+template_copy_list = [
+    'MUSIC/music_input_mode_2',
+    'photonEmission_hydroInterface/parameters.dat',
+    'hadronic_afterburner_toolkit/parameters.dat',
+    'osc2u', 'urqmd',
+]
+
 
 def write_script_header(cluster, script, n_threads, event_id, walltime,
                         working_folder):
@@ -254,12 +282,19 @@ def generate_full_job_script(cluster_name, folder_name, database, initial_type,
     else:
         enableCheckPoint = False
 
+    driver_options = ""
+    for option_i in driver_option_list:
+        if option_i in para_dict.control_dict:
+            driver_options += " {}={}".format(option_i,
+                                              para_dict.control_dict[option_i])
+
     script = open(path.join(working_folder, "submit_job.script"), "w")
-    write_script_header(cluster_name, script, n_threads, event_id, walltime,
+    n_cores = max(n_threads, para_dict.control_dict.get('n_cores', 0))
+    write_script_header(cluster_name, script, n_cores, event_id, walltime,
                         working_folder)
     script.write("\nseed_add=${1:-0}\n")
     script.write("""
-python3 hydro_plus_UrQMD_driver.py {0:s} {1:s} {2:d} {3:d} {4:d} {5:d} {6} {7} {8} {9} $seed_add {10:s} {11} {12} {13} {14:s}
+python3 hydro_plus_UrQMD_driver.py {0:s} {1:s} {2:d} {3:d} {4:d} {5:d} {6} {7} {8} {9} $seed_add {10:s} {11} {12} {13} {14:s}{15:s}
 """.format(initial_type, database, n_hydro, ev0_id, n_urqmd, n_threads,
            para_dict.control_dict["save_ipglasma_results"],
            para_dict.control_dict["save_kompost_results"],
@@ -268,7 +303,7 @@ python3 hydro_plus_UrQMD_driver.py {0:s} {1:s} {2:d} {3:d} {4:d} {5:d} {6} {7} {
            time_stamp,
            para_dict.control_dict["compute_polarization"],
            para_dict.control_dict["compute_photon_emission"],
-           enableCheckPoint, afterburner_type))
+           enableCheckPoint, afterburner_type, driver_options))
     script.write("""
 
 status=$?
@@ -299,8 +334,9 @@ rm -fr $results_folder/*
 """.format(results_folder))
 
     if nthreads > 0:
+        # the driver can overwrite the number of threads with the 2nd argument
         script.write("""
-export OMP_NUM_THREADS={0:d}
+export OMP_NUM_THREADS=${{2:-{0:d}}}
 """.format(nthreads))
 
     if cluster_name != "osg":
@@ -348,8 +384,9 @@ rm -fr $results_folder/*
 """.format(hydro_results_folder))
 
     if nthreads > 0:
+        # the driver can overwrite the number of threads with the 1st argument
         script.write("""
-export OMP_NUM_THREADS={0:d}
+export OMP_NUM_THREADS=${{1:-{0:d}}}
 """.format(nthreads))
 
     if cluster_name != "osg":
@@ -386,17 +423,25 @@ cd MUSIC
 rm -fr *.dat
 rm -fr $results_folder
 
+if [ -n "$EVOLUTION_FIFO" ]; then
+    # the driver streams the evolution history to the photon emission
+    ln -s $EVOLUTION_FIFO evolution_all_xyeta.dat
+fi
 """.format(hydro_results_folder))
 
     if nthreads > 0:
+        # the driver can overwrite the number of threads with the 1st argument
         script.write("""
-export OMP_NUM_THREADS={0:d}
+export OMP_NUM_THREADS=${{1:-{0:d}}}
 """.format(nthreads))
 
     if cluster_name != "osg":
         script.write("""
 # hydro evolution
 ./MUSIChydro music_input_mode_2 1> run.log 2> run.err
+if [ -n "$EVOLUTION_FIFO" ]; then
+    rm -f evolution_all_xyeta.dat
+fi
 ./sweeper.sh $results_folder
 )
 """)
@@ -404,6 +449,9 @@ export OMP_NUM_THREADS={0:d}
         script.write("""
 # hydro evolution
 ./MUSIChydro music_input_mode_2 | tee run.log
+if [ -n "$EVOLUTION_FIFO" ]; then
+    rm -f evolution_all_xyeta.dat
+fi
 ./sweeper.sh $results_folder
 )
 """)
@@ -422,8 +470,9 @@ cd photonEmission_hydroInterface
 
 """)
     if nthreads > 0:
+        # the driver can overwrite the number of threads with the 1st argument
         script.write("""
-export OMP_NUM_THREADS={0:d}
+export OMP_NUM_THREADS=${{1:-{0:d}}}
 """.format(nthreads))
 
     if cluster_name != "osg":
@@ -480,8 +529,17 @@ rm -fr ../hydro_event
 
 
 def generate_script_afterburner(folder_name, cluster_name, HBT_flag,
-                                afterburner_type):
-    """This function generates script for hadronic afterburner"""
+                                afterburner_type, fifo_flag=False):
+    """This function generates script for hadronic afterburner
+
+       run_afterburner.sh SubEventId SampleId runs one particlization +
+       hadronic afterburner sample in the folder UrQMDev_{SubEventId} and
+       stores its particle list in
+       UrQMDev_{SubEventId}/UrQMD_results/particle_list_{SampleId}.bin
+       With fifo_flag, iSS, osc2u, UrQMD, and the binary conversion run at
+       the same time connected by named pipes. The sample reruns with
+       intermediate files if the pipes do not work.
+    """
     working_folder = folder_name
 
     logfile = ""
@@ -494,86 +552,194 @@ def generate_script_afterburner(folder_name, cluster_name, HBT_flag,
 unalias ls 2>/dev/null
 
 SubEventId=$1
+SampleId=$2
 
 (
 cd UrQMDev_$SubEventId
 
 mkdir -p UrQMD_results
-rm -fr UrQMD_results/*
 
 surfaceFile=`ls hydro_event | grep "surface"`
-for iev in {0..9}
-do
-    cd iSS
-    RANDOMSEED=`cat iSS_parameters.dat | grep "randomSeed" | cut -f 3 -d " "`
-    if [ $RANDOMSEED != "-1" ]; then
-        RANDOMSEED=$((RANDOMSEED + iev))
-    fi
-    mkdir -p results
-    rm -fr results/*
-    ln -s ../../hydro_event/${surfaceFile} results/surface.dat
-    cp ../hydro_event/music_input results/music_input
-    cp ../hydro_event/spectators.dat results/spectators.dat
-    if [ $SubEventId = "0" ] && [ $iev -eq "0" ]; then
-    """)
+cd iSS
+RANDOMSEED=`cat iSS_parameters.dat | grep "randomSeed" | cut -f 3 -d " "`
+if [ $RANDOMSEED != "-1" ]; then
+    RANDOMSEED=$((RANDOMSEED + SampleId))
+fi
+mkdir -p results
+rm -fr results/*
+ln -s ../../hydro_event/${surfaceFile} results/surface.dat
+cp ../hydro_event/music_input results/music_input
+cp ../hydro_event/spectators.dat results/spectators.dat
+""")
+    if afterburner_type == "UrQMD" and fifo_flag:
+        write_afterburner_fifo_chain(script, logfile)
+        script.close()
+        if HBT_flag:
+            generate_script_afterburner_HBT(folder_name, cluster_name)
+        return
+
+    script.write('if [ $SampleId -eq "0" ]; then\n')
     script.write("    ./iSS.e randomSeed=$RANDOMSEED {0}".format(logfile))
     script.write("""
-    else
-        ./iSS.e randomSeed=$RANDOMSEED > run.log
-    fi
-    """)
+else
+    ./iSS.e randomSeed=$RANDOMSEED > run.log
+fi
+""")
 
     if afterburner_type == "UrQMD":
         script.write("""
+cd ../osc2u
+./osc2u.e < ../iSS/OSCAR.DAT > run.log
+mv fort.14 ../urqmd/OSCAR.input
+rm -fr ../iSS/OSCAR.DAT
+cd ../urqmd
+./runqmd.sh > run.log
+mv particle_list.dat ../UrQMD_results/particle_list_${SampleId}.dat
+rm -fr OSCAR.input
+cd ..
+../hadronic_afterburner_toolkit/convert_to_binary.e UrQMD_results/particle_list_${SampleId}.dat binary
+rm -fr UrQMD_results/particle_list_${SampleId}.dat
+)
+""")
+    elif afterburner_type == "decay":
+        script.write("""
+mv particle_samples.bin ../UrQMD_results/particle_list_${SampleId}.bin
+)
+""")
+    script.close()
+
+    if HBT_flag:
+        generate_script_afterburner_HBT(folder_name, cluster_name)
+
+
+def write_afterburner_fifo_chain(script, logfile):
+    """This function writes the particlization + UrQMD chain connected by
+       named pipes. OSCAR.DAT, fort.14, and the text particle list are
+       FIFOs, so the four programs overlap in time and the intermediate
+       files never hit the disk. A program that replaces its pipe by a
+       regular file, e.g. to seek in it, or a failure anywhere in the chain
+       makes the sample rerun with the intermediate files.
+    """
+    script.write("""cd ..
+
+run_iSS () {
+    if [ $SampleId -eq "0" ]; then
+""")
+    script.write("        ./iSS.e randomSeed=$RANDOMSEED {0}\n".format(logfile))
+    script.write("""    else
+        ./iSS.e randomSeed=$RANDOMSEED > run.log
+    fi
+}
+
+unblock_fifo () {
+    # open and close the pipe $1 at both ends, so the program on its other
+    # end does not wait forever after its partner exits
+    if [ -p $1 ]; then
+        exec 3<>$1
+        exec 3>&-
+    fi
+}
+
+run_afterburner_fifo () {
+    ParticleList=UrQMD_results/particle_list_${SampleId}
+    rm -fr iSS/OSCAR.DAT osc2u/fort.14 urqmd/OSCAR.input \\
+           urqmd/particle_list.dat ${ParticleList}.dat ${ParticleList}.bin
+    mkfifo iSS/OSCAR.DAT urqmd/OSCAR.input ${ParticleList}.dat || return 1
+    ln -s ../urqmd/OSCAR.input osc2u/fort.14
+    ln -s ../${ParticleList}.dat urqmd/particle_list.dat
+    (cd iSS; run_iSS; status=$?; unblock_fifo OSCAR.DAT; exit $status) &
+    pid_iSS=$!
+    (cd osc2u; ./osc2u.e < ../iSS/OSCAR.DAT > run.log; status=$?;
+     unblock_fifo ../iSS/OSCAR.DAT; unblock_fifo ../urqmd/OSCAR.input;
+     exit $status) &
+    pid_osc2u=$!
+    (cd urqmd; ./runqmd.sh > run.log; status=$?;
+     unblock_fifo OSCAR.input; unblock_fifo ../${ParticleList}.dat;
+     exit $status) &
+    pid_urqmd=$!
+    ../hadronic_afterburner_toolkit/convert_to_binary.e ${ParticleList}.dat binary
+    status=$?
+    unblock_fifo ${ParticleList}.dat
+    wait $pid_iSS || status=1
+    wait $pid_osc2u || status=1
+    wait $pid_urqmd || status=1
+    if [ ! -L osc2u/fort.14 ] || [ ! -L urqmd/particle_list.dat ] \\
+            || [ ! -s ${ParticleList}.bin ]; then
+        status=1
+    fi
+    rm -fr iSS/OSCAR.DAT osc2u/fort.14 urqmd/OSCAR.input \\
+           urqmd/particle_list.dat ${ParticleList}.dat
+    return $status
+}
+
+if ! run_afterburner_fifo; then
+    echo "The named pipes failed, rerun sample ${SampleId} with files"
+    rm -fr UrQMD_results/particle_list_${SampleId}.bin
+    cd iSS
+    run_iSS
     cd ../osc2u
     ./osc2u.e < ../iSS/OSCAR.DAT > run.log
     mv fort.14 ../urqmd/OSCAR.input
     rm -fr ../iSS/OSCAR.DAT
     cd ../urqmd
     ./runqmd.sh > run.log
-    mv particle_list.dat ../UrQMD_results/particle_list_${iev}.dat
+    mv particle_list.dat ../UrQMD_results/particle_list_${SampleId}.dat
     rm -fr OSCAR.input
     cd ..
-    ../hadronic_afterburner_toolkit/convert_to_binary.e UrQMD_results/particle_list_${iev}.dat binary
-    rm -fr UrQMD_results/particle_list_${iev}.dat
-    cat UrQMD_results/particle_list_${iev}.bin >> UrQMD_results/particle_list.bin
-    rm -fr UrQMD_results/particle_list_${iev}.bin
-done
-""")
-    elif afterburner_type == "decay":
-        script.write("""
-    cat particle_samples.bin >> ../UrQMD_results/particle_list.bin
-    rm -fr particle_samples.bin
-    cd ..
-done
-        """)
-    if HBT_flag:
-        script.write("""
-    cd hadronic_afterburner_toolkit
-    mkdir -p results
-    cd results; rm -fr *
-    ln -s ../../UrQMD_results/particle_list.bin particle_list.bin
-    cd ..
-""")
-        script.write('    if [ $SubEventId = "0" ]; then\n')
-        script.write(
-            "        ./hadronic_afterburner_tools.e analyze_flow=0 analyze_HBT=1 particle_monval=211 distinguish_isospin=1 event_buffer_size=500000 {0}\n"
-            .format(logfile))
-        script.write("    else\n")
-        script.write(
-            "        ./hadronic_afterburner_tools.e analyze_flow=0 analyze_HBT=1 particle_monval=211 distinguish_isospin=1 event_buffer_size=500000 >> run.log\n"
-        )
-        script.write("    fi\n")
-        script.write("    mv results/HBT* ../UrQMD_results/ \n")
-    script.write("""
-    rm -fr hydro_event
+    ../hadronic_afterburner_toolkit/convert_to_binary.e UrQMD_results/particle_list_${SampleId}.dat binary
+    rm -fr UrQMD_results/particle_list_${SampleId}.dat
+fi
 )
 """)
+
+
+def generate_script_afterburner_HBT(folder_name, cluster_name):
+    """This function generates script for the HBT analysis of all the
+       hadronic afterburner samples in one UrQMDev folder
+    """
+    working_folder = folder_name
+
+    logfile = ""
+    if cluster_name != "osg":
+        logfile = " >> run.log"
+
+    script = open(path.join(working_folder, "run_afterburner_HBT.sh"), "w")
+    script.write("""#!/bin/bash
+
+SubEventId=$1
+
+(
+cd UrQMDev_$SubEventId/hadronic_afterburner_toolkit
+mkdir -p results
+cd results; rm -fr *
+cat ../../UrQMD_results/particle_list_*.bin > particle_list.bin
+cd ..
+""")
+    script.write('if [ $SubEventId = "0" ]; then\n')
+    script.write(
+        "    ./hadronic_afterburner_tools.e analyze_flow=0 analyze_HBT=1 particle_monval=211 distinguish_isospin=1 event_buffer_size=500000 {0}\n"
+        .format(logfile))
+    script.write("else\n")
+    script.write(
+        "    ./hadronic_afterburner_tools.e analyze_flow=0 analyze_HBT=1 particle_monval=211 distinguish_isospin=1 event_buffer_size=500000 >> run.log\n"
+    )
+    script.write("fi\n")
+    script.write("rm -fr results/particle_list.bin\n")
+    script.write("mv results/HBT* ../UrQMD_results/\n")
+    script.write(")\n")
     script.close()
 
 
 def generate_script_analyze_spvn(folder_name, cluster_name, HBT_flag):
-    """This function generates script for analysis"""
+    """This function generates script for analysis
+
+       run_analysis_spvn.sh analyzes the particle list in
+       hadronic_afterburner_toolkit/results. With the argument "merged",
+       the results are already merged from the shards and it only runs
+       the HBT averaging.
+       run_analysis_spvn_shard.sh ShardId SampleFile analyzes one
+       afterburner sample in hadronic_afterburner_toolkit/shard_{ShardId}
+    """
     working_folder = folder_name
 
     logfile = ""
@@ -583,11 +749,16 @@ def generate_script_analyze_spvn(folder_name, cluster_name, HBT_flag):
     script = open(path.join(working_folder, "run_analysis_spvn.sh"), "w")
     script.write("""#!/bin/bash
 
+AnalysisMode=${1:-full}
+
 (
     cd hadronic_afterburner_toolkit
+    if [ $AnalysisMode = "full" ]; then
 """)
     script.write(
-        "   ./hadronic_afterburner_tools.e analyze_HBT=0 {0}\n".format(logfile))
+        "       ./hadronic_afterburner_tools.e analyze_HBT=0 {0}\n".format(
+            logfile))
+    script.write("    fi\n")
     if HBT_flag:
         script.write(
             "    python3 ./average_event_HBT_correlation_function.py .. results\n"
@@ -595,37 +766,228 @@ def generate_script_analyze_spvn(folder_name, cluster_name, HBT_flag):
     script.write(")\n")
     script.close()
 
+    script = open(path.join(working_folder, "run_analysis_spvn_shard.sh"),
+                  "w")
+    script.write("""#!/bin/bash
 
-def generate_event_folders(initial_condition_database, initial_condition_type,
-                           package_root_path, code_path, working_folder,
-                           cluster_name, event_id, event_id_offset,
-                           n_hydro_per_job, n_urqmd_per_hydro, n_threads,
-                           time_stamp, para_dict, afterburner_type):
-    """This function creates the event folder structure"""
-    event_folder = path.join(working_folder, 'event_%d' % event_id)
+ShardId=$1
+SampleFile=$2
+
+(
+    cd hadronic_afterburner_toolkit
+    rm -fr shard_$ShardId
+    mkdir -p shard_$ShardId/results
+    cd shard_$ShardId
+    for link_i in hadronic_afterburner_tools.e EOS parameters.dat
+    do
+        ln -s ../$link_i $link_i
+    done
+    ln -s $SampleFile results/particle_list.bin
+    ./hadronic_afterburner_tools.e analyze_HBT=0 > run.log
+    rm -fr results/particle_list.bin
+)
+""")
+    script.close()
+
+
+def link_file(source, target):
+    """This function creates a symbolic link to source at target"""
+    if path.lexists(target):
+        remove(target)
+    symlink(path.abspath(source), target)
+
+
+def link_or_copy(source, target):
+    """This function hard-links a file or a symbolic link of the code
+       template into the event folder, or copies it if the link fails
+       (e.g. on file systems without hard links)
+    """
+    try:
+        link(source, target, follow_symlinks=False)
+    except OSError:
+        shutil.copy2(source, target, follow_symlinks=False)
+    return target
+
+
+def set_write_permission(folder, write_flag):
+    """This function adds or removes the write permission of all the files
+       in a folder, the folders themselves stay writable
+    """
+    for root, _, filenames in walk(folder):
+        for filename in filenames:
+            file_i = path.join(root, filename)
+            if path.islink(file_i):
+                continue
+            mode = lstat(file_i).st_mode
+            if write_flag:
+                chmod(file_i, mode | 0o200)
+            else:
+                chmod(file_i, mode & ~0o222)
+
+
+def build_code_template(working_folder, package_root_path, code_path,
+                        afterburner_type, photon_flag):
+    """This function builds the read-only template of the code package
+       folders in the working folder. It holds the files shared by all the
+       event folders: the driver and its modules, the scripts and the
+       parameter files of the code packages, and the links to their
+       executables and tables. The event folders replicate it with
+       replicate_code_folder.
+       It returns the template folder.
+    """
     param_folder = path.join(working_folder, 'model_parameters')
-    mkdir(event_folder)
+    template_folder = path.join(working_folder, 'code_template')
+    mkdir(template_folder)
+
+    driver_folder = path.join(template_folder, 'driver')
+    mkdir(driver_folder)
     shutil.copy(path.join(code_path, 'hydro_plus_UrQMD_driver.py'),
-                event_folder)
+                driver_folder)
     shutil.copy(
         path.join(package_root_path, 'IPGlasma_database',
-                  'fetch_IPGlasma_event_from_hdf5_database.py'), event_folder)
+                  'fetch_IPGlasma_event_from_hdf5_database.py'), driver_folder)
     shutil.copy(
         path.join(package_root_path, '3DMCGlauber_database',
                   'fetch_3DMCGlauber_event_from_hdf5_database.py'),
-        event_folder)
+        driver_folder)
+    for module_i in ['hdf5_storage_profiles.py', 'hdf5_columnar_layout.py',
+                     'hydro_archive.py', 'particle_list_frames.py']:
+        shutil.copy(path.join(package_root_path, 'utilities', module_i),
+                    driver_folder)
+
+    def add_links(folder_name, code_folder_name, link_list):
+        for link_i in link_list:
+            link_file(path.join(code_path, code_folder_name, link_i),
+                      path.join(template_folder, folder_name, link_i))
+
+    shutil.copytree(path.join(code_path, 'MUSIC'),
+                    path.join(template_folder, 'MUSIC'))
+    shutil.copyfile(path.join(param_folder, 'MUSIC/music_input_mode_2'),
+                    path.join(template_folder, 'MUSIC/music_input_mode_2'))
+    add_links('MUSIC', 'MUSIC_code', ['EOS', 'MUSIChydro'])
+
+    if photon_flag:
+        mkdir(path.join(template_folder, 'photonEmission_hydroInterface'))
+        shutil.copyfile(path.join(param_folder, 'photonEmission_hydroInterface',
+                                  'parameters.dat'),
+                        path.join(template_folder,
+                                  'photonEmission_hydroInterface',
+                                  'parameters.dat'))
+        add_links('photonEmission_hydroInterface',
+                  'photonEmission_hydroInterface_code',
+                  ['ph_rates', 'hydro_photonEmission.e'])
+
+    mkdir(path.join(template_folder, 'iSS'))
+    add_links('iSS', 'iSS_code', ['iSS_tables', 'iSS.e'])
+    if afterburner_type == "UrQMD":
+        shutil.copytree(path.join(code_path, 'osc2u'),
+                        path.join(template_folder, 'osc2u'))
+        shutil.copytree(path.join(code_path, 'urqmd'),
+                        path.join(template_folder, 'urqmd'))
+        add_links('urqmd', 'urqmd_code/urqmd', ['urqmd.e'])
+
+    shutil.copytree(path.join(code_path, 'hadronic_afterburner_toolkit'),
+                    path.join(template_folder, 'hadronic_afterburner_toolkit'))
+    shutil.copyfile(
+        path.join(param_folder, 'hadronic_afterburner_toolkit/parameters.dat'),
+        path.join(template_folder,
+                  'hadronic_afterburner_toolkit/parameters.dat'))
+    add_links('hadronic_afterburner_toolkit',
+              'hadronic_afterburner_toolkit_code',
+              ['hadronic_afterburner_tools.e', 'EOS'])
+
+    # the files are shared by all the event folders through hard links,
+    # except the ones in template_copy_list
+    set_write_permission(template_folder, False)
+    return template_folder
+
+
+def is_template_copy(template_folder, file_i):
+    """This function checks whether the event folders need their own copy
+       of the file file_i of the code template, see template_copy_list
+    """
+    rel_path = path.relpath(file_i, template_folder)
+    if rel_path in template_copy_list:
+        return True
+    if path.islink(file_i) or lstat(file_i).st_mode & 0o111:
+        return False
+    return any(rel_path.startswith(folder_i + "/")
+               for folder_i in template_copy_list)
+
+
+def replicate_code_folder(template_folder, folder_name, target_folder,
+                          link_flag=True):
+    """This function replicates a folder of the code template in the event
+       folder. With link_flag, only the folders are created and the files
+       are hard links to the template, except the writable copies of the
+       files in template_copy_list. Otherwise, all the files are writable
+       copies.
+    """
+    source = path.join(template_folder, folder_name)
+    target = path.join(target_folder, folder_name)
+    if not link_flag:
+        shutil.copytree(source, target, symlinks=True)
+        set_write_permission(target, True)
+        return
+    for root, folders, filenames in walk(source):
+        target_root = path.normpath(path.join(target,
+                                              path.relpath(root, source)))
+        mkdir(target_root)
+        for name_i in list(folders):
+            if path.islink(path.join(root, name_i)):
+                # links to the folders of the code packages
+                folders.remove(name_i)
+                filenames.append(name_i)
+        for name_i in filenames:
+            source_i = path.join(root, name_i)
+            target_i = path.join(target_root, name_i)
+            if is_template_copy(template_folder, source_i):
+                shutil.copyfile(source_i, target_i)
+            else:
+                link_or_copy(source_i, target_i)
+
+
+def substitute_in_file(filename, pattern, replacement):
+    """This function replaces a pattern in every line of a file"""
+    with open(filename, "r") as f:
+        lines = [re.sub(pattern, replacement, line) for line in f]
+    with open(filename, "w") as f:
+        f.writelines(lines)
+
+
+def generate_event_folders(initial_condition_database, initial_condition_type,
+                           package_root_path, code_path, working_folder,
+                           cluster_name, event_id, event_id_offset,
+                           n_hydro_per_job, n_urqmd_per_hydro, n_threads,
+                           time_stamp, para_dict, afterburner_type,
+                           template_folder, link_flag=True):
+    """This function creates the event folder structure
+       The code package folders are replicated from the code template
+       (build_code_template), with hard links if link_flag is True. It can
+       run for several event folders at the same time.
+    """
+    event_folder = path.join(working_folder, 'event_%d' % event_id)
+    param_folder = path.join(working_folder, 'model_parameters')
+    mkdir(event_folder)
+    for module_i in listdir(path.join(template_folder, 'driver')):
+        # the driver and its modules
+        if link_flag:
+            link_or_copy(path.join(template_folder, 'driver', module_i),
+                         path.join(event_folder, module_i))
+        else:
+            shutil.copyfile(path.join(template_folder, 'driver', module_i),
+                            path.join(event_folder, module_i))
     if initial_condition_database == "self" or "fixCentrality":
         if "3DMCGlauber" in initial_condition_type:
             mkdir(path.join(event_folder, '3dMCGlauber'))
             shutil.copyfile(path.join(param_folder, '3dMCGlauber/input'),
                             path.join(event_folder, '3dMCGlauber/input'))
             for link_i in ['3dMCGlb.e', 'eps09', 'tables']:
-                subprocess.call("ln -s {0:s} {1:s}".format(
+                link_file(
                     path.abspath(
                         path.join(code_path,
                                   '3dMCGlauber_code/{}'.format(link_i))),
-                    path.join(event_folder, "3dMCGlauber/{}".format(link_i))),
-                                shell=True)
+                    path.join(event_folder, "3dMCGlauber/{}".format(link_i)))
         elif initial_condition_type in ("IPGlasma", "IPGlasma+KoMPoST"):
             generate_script_ipglasma(event_folder, n_threads, cluster_name,
                                      event_id)
@@ -637,12 +999,11 @@ def generate_event_folders(initial_condition_database, initial_condition_type,
                 'nucleusConfigurations', 'tables',
             ]
             for link_i in link_list:
-                subprocess.call("ln -s {0:s} {1:s}".format(
+                link_file(
                     path.abspath(
                         path.join(code_path,
                                   'ipglasma_code/{}'.format(link_i))),
-                    path.join(event_folder, "ipglasma/{}".format(link_i))),
-                                shell=True)
+                    path.join(event_folder, "ipglasma/{}".format(link_i)))
 
     generate_full_job_script(cluster_name, event_folder,
                              initial_condition_database,
@@ -657,43 +1018,22 @@ def generate_event_folders(initial_condition_database, initial_condition_type,
         shutil.copyfile(path.join(param_folder, 'KoMPoST/setup.ini'),
                         path.join(event_folder, 'kompost/setup.ini'))
         for link_i in ['EKT', 'KoMPoST.exe']:
-            subprocess.call("ln -s {0:s} {1:s}".format(
+            link_file(
                 path.abspath(
                     path.join(code_path, 'kompost_code/{}'.format(link_i))),
-                path.join(event_folder, "kompost/{}".format(link_i))),
-                            shell=True)
+                path.join(event_folder, "kompost/{}".format(link_i)))
 
     # MUSIC
     generate_script_hydro(event_folder, n_threads, cluster_name)
 
-    shutil.copytree(path.join(code_path, 'MUSIC'),
-                    path.join(event_folder, 'MUSIC'))
-    shutil.copyfile(path.join(param_folder, 'MUSIC/music_input_mode_2'),
-                    path.join(event_folder, 'MUSIC/music_input_mode_2'))
-    for link_i in ['EOS', 'MUSIChydro']:
-        subprocess.call("ln -s {0:s} {1:s}".format(
-            path.abspath(path.join(code_path, 'MUSIC_code/{}'.format(link_i))),
-            path.join(event_folder, "MUSIC/{}".format(link_i))),
-                        shell=True)
+    replicate_code_folder(template_folder, 'MUSIC', event_folder, link_flag)
 
     if para_dict.control_dict['compute_photon_emission']:
         # photon
         generate_script_photon(event_folder, n_threads, cluster_name)
-        mkdir(path.join(event_folder, 'photonEmission_hydroInterface'))
-        shutil.copyfile(path.join(param_folder, 'photonEmission_hydroInterface',
-                                  'parameters.dat'),
-                        path.join(event_folder, 'photonEmission_hydroInterface',
-                                  'parameters.dat'))
-        for link_i in ['ph_rates', 'hydro_photonEmission.e']:
-            orgFilePath = path.abspath(path.join(code_path,
-                                       'photonEmission_hydroInterface_code',
-                                       '{}'.format(link_i)))
-            trgFilePath = path.join(event_folder,
-                                    "photonEmission_hydroInterface",
-                                    "{}".format(link_i))
-            subprocess.call("ln -s {0:s} {1:s}".format(orgFilePath,
-                                                       trgFilePath),
-                            shell=True)
+        replicate_code_folder(template_folder,
+                              'photonEmission_hydroInterface', event_folder,
+                              link_flag)
 
     # particlization + hadronic afterburner
     HBT_flag = False
@@ -704,8 +1044,9 @@ def generate_event_folders(initial_condition_database, initial_condition_type,
     if para_dict.control_dict['compute_polarization']:
         generate_script_spinPol(event_folder, cluster_name)
 
-    generate_script_afterburner(event_folder, cluster_name, HBT_flag,
-                                afterburner_type)
+    generate_script_afterburner(
+        event_folder, cluster_name, HBT_flag, afterburner_type,
+        para_dict.control_dict.get('afterburner_fifo', False))
 
     generate_script_analyze_spvn(event_folder, cluster_name, HBT_flag)
 
@@ -717,83 +1058,31 @@ def generate_event_folders(initial_condition_database, initial_condition_type,
                                      'event_{}'.format(event_id),
                                      'UrQMDev_{}'.format(iev))
         mkdir(sub_event_folder)
-        mkdir(path.join(sub_event_folder, 'iSS'))
+        replicate_code_folder(template_folder, 'iSS', sub_event_folder,
+                              link_flag)
         iSSParamFile = 'iSS/iSS_parameters.dat'
         shutil.copyfile(path.join(param_folder, iSSParamFile),
                         path.join(sub_event_folder, iSSParamFile))
         if para_dict.control_dict['compute_polarization']:
             if iev < n_urqmd_per_hydro:
-                f1 = open("temp.dat", "w")
-                with open(path.join(sub_event_folder, iSSParamFile)) as f:
-                    for line in f:
-                        line2 = re.sub("calculate_polarization = 1",
-                                       "calculate_polarization = 0", line)
-                        f1.write(line2)
-                f1.close()
-                shutil.copyfile("temp.dat", path.join(sub_event_folder,
-                                                      iSSParamFile))
+                substitute_in_file(path.join(sub_event_folder, iSSParamFile),
+                                   "calculate_polarization = 1",
+                                   "calculate_polarization = 0")
             if iev == n_urqmd_per_hydro:
-                f1 = open("temp.dat", "w")
-                with open(path.join(sub_event_folder, iSSParamFile)) as f:
-                    for line in f:
-                        line2 = re.sub("MC_sampling = 4",
-                                       "MC_sampling = 0", line)
-                        f1.write(line2)
-                f1.close()
-                shutil.copyfile("temp.dat", path.join(sub_event_folder,
-                                                      iSSParamFile))
-            remove("temp.dat")
-
-        for link_i in ['iSS_tables', 'iSS.e']:
-            subprocess.call("ln -s {0:s} {1:s}".format(
-                path.abspath(path.join(code_path,
-                                       'iSS_code/{}'.format(link_i))),
-                path.join(sub_event_folder, "iSS/{}".format(link_i))),
-                            shell=True)
+                substitute_in_file(path.join(sub_event_folder, iSSParamFile),
+                                   "MC_sampling = 4", "MC_sampling = 0")
+
         if afterburner_type == "UrQMD":
-            shutil.copytree(path.join(code_path, 'osc2u'),
-                            path.join(sub_event_folder, 'osc2u'))
-            shutil.copytree(path.join(code_path, 'urqmd'),
-                            path.join(sub_event_folder, 'urqmd'))
-            subprocess.call("ln -s {0:s} {1:s}".format(
-                path.abspath(path.join(code_path, 'urqmd_code/urqmd/urqmd.e')),
-                path.join(sub_event_folder, "urqmd/urqmd.e")),
-                            shell=True)
+            replicate_code_folder(template_folder, 'osc2u', sub_event_folder,
+                                  link_flag)
+            replicate_code_folder(template_folder, 'urqmd', sub_event_folder,
+                                  link_flag)
         if HBT_flag:
-            shutil.copytree(path.join(code_path,
-                                      'hadronic_afterburner_toolkit'),
-                            path.join(sub_event_folder,
-                                      'hadronic_afterburner_toolkit'))
-            shutil.copyfile(
-                path.join(param_folder,
-                          'hadronic_afterburner_toolkit/parameters.dat'),
-                path.join(sub_event_folder,
-                          'hadronic_afterburner_toolkit/parameters.dat'))
-            for link_i in ['hadronic_afterburner_tools.e', 'EOS']:
-                subprocess.call("ln -s {0:s} {1:s}".format(
-                    path.abspath(
-                        path.join(
-                            code_path,
-                            'hadronic_afterburner_toolkit_code/{}'.format(
-                                link_i))),
-                    path.join(
-                        sub_event_folder,
-                        "hadronic_afterburner_toolkit/{}".format(link_i))),
-                                shell=True)
-    shutil.copytree(path.join(code_path, 'hadronic_afterburner_toolkit'),
-                    path.join(event_folder, 'hadronic_afterburner_toolkit'))
-    shutil.copyfile(
-        path.join(param_folder, 'hadronic_afterburner_toolkit/parameters.dat'),
-        path.join(event_folder, 'hadronic_afterburner_toolkit/parameters.dat'))
-    for link_i in ['hadronic_afterburner_tools.e', 'EOS']:
-        subprocess.call("ln -s {0:s} {1:s}".format(
-            path.abspath(
-                path.join(
-                    code_path,
-                    'hadronic_afterburner_toolkit_code/{}'.format(link_i))),
-            path.join(event_folder,
-                      "hadronic_afterburner_toolkit/{}".format(link_i))),
-                        shell=True)
+            replicate_code_folder(template_folder,
+                                  'hadronic_afterburner_toolkit',
+                                  sub_event_folder, link_flag)
+    replicate_code_folder(template_folder, 'hadronic_afterburner_toolkit',
+                          event_folder, link_flag)
 
 
 def create_a_working_folder(workfolder_path):
@@ -883,6 +1172,14 @@ def main():
                         default='-1',
                         help='Random Seed (-1: according to system time)')
     parser.add_argument('--nocopy', action='store_true')
+    parser.add_argument('--n_workers',
+                        metavar='',
+                        type=int,
+                        default=8,
+                        help='number of event folders generated at a time')
+    parser.add_argument('--copy_code_folders', action='store_true',
+                        help=('copy the code template into every event '
+                              + 'folder instead of hard-linking it'))
     parser.add_argument("--continueFlag", action="store_true")
     args = parser.parse_args()
 
@@ -913,17 +1210,21 @@ def main():
 
     code_package_path = path.abspath(path.dirname(__file__))
 
-    if n_threads < n_urqmd_per_hydro:
+    par_diretory = path.dirname(path.abspath(args.par_dict))
+    sys.path.insert(0, par_diretory)
+    parameter_dict = __import__(args.par_dict.split('.py')[0].split("/")[-1])
+
+    # with n_cores, the job holds n_cores cores and n_threads only sets the
+    # threads of the multithreaded codes
+    if (n_threads < n_urqmd_per_hydro
+            and parameter_dict.control_dict.get('n_cores', 0)
+            < n_urqmd_per_hydro):
         print("\U000026A0  "
               + "Warning: n_threads = {} < n_urqmd_per_hydro = {}!".format(
                   n_threads, n_urqmd_per_hydro))
         print("reset n_threads to {}".format(n_urqmd_per_hydro))
         n_threads = n_urqmd_per_hydro
 
-    par_diretory = path.dirname(path.abspath(args.par_dict))
-    sys.path.insert(0, par_diretory)
-    parameter_dict = __import__(args.par_dict.split('.py')[0].split("/")[-1])
-
     if cluster_name == "osg":
         if seed == -1:
             seed = 0
@@ -1039,14 +1340,15 @@ def main():
         n_jobs, " "*toolbar_width))
     sys.stdout.flush()
     sys.stdout.write("\b"*(toolbar_width + 1))
+    generation_start = time.time()
+    template_folder = build_code_template(
+        working_folder_name, code_package_path, code_path, afterburner_type,
+        parameter_dict.control_dict['compute_photon_emission'])
+    executor = ThreadPoolExecutor(max_workers=max(1, args.n_workers))
+    futures = []
     event_id_offset = job_id
     n_hydro_rescaled = n_hydro_per_job
     for iev in range(n_jobs):
-        progress_i = (int(float(iev + 1)/n_jobs*toolbar_width)
-                      - int(float(iev)/n_jobs*toolbar_width))
-        for ii in range(progress_i):
-            sys.stdout.write("#")
-            sys.stdout.flush()
         # I think this is rescaling the number of events according to an initial estimate of the centrality (&HSC)
         # This is done because peripheral events are much more common, so it enables statistics for central events.
         # I'm not sure how the rescaling is actually handled
@@ -1063,15 +1365,29 @@ def main():
                         cent_label_pre = cent_label
                         event_id_offset = 0
                     break
-        generate_event_folders(initial_condition_database.format(cent_label),
-                               initial_condition_type, code_package_path,
-                               code_path, working_folder_name, cluster_name,
-                               iev, event_id_offset, n_hydro_rescaled,
-                               n_urqmd_per_hydro, n_threads,
-                               IPGlasma_time_stamp, parameter_dict,
-                               afterburner_type)
+        futures.append(executor.submit(
+            generate_event_folders,
+            initial_condition_database.format(cent_label),
+            initial_condition_type, code_package_path, code_path,
+            working_folder_name, cluster_name, iev, event_id_offset,
+            n_hydro_rescaled, n_urqmd_per_hydro, n_threads,
+            IPGlasma_time_stamp, parameter_dict, afterburner_type,
+            template_folder, not args.copy_code_folders))
         event_id_offset += n_hydro_rescaled
+    for iev, future_i in enumerate(as_completed(futures)):
+        future_i.result()
+        progress_i = (int(float(iev + 1)/n_jobs*toolbar_width)
+                      - int(float(iev)/n_jobs*toolbar_width))
+        for ii in range(progress_i):
+            sys.stdout.write("#")
+            sys.stdout.flush()
+    executor.shutdown()
+    generation_time = time.time() - generation_start
     sys.stdout.write("\n")
+    sys.stdout.write("\U0001F375  Generated {} jobs in {:.1f} s ".format(
+        n_jobs, generation_time)
+                     + "({:.1f} folders/s)\n".format(
+                         n_jobs/max(generation_time, 1e-6)))
     sys.stdout.flush()
 
     # copy script to collect final results
@@ -1087,18 +1403,20 @@ def main():
     walltime = '10:00:00'
     if "walltime" in parameter_dict.control_dict.keys():
         walltime = parameter_dict.control_dict["walltime"]
+    # every job reserves n_cores cores, the same as in its script header
+    n_cores = max(n_threads, parameter_dict.control_dict.get('n_cores', 0))
     if cluster_name == "nersc":
         shutil.copy(
             path.join(code_package_path,
                       'Cluster_supports/NERSC/job_MPI_wrapper.py'),
             working_folder_name)
 
-        n_nodes = max(1, int(n_jobs*n_threads/64))
+        n_nodes = max(1, int(n_jobs*n_cores/64))
         if args.node_type.lower() == "knl":
-            n_nodes = max(1, int(n_jobs*n_threads/272))
+            n_nodes = max(1, int(n_jobs*n_cores/272))
         generate_nersc_mpi_job_script(working_folder_name,
                                       args.node_type.lower(), n_nodes,
-                                      n_threads, int(n_jobs/n_nodes), walltime)
+                                      n_cores, int(n_jobs/n_nodes), walltime)
 
     if cluster_name == "wsugrid":
         shutil.copy(
@@ -1122,13 +1440,13 @@ def main():
             path.join(code_package_path,
                       'Cluster_supports/Stampede2/job_MPI_wrapper.py'),
             working_folder_name)
-        n_nodes = max(1, int(n_jobs*n_threads/nThreadsPerNode))
-        if n_nodes*nThreadsPerNode < n_jobs*n_threads:
+        n_nodes = max(1, int(n_jobs*n_cores/nThreadsPerNode))
+        if n_nodes*nThreadsPerNode < n_jobs*n_cores:
             n_nodes += 1
 
         generate_Stampede2_mpi_job_script(working_folder_name,
                                           args.node_type.lower(),
-                                          n_nodes, n_jobs, n_threads, walltime)
+                                          n_nodes, n_jobs, n_cores, walltime)
         script_path = path.join(code_package_path, "utilities")
         shutil.copy(path.join(script_path, 'collect_events.sh'),
                     working_folder_name)
@@ -1141,14 +1459,14 @@ def main():
             path.join(code_package_path,
                       'Cluster_supports/Anvil/job_MPI_wrapper.py'),
             working_folder_name)
-        n_nodes = max(1, int(n_jobs*n_threads/nThreadsPerNode))
-        nTaskPerNode = int(nThreadsPerNode/n_threads)
-        if n_nodes*nThreadsPerNode < n_jobs*n_threads:
+        n_nodes = max(1, int(n_jobs*n_cores/nThreadsPerNode))
+        nTaskPerNode = int(nThreadsPerNode/n_cores)
+        if n_nodes*nThreadsPerNode < n_jobs*n_cores:
             n_nodes += 1
 
         generate_Anvil_mpi_job_script(working_folder_name,
                                       args.node_type.lower(), n_nodes,
-                                      nTaskPerNode, n_threads, walltime)
+                                      nTaskPerNode, n_cores, walltime)
         script_path = path.join(code_package_path, "utilities")
         shutil.copy(path.join(script_path, 'collect_events.sh'),
                     working_folder_name)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Tests that the merged spvn results of the shards are the same as the
+   results of the analysis of all the samples at once"""
+
+import sys
+from os import path, makedirs, listdir
+import numpy as np
+
+repo_folder = path.dirname(path.dirname(path.abspath(__file__)))
+for folder_i in ["codes", "utilities", "3DMCGlauber_database",
+                 "IPGlasma_database"]:
+    sys.path.insert(0, path.join(repo_folder, folder_i))
+
+import hydro_plus_UrQMD_driver as driver
+
+NORDER = 3
+pT_bins = np.linspace(0., 3., 11)
+eta_bins = np.linspace(-2., 2., 9)
+
+
+def generate_events(n_events, rng):
+    """This function generates events of charged hadrons (pT, eta, phi)"""
+    event_list = []
+    for _ in range(n_events):
+        n_particles = rng.integers(50, 300)
+        event_list.append(np.array([
+            rng.exponential(0.6, n_particles),
+            rng.uniform(-2., 2., n_particles),
+            rng.uniform(0., 2.*np.pi, n_particles)]).T)
+    return event_list
+
+
+def write_toolkit_results(event_list, results_folder):
+    """This function writes the spvn results of the events in the output
+       format of the hadronic_afterburner_toolkit
+    """
+    makedirs(results_folder, exist_ok=True)
+    particles = np.concatenate(event_list)
+    pT, eta, phi = particles[:, 0], particles[:, 1], particles[:, 2]
+    nev = len(event_list)
+    dy = 1.
+
+    def Qn_columns(selection, norm):
+        columns = []
+        for iorder in range(1, NORDER + 1):
+            Qn = np.sum(np.exp(1j*iorder*phi[selection]))
+            columns += [np.real(Qn)/norm, np.imag(Qn)/norm]
+        return columns
+
+    # pT differential
+    rows = []
+    central = np.abs(eta) < 0.5
+    for ipT in range(len(pT_bins) - 1):
+        selection = central & (pT >= pT_bins[ipT]) & (pT < pT_bins[ipT + 1])
+        N = np.sum(selection)
+        pT_c = (pT_bins[ipT] + pT_bins[ipT + 1])/2.
+        dpT = pT_bins[ipT + 1] - pT_bins[ipT]
+        rows.append([np.sum(pT[selection])/(N + 1e-15),
+                     N/nev/dy/(2.*np.pi*pT_c*dpT)]
+                    + Qn_columns(selection, N + 1e-15) + [N])
+    np.savetxt(path.join(results_folder,
+                         "particle_9999_vndata_diff_eta_-0.5_0.5.dat"),
+               rows, fmt="%.10e",
+               header="pT(GeV)  dN/(2pi dy pT dpT)(GeV^-2)  vn_real  "
+                      + "vn_imag  ...  totalN")
+
+    # pT integrated
+    N = np.sum(central)
+    rows = [[0, N/nev/dy, 0.]]
+    Qn = Qn_columns(central, N)
+    for iorder in range(1, NORDER + 1):
+        rows.append([iorder, Qn[2*iorder - 2], Qn[2*iorder - 1]])
+    rows.append([NORDER + 1, N, nev])
+    np.savetxt(path.join(results_folder,
+                         "particle_9999_vndata_eta_-0.5_0.5.dat"),
+               rows, fmt="%.10e", header="n  vn_real  vn_imag")
+
+    # rapidity distribution
+    rows = []
+    deta = eta_bins[1] - eta_bins[0]
+    for ieta in range(len(eta_bins) - 1):
+        selection = (eta >= eta_bins[ieta]) & (eta < eta_bins[ieta + 1])
+        N = np.sum(selection)
+        rows.append([(eta_bins[ieta] + eta_bins[ieta + 1])/2.,
+                     N/nev/deta, np.sum(pT[selection])/nev/deta]
+                    + Qn_columns(selection, N + 1e-15) + [N])
+    np.savetxt(path.join(results_folder,
+                         "particle_9999_dNdeta_pT_0.2_3.dat"),
+               rows, fmt="%.10e",
+               header="eta  dN/deta  dET/deta  vn_real  vn_imag  ...  N")
+
+    # pT-eta distribution
+    rows = []
+    for ieta in range(len(eta_bins) - 1):
+        for ipT in range(len(pT_bins) - 1):
+            selection = ((eta >= eta_bins[ieta]) & (eta < eta_bins[ieta + 1])
+                         & (pT >= pT_bins[ipT]) & (pT < pT_bins[ipT + 1]))
+            N = np.sum(selection)
+            rows.append([(eta_bins[ieta] + eta_bins[ieta + 1])/2.,
+                         np.sum(pT[selection])/(N + 1e-15), N/nev]
+                        + Qn_columns(selection, nev))
+    np.savetxt(path.join(results_folder,
+                         "particle_9999_pTeta_distribution.dat"),
+               rows, fmt="%.10e", header="eta  pT  dN  Qn_real  Qn_imag ...")
+
+
+def test_sharded_results_match_unsharded_results(tmp_path):
+    rng = np.random.default_rng(1)
+    event_list = generate_events(40, rng)
+    write_toolkit_results(event_list, str(tmp_path/"unsharded"))
+    shard_results = []
+    for ishard, (i_start, i_end) in enumerate([(0, 5), (5, 20), (20, 40)]):
+        shard_folder = str(tmp_path/"shard_{}".format(ishard))
+        write_toolkit_results(event_list[i_start:i_end], shard_folder)
+        shard_results.append((shard_folder, i_end - i_start))
+    makedirs(str(tmp_path/"merged"))
+
+    failed_files = driver.merge_spvn_shards(shard_results,
+                                            str(tmp_path/"merged"))
+
+    assert failed_files == []
+    for filename in listdir(str(tmp_path/"unsharded")):
+        merged = np.loadtxt(str(tmp_path/"merged"/filename))
+        unsharded = np.loadtxt(str(tmp_path/"unsharded"/filename))
+        np.testing.assert_allclose(merged, unsharded, rtol=1e-6,
+                                   atol=1e-10, err_msg=filename)
+
+
+def test_raw_counts_are_summed(tmp_path):
+    rng = np.random.default_rng(2)
+    event_list = generate_events(400, rng)
+    shard_results = []
+    for ishard, (i_start, i_end) in enumerate([(0, 100), (100, 400)]):
+        shard_folder = str(tmp_path/"shard_{}".format(ishard))
+        write_toolkit_results(event_list[i_start:i_end], shard_folder)
+        shard_results.append((shard_folder, i_end - i_start))
+    makedirs(str(tmp_path/"merged"))
+
+    driver.merge_spvn_shards(shard_results, str(tmp_path/"merged"))
+
+    vn_inte = np.loadtxt(str(
+        tmp_path/"merged"/"particle_9999_vndata_eta_-0.5_0.5.dat"))
+    assert vn_inte[-1, 2] == 400
+    vn_diff = [np.loadtxt(path.join(
+        folder, "particle_9999_vndata_diff_eta_-0.5_0.5.dat"))
+               for folder, _ in shard_results]
+    merged = np.loadtxt(str(
+        tmp_path/"merged"/"particle_9999_vndata_diff_eta_-0.5_0.5.dat"))
+    np.testing.assert_array_equal(merged[:, -1],
+                                  vn_diff[0][:, -1] + vn_diff[1][:, -1])
+
+
+def test_files_without_rules_are_not_merged(tmp_path):
+    shard_results = []
+    for ishard in range(2):
+        shard_folder = tmp_path/"shard_{}".format(ishard)
+        makedirs(str(shard_folder))
+        np.savetxt(str(shard_folder/"particle_9999_Cn4_eta_-1_1.dat"),
+                   np.ones([3, 4]))
+        shard_results.append((str(shard_folder), 10))
+    makedirs(str(tmp_path/"merged"))
+
+    failed_files = driver.merge_spvn_shards(shard_results,
+                                            str(tmp_path/"merged"))
+
+    assert failed_files == ["particle_9999_Cn4_eta_-1_1.dat"]
+    assert listdir(str(tmp_path/"merged")) == []
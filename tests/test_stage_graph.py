@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Tests the order, the failure propagation, and the error flags of the
+   stage graph of the driver"""
+
+import sys
+import time
+import threading
+from os import path
+
+repo_folder = path.dirname(path.dirname(path.abspath(__file__)))
+for folder_i in ["codes", "utilities", "3DMCGlauber_database",
+                 "IPGlasma_database"]:
+    sys.path.insert(0, path.join(repo_folder, folder_i))
+
+import hydro_plus_UrQMD_driver as driver
+
+
+def make_stages(log, failed_stages=()):
+    """This function returns the stages of an event, which log their start
+       and end
+    """
+    lock = threading.Lock()
+
+    def make_func(name):
+        def func(n_threads):
+            with lock:
+                log.append(("start", name))
+            time.sleep(0.05)
+            with lock:
+                log.append(("end", name))
+            return name not in failed_stages
+        return func
+
+    stage_specs = [
+        ("initial_condition", [], ["initial"], "initial"),
+        ("hydro", ["initial"], ["hydro"], "event"),
+        ("photon", ["hydro"], ["photon"], "event"),
+        ("spin", ["hydro"], ["spin"], "event"),
+        ("urqmd", ["hydro"], ["urqmd"], "event"),
+        ("spvn", ["urqmd"], ["spvn"], "event"),
+        ("hdf5", ["spvn", "photon", "spin"], ["hdf5"], "event"),
+    ]
+    return [{'name': name, 'func': make_func(name), 'inputs': inputs,
+             'outputs': outputs, 'n_threads': 2, 'error_flag': error_flag}
+            for name, inputs, outputs, error_flag in stage_specs]
+
+
+def test_serial_stages_run_one_at_a_time_in_order():
+    log = []
+    stage_list = make_stages(log)
+    status = driver.run_stage_graph(stage_list, 4, serial=True)
+    names = [stage['name'] for stage in stage_list]
+    assert log == [(event, name) for name in names
+                   for event in ("start", "end")]
+    assert all(status[name] == "success" for name in names)
+    assert driver.collect_stage_errors(stage_list, status) == (False, False)
+
+
+def test_stage_graph_runs_independent_stages_concurrently():
+    log = []
+    stage_list = make_stages(log)
+    driver.run_stage_graph(stage_list, 6)
+    started = [name for event, name in log[:log.index(("end", "hydro")) + 4]
+               if event == "start"]
+    assert {"photon", "spin", "urqmd"} <= set(started)
+    assert log.index(("end", "hydro")) < log.index(("start", "photon"))
+    assert log.index(("end", "urqmd")) < log.index(("start", "spvn"))
+
+
+def test_failed_stage_skips_its_dependents():
+    for serial in (True, False):
+        log = []
+        stage_list = make_stages(log, failed_stages=("urqmd",))
+        status = driver.run_stage_graph(stage_list, 4, serial=serial)
+        assert status["urqmd"] == "failed"
+        assert status["spvn"] == "skipped"
+        assert status["hdf5"] == "skipped"
+        assert status["photon"] == "success"
+        assert ("start", "spvn") not in log
+        assert driver.collect_stage_errors(stage_list, status) == (
+            False, True)
+
+
+def test_failed_initial_condition_sets_the_initial_error_flag():
+    log = []
+    stage_list = make_stages(log, failed_stages=("initial_condition",))
+    status = driver.run_stage_graph(stage_list, 4, serial=True)
+    assert log == [("start", "initial_condition"),
+                   ("end", "initial_condition")]
+    assert all(status[stage['name']] == "skipped"
+               for stage in stage_list[1:])
+    assert driver.collect_stage_errors(stage_list, status) == (True, True)
+
+
+def run_main(monkeypatch, failed_stages):
+    """This function runs the event loop of the driver for one event with
+       the test stages and returns its exit code
+    """
+    log = []
+    stage_list = make_stages(log, failed_stages)
+    monkeypatch.setattr(driver, "setup_event_folder",
+                        lambda iev, para_dict_, stage_manifest: (
+                            str(iev), "EVENT_RESULTS_{}".format(iev)))
+    monkeypatch.setattr(driver, "build_hydro_stages",
+                        lambda *args: stage_list[:2])
+    monkeypatch.setattr(driver, "build_afterburner_stages",
+                        lambda *args: stage_list[2:])
+    monkeypatch.setattr(driver, "stage_out_event", lambda *args: False)
+    para_dict = dict(driver.driver_options_dict)
+    para_dict.update({
+        'num_threads': 4, 'n_urqmd': 2, 'n_hydro': 1, 'hydro_id0': 0,
+        'initial_condition': "self", 'initial_type': "3DMCGlauber_consttau",
+        'check_point_flag': False, 'compute_photons': False,
+        'prefetch_initial_condition': False,
+    })
+    try:
+        driver.main(para_dict)
+    except SystemExit as err:
+        return err.code
+    return 0
+
+
+def test_exit_codes(monkeypatch):
+    assert run_main(monkeypatch, ()) == 0
+    assert run_main(monkeypatch, ("spvn",)) == 73
+    assert run_main(monkeypatch, ("initial_condition",)) == 71
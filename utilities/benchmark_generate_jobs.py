@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""This script reports how fast generate_jobs.py creates the event folders
+
+   It builds the code template and generates n_jobs event folders in a
+   scratch folder next to an existing working folder (made by
+   generate_jobs.py), one at a time with copies of the template, one at a
+   time with hard links, and with n_workers threads and hard links, and
+   reports the folders per second, the disk usage, and the number of
+   inodes of every mode, with the savings of the links over the copies.
+   Every generated event folder is checked to be runnable: the job script
+   and the run scripts are there, all the links resolve, the executables
+   are executable, and the files the codes rewrite are writable copies of
+   their own.
+"""
+
+import sys
+import time
+import shutil
+from os import path, mkdir, symlink, walk, lstat, access, X_OK, W_OK
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from generate_jobs import (build_code_template, generate_event_folders,
+                           is_template_copy)
+
+
+def print_usage():
+    """This function prints out help messages"""
+    print("Usage: {} ".format(sys.argv[0])
+          + "working_folder parameters_dict_user.py "
+          + "[n_jobs] [n_workers] [n_urqmd_per_hydro]")
+
+
+def load_parameter_dict(par_dict_file):
+    """This function imports the user parameter dictionary and fills in the
+       defaults that generate_jobs.py sets
+    """
+    sys.path.insert(0, path.dirname(path.abspath(par_dict_file)))
+    parameter_dict = __import__(
+        path.basename(par_dict_file).split('.py')[0])
+    parameter_dict.control_dict.setdefault('save_ipglasma_results', False)
+    parameter_dict.control_dict.setdefault('save_kompost_results', False)
+    parameter_dict.control_dict.setdefault('compute_polarization', False)
+    parameter_dict.control_dict.setdefault('compute_photon_emission', False)
+    return parameter_dict
+
+
+def get_disk_usage(folder):
+    """This function returns the disk usage of a folder in MB and its number
+       of inodes, counting every hard-linked file once
+    """
+    inodes = set()
+    n_bytes = 0
+    for root, dirnames, filenames in walk(folder):
+        for name_i in dirnames + filenames:
+            stat_i = lstat(path.join(root, name_i))
+            if (stat_i.st_dev, stat_i.st_ino) not in inodes:
+                inodes.add((stat_i.st_dev, stat_i.st_ino))
+                n_bytes += stat_i.st_blocks*512
+    return n_bytes/1024.**2, len(inodes)
+
+
+def check_event_folder(event_folder, template_folder):
+    """This function checks that an event folder can run. It returns the
+       list of problems.
+    """
+    problems = []
+    for script_i in ["submit_job.script", "hydro_plus_UrQMD_driver.py",
+                     "run_hydro.sh", "run_afterburner.sh"]:
+        if not path.exists(path.join(event_folder, script_i)):
+            problems.append("{} is missing".format(script_i))
+    for root, dirnames, filenames in walk(event_folder):
+        for name_i in dirnames + filenames:
+            file_i = path.join(root, name_i)
+            if not path.exists(file_i):
+                problems.append("{} is a broken link".format(file_i))
+                continue
+            if path.islink(file_i) or path.isdir(file_i):
+                continue
+            rel_path = path.relpath(file_i, event_folder)
+            if rel_path.startswith("UrQMDev_"):
+                rel_path = rel_path.split("/", 1)[1]
+            template_i = path.join(template_folder, rel_path)
+            if name_i.endswith(".e") and not access(file_i, X_OK):
+                problems.append("{} is not executable".format(file_i))
+            if (path.exists(template_i) and not path.islink(template_i)
+                    and is_template_copy(template_folder, template_i)
+                    and (lstat(file_i).st_nlink > 1
+                         or not access(file_i, W_OK))):
+                problems.append("{} is not a writable copy".format(file_i))
+    return problems
+
+
+def generate_folders(working_folder, parameter_dict, n_jobs, n_workers,
+                     n_urqmd, link_flag):
+    """This function generates n_jobs event folders in a scratch folder and
+       returns the time it takes, their disk usage, and their inodes
+    """
+    package_root_path = path.dirname(path.dirname(path.abspath(__file__)))
+    code_path = path.join(working_folder, "codes")
+    if not path.exists(code_path):
+        code_path = path.join(package_root_path, "codes")
+    bench_folder = path.join(working_folder, "benchmark_generate_jobs")
+    shutil.rmtree(bench_folder, ignore_errors=True)
+    mkdir(bench_folder)
+    symlink(path.join(working_folder, "model_parameters"),
+            path.join(bench_folder, "model_parameters"))
+    initial_type = parameter_dict.control_dict['initial_state_type']
+    afterburner_type = parameter_dict.control_dict.get('afterburner_type',
+                                                       "UrQMD")
+    start = time.time()
+    template_folder = build_code_template(
+        bench_folder, package_root_path, code_path, afterburner_type,
+        parameter_dict.control_dict['compute_photon_emission'])
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(
+            generate_event_folders, "self", initial_type, package_root_path,
+            code_path, bench_folder, "local", iev, iev, 1, n_urqmd, n_urqmd,
+            "0.4", parameter_dict, afterburner_type, template_folder,
+            link_flag)
+                   for iev in range(n_jobs)]
+        for future_i in futures:
+            future_i.result()
+    elapsed = time.time() - start
+    disk_usage, n_inodes = get_disk_usage(bench_folder)
+    problems = []
+    for iev in range(n_jobs):
+        problems += check_event_folder(
+            path.join(bench_folder, "event_{}".format(iev)), template_folder)
+    shutil.rmtree(bench_folder)
+    return elapsed, disk_usage, n_inodes, problems
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print_usage()
+        exit(0)
+    working_folder = path.abspath(sys.argv[1])
+    parameter_dict = load_parameter_dict(sys.argv[2])
+    n_jobs = 20
+    if len(sys.argv) > 3:
+        n_jobs = int(sys.argv[3])
+    n_workers = 8
+    if len(sys.argv) > 4:
+        n_workers = int(sys.argv[4])
+    n_urqmd = 4
+    if len(sys.argv) > 5:
+        n_urqmd = int(sys.argv[5])
+
+    print("{:>20s} {:>10s} {:>12s} {:>10s} {:>10s} {:>12s} {:>8s}".format(
+        "mode", "time (s)", "folders/s", "disk (MB)", "inodes",
+        "inode saving", "check"))
+    all_problems = []
+    n_inodes_copy = None
+    for mode_name, n_workers_i, link_flag in [
+            ("serial, copy", 1, False),
+            ("serial, link", 1, True),
+            ("{} threads, link".format(n_workers), n_workers, True)]:
+        elapsed, disk_usage, n_inodes, problems = generate_folders(
+            working_folder, parameter_dict, n_jobs, n_workers_i, n_urqmd,
+            link_flag)
+        if n_inodes_copy is None:
+            n_inodes_copy = n_inodes
+        all_problems += problems
+        print("{:>20s} {:>10.2f} {:>12.1f} {:>10.1f} {:>10d} {:>11.2f}x "
+              "{:>8s}".format(
+                  mode_name, elapsed, n_jobs/max(elapsed, 1e-6), disk_usage,
+                  n_inodes, n_inodes_copy/max(n_inodes, 1),
+                  "ok" if problems == [] else "failed"))
+    for problem_i in all_problems[:20]:
+        print(problem_i)
+    if all_problems != []:
+        exit(1)
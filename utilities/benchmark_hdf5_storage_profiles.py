@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""This script reports the size and speed of the hdf5 storage profiles
+
+   It rewrites all the datasets of a sample hdf5 file (e.g. one
+   spvn_results_*.h5 event or an IPGlasma database) with every storage
+   profile and measures the write time, the read time, and the file size.
+"""
+
+import sys
+import time
+from os import path, remove
+import h5py
+import numpy as np
+from hdf5_storage_profiles import (hdf5_storage_profiles,
+                                   create_dataset_with_profile)
+
+
+def print_usage():
+    """This function prints out help messages"""
+    print("Usage: {} ".format(sys.argv[0]) + "sample_event.h5 [n_repeat]")
+
+
+def load_all_datasets(h5_filename):
+    """This function reads all the datasets and their attributes"""
+    dataset_list = []
+
+    def collect_dataset(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            dataset_list.append((name, obj[()], dict(obj.attrs)))
+
+    with h5py.File(h5_filename, "r") as hf:
+        hf.visititems(collect_dataset)
+    return dataset_list
+
+
+def write_with_profile(dataset_list, h5_filename, profile_name):
+    """This function writes the datasets with the given storage profile"""
+    with h5py.File(h5_filename, "w") as hf:
+        for name, data, attrs in dataset_list:
+            group_name, _, dataset_name = name.rpartition("/")
+            group = hf.require_group(group_name) if group_name != "" else hf
+            dset = create_dataset_with_profile(group, dataset_name, data,
+                                               profile_name)
+            for key, value in attrs.items():
+                dset.attrs.create(key, value)
+
+
+def read_all(h5_filename):
+    """This function reads back all the datasets"""
+    n_bytes = 0
+
+    def read_dataset(name, obj):
+        nonlocal n_bytes
+        if isinstance(obj, h5py.Dataset):
+            n_bytes += np.asarray(obj[()]).nbytes
+
+    with h5py.File(h5_filename, "r") as hf:
+        hf.visititems(read_dataset)
+    return n_bytes
+
+
+def benchmark_profiles(h5_filename, n_repeat=3):
+    """This function benchmarks all the storage profiles"""
+    dataset_list = load_all_datasets(h5_filename)
+    raw_size = sum(np.asarray(data).nbytes for _, data, _ in dataset_list)
+    print("{}: {} datasets, {:.2f} MB uncompressed".format(
+        h5_filename, len(dataset_list), raw_size/1024.**2))
+    print("{:>10s} {:>12s} {:>8s} {:>12s} {:>12s}".format(
+        "profile", "size (MB)", "ratio", "write (s)", "read (s)"))
+    tmp_filename = "benchmark_storage_profile_tmp.h5"
+    for profile_name in hdf5_storage_profiles:
+        write_time = []
+        read_time = []
+        for _ in range(n_repeat):
+            time_0 = time.time()
+            write_with_profile(dataset_list, tmp_filename, profile_name)
+            write_time.append(time.time() - time_0)
+            time_0 = time.time()
+            read_all(tmp_filename)
+            read_time.append(time.time() - time_0)
+        file_size = path.getsize(tmp_filename)
+        print("{:>10s} {:12.3f} {:8.2f} {:12.4f} {:12.4f}".format(
+            profile_name, file_size/1024.**2,
+            raw_size/max(file_size, 1), min(write_time), min(read_time)))
+    remove(tmp_filename)
+
+
+if __name__ == "__main__":
+    try:
+        H5_FILENAME = str(sys.argv[1])
+    except IndexError:
+        print_usage()
+        exit(0)
+    N_REPEAT = 3
+    if len(sys.argv) > 2:
+        N_REPEAT = int(sys.argv[2])
+    benchmark_profiles(H5_FILENAME, N_REPEAT)
@@ -92,6 +92,10 @@ do
             fi
             if [ "$urqmdstatus" = true ]; then
                 $move_or_copy ${eventsPath}/${iev}/${UrQMD_file_name}*${event_id}.gz $target_urqmd_folder
+                # the frame index of the compressed particle list
+                if [ -e ${eventsPath}/${iev}/${UrQMD_file_name}${event_id}.idx ]; then
+                    $move_or_copy ${eventsPath}/${iev}/${UrQMD_file_name}${event_id}.idx $target_urqmd_folder
+                fi
             fi
             $move_or_copy ${eventsPath}/${iev}/${spvn_folder_name}*${event_id}.h5 $target_spvn_folder
             ((collected_eventNum++))
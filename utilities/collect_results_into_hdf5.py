@@ -7,11 +7,13 @@ import sys
 import shutil
 import h5py
 import numpy as np
+from hdf5_storage_profiles import create_dataset_with_profile
 
 
 def print_usage():
     """This function prints out help messages"""
-    print("Usage: {} ".format(sys.argv[0]) + "results_folder_path ")
+    print("Usage: {} ".format(sys.argv[0]) + "results_folder_path "
+          + "[storage_profile]")
 
 
 def check_an_event_is_good(event_folder):
@@ -44,7 +46,7 @@ def check_an_event_is_good(event_folder):
     return True
 
 
-def zip_results_into_hdf5(results_folder):
+def zip_results_into_hdf5(results_folder, storage_profile="legacy"):
     """This function combines all the results into hdf5"""
     final_results_folder = "/".join(
                             path.abspath(results_folder).split("/")[:-1])
@@ -62,8 +64,9 @@ def zip_results_into_hdf5(results_folder):
         for file_path in file_list:
             file_name = file_path.split("/")[-1]
             dtemp = np.loadtxt(file_path)
-            h5data = gtemp.create_dataset("{0}".format(file_name), data=dtemp,
-                                 compression="gzip", compression_opts=9)
+            h5data = create_dataset_with_profile(gtemp,
+                                                 "{0}".format(file_name),
+                                                 dtemp, storage_profile)
             ftemp = open(file_path, "r")
             header_text = str(ftemp.readline())
             ftemp.close()
@@ -77,7 +80,10 @@ def zip_results_into_hdf5(results_folder):
 if __name__ == "__main__":
     try:
         results_folder = str(sys.argv[1])
-        zip_results_into_hdf5(results_folder)
+        storage_profile = "legacy"
+        if len(sys.argv) > 2:
+            storage_profile = str(sys.argv[2])
+        zip_results_into_hdf5(results_folder, storage_profile)
     except IndexError:
         print_usage()
         exit(0)
@@ -5,6 +5,7 @@ from os import path, mkdir
 import sys
 import h5py
 import numpy as np
+from hdf5_columnar_layout import EventResults
 
 
 def print_usage():
@@ -23,13 +24,11 @@ def dump_results_from_hdf5(resultsFile):
     for group_i in groupList:
         resFolder = path.join(dataFileName, group_i)
         mkdir(resFolder)
-        fileList = list(hf[group_i].keys())
+        eventResults = EventResults(hf[group_i])
+        fileList = list(eventResults.keys())
         for file_i in fileList:
-            data = np.nan_to_num(hf[group_i][file_i])
-            attrsList = list(hf[group_i][file_i].attrs.keys())
-            headerText = ""
-            if "header" in attrsList:
-                headerText = str(hf[group_i][file_i].attrs.get("header"))
+            data = np.nan_to_num(eventResults[file_i])
+            headerText = eventResults.get_header(file_i).strip().lstrip("#")
             np.savetxt(path.join(resFolder, file_i), data, fmt="%.6e",
                        delimiter="  ", header=headerText)
         hf.close()
@@ -3,6 +3,7 @@
 import h5py
 import sys
 from numpy import *
+from hdf5_columnar_layout import EventResults
 
 n_order = 7
 
@@ -61,7 +62,7 @@ except:
     help_message()
 
 h5_data = h5py.File(database_file, "r")
-h5_group = h5_data.get("spvn_results_{}".format(event_id))
+h5_group = EventResults(h5_data.get("spvn_results_{}".format(event_id)))
 print("fetching event {0} from the database {1} ...".format(
     event_id, database_file))
 
@@ -112,7 +113,7 @@ for fileName in fileList:
 
 # Output all attributes (usedParameters lines) to attributes.dat
 attr_data = []
-for key in sorted(h5_group.attrs, key=int):
+for key in sorted((key for key in h5_group.attrs if key.isdigit()), key=int):
     attr_data.append(h5_group.attrs[key].decode('utf-8'))
 
 savetxt("attributes_{}.dat".format(event_id), attr_data, fmt="%s")
\ No newline at end of file
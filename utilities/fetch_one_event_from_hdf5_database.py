@@ -4,6 +4,7 @@ import h5py
 import sys
 import os
 from numpy import *
+from hdf5_columnar_layout import EventResults
 
 
 def help_message():
@@ -19,7 +20,7 @@ except:
 
 h5_data = h5py.File(database_file, "r")
 group_name = "spvn_results_{}".format(event_id)
-h5_group = h5_data.get(group_name)
+h5_group = EventResults(h5_data.get(group_name))
 print("fetching event {0} from the database {1} ...".format(
     event_id, database_file))
 
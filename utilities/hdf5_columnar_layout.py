@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""This module writes and reads the columnar layout of the event results
+
+   In the default layout, every event group holds one dataset per result
+   file, e.g. particle_211_vndata_diff_y_-0.5_0.5.dat. In the columnar
+   layout, the particle tables of the same kind and shape, e.g. all the
+   particle_*_vndata_diff_y_*.dat tables, are stacked into one dataset
+   columnar/particle_vndata_diff_y with shape (n_tables, n_rows, n_cols).
+   The dataset columnar/particle_vndata_diff_y_index lists the particle id
+   and the rapidity window of every table and
+   columnar/particle_vndata_diff_y_files lists their original file names.
+   All the other files stay as one dataset per file.
+
+   EventResults gives the same file-name based access for both layouts.
+"""
+
+import re
+from collections import Counter
+import numpy as np
+from hdf5_storage_profiles import create_dataset_with_profile
+
+particle_table_pattern = re.compile(
+    r"^particle_(-?\d+)_(.+)_(-?[0-9.]+)_(-?[0-9.]+)\.dat$")
+
+
+def parse_particle_table_name(file_name):
+    """This function splits a particle table name into
+       (kind, particle id, window lower edge, window upper edge)
+       It returns None if the file is not a particle table.
+    """
+    match = particle_table_pattern.match(file_name)
+    if match is None:
+        return None
+    try:
+        return (match.group(2), int(match.group(1)), float(match.group(3)),
+                float(match.group(4)))
+    except ValueError:
+        return None
+
+
+def write_columnar_event(group, file_names, data_list, header_list,
+                         storage_profile="legacy"):
+    """This function writes the tables of one event into the hdf5 group in
+       the columnar layout
+    """
+    group.attrs.create("layout", np.bytes_("columnar"))
+    families = {}
+    for itable, file_name in enumerate(file_names):
+        table_info = parse_particle_table_name(file_name)
+        if table_info is None or np.ndim(data_list[itable]) == 0:
+            continue
+        families.setdefault(table_info[0], []).append(itable)
+
+    stacked_tables = set()
+    columnar_group = group.require_group("columnar")
+    for kind, table_list in families.items():
+        # stack the tables with the most common shape
+        shape_count = Counter(np.shape(data_list[itable])
+                              for itable in table_list)
+        stack_shape = shape_count.most_common(1)[0][0]
+        table_list = [itable for itable in table_list
+                      if np.shape(data_list[itable]) == stack_shape]
+        if len(table_list) < 2:
+            continue
+        stack_name = "particle_{}".format(kind)
+        dset = create_dataset_with_profile(
+            columnar_group, stack_name,
+            np.stack([data_list[itable] for itable in table_list]),
+            storage_profile, "spectra")
+        dset.attrs.create("headers", [np.bytes_(header_list[itable])
+                                      for itable in table_list])
+        columnar_group.create_dataset(
+            "{}_index".format(stack_name),
+            data=np.array([parse_particle_table_name(file_names[itable])[1:]
+                           for itable in table_list]))
+        columnar_group.create_dataset(
+            "{}_files".format(stack_name),
+            data=np.array([np.bytes_(file_names[itable])
+                           for itable in table_list]))
+        stacked_tables.update(table_list)
+
+    for itable, file_name in enumerate(file_names):
+        if itable in stacked_tables:
+            continue
+        h5data = create_dataset_with_profile(group, file_name,
+                                             data_list[itable],
+                                             storage_profile)
+        if header_list[itable].startswith("#"):
+            h5data.attrs.create("header", np.bytes_(header_list[itable]))
+
+
+class EventResults:
+    """This class reads the results of one event by file name for both the
+       default and the columnar layouts. Every stacked dataset is read in
+       one go on its first use.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.attrs = group.attrs
+        self.table_map = {}
+        self.stack_cache = {}
+        if "columnar" in group:
+            columnar_group = group["columnar"]
+            for name_i in columnar_group.keys():
+                if not name_i.endswith("_files"):
+                    continue
+                stack_name = name_i[:-len("_files")]
+                for itable, file_name in enumerate(columnar_group[name_i][()]):
+                    self.table_map[file_name.decode()] = (stack_name, itable)
+
+    def keys(self):
+        """This function returns the file names of all the tables"""
+        return ([name_i for name_i in self.group.keys()
+                 if name_i != "columnar"] + list(self.table_map.keys()))
+
+    def __contains__(self, file_name):
+        return file_name in self.table_map or (
+            file_name != "columnar" and file_name in self.group)
+
+    def get_stack(self, stack_name):
+        """This function returns (data, index, file names) of one stacked
+           dataset, e.g. particle_vndata_diff_y
+        """
+        if stack_name not in self.stack_cache:
+            columnar_group = self.group["columnar"]
+            self.stack_cache[stack_name] = (
+                columnar_group[stack_name][()],
+                columnar_group["{}_index".format(stack_name)][()],
+                [name_i.decode() for name_i in
+                 columnar_group["{}_files".format(stack_name)][()]])
+        return self.stack_cache[stack_name]
+
+    def get(self, file_name, default=None):
+        """This function returns the table of file_name as an array"""
+        if file_name in self.table_map:
+            stack_name, itable = self.table_map[file_name]
+            return self.get_stack(stack_name)[0][itable]
+        if file_name == "columnar" or file_name not in self.group:
+            return default
+        return self.group[file_name][()]
+
+    def __getitem__(self, file_name):
+        data = self.get(file_name)
+        if data is None:
+            raise KeyError(file_name)
+        return data
+
+    def get_header(self, file_name):
+        """This function returns the header line of file_name"""
+        if file_name in self.table_map:
+            stack_name, itable = self.table_map[file_name]
+            headers = self.group["columnar"][stack_name].attrs["headers"]
+            return headers[itable].decode()
+        header = self.group[file_name].attrs.get("header", b"")
+        if isinstance(header, bytes):
+            header = header.decode()
+        return str(header)
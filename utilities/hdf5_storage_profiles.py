@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""This module defines the storage profiles for the hdf5 results
+
+   A storage profile sets the compression codec, compression level,
+   shuffle filter, chunk shape, and float precision for every class of
+   datasets:
+       spectra: particle spectra, flow, photon and spin results
+       evolution: hydro evolution estimators
+       initial_state: initial-state grids and event-by-event lists
+"""
+
+import numpy as np
+
+known_dataset_classes = ['spectra', 'evolution', 'initial_state']
+
+# chunk_rows = 0 lets h5py choose the chunk shape
+# dtype = None keeps the precision of the data
+hdf5_storage_profiles = {
+    'legacy': {     # the settings used before the storage profiles
+        'spectra': {'compression': "gzip", 'compression_opts': 9,
+                    'shuffle': False, 'chunk_rows': 0, 'dtype': None},
+        'evolution': {'compression': "gzip", 'compression_opts': 9,
+                      'shuffle': False, 'chunk_rows': 0, 'dtype': None},
+        'initial_state': {'compression': "gzip", 'compression_opts': 9,
+                          'shuffle': False, 'chunk_rows': 0, 'dtype': None},
+    },
+    'balanced': {   # fast writes with a small loss in size
+        'spectra': {'compression': "gzip", 'compression_opts': 4,
+                    'shuffle': True, 'chunk_rows': 0, 'dtype': "float32"},
+        'evolution': {'compression': "gzip", 'compression_opts': 4,
+                      'shuffle': True, 'chunk_rows': 0, 'dtype': "float32"},
+        'initial_state': {'compression': "gzip", 'compression_opts': 4,
+                          'shuffle': True, 'chunk_rows': 4096,
+                          'dtype': "float32"},
+    },
+    'fast': {       # fastest reads and writes, larger files
+        'spectra': {'compression': "lzf", 'compression_opts': None,
+                    'shuffle': True, 'chunk_rows': 0, 'dtype': "float32"},
+        'evolution': {'compression': "lzf", 'compression_opts': None,
+                      'shuffle': True, 'chunk_rows': 0, 'dtype': "float32"},
+        'initial_state': {'compression': "lzf", 'compression_opts': None,
+                          'shuffle': True, 'chunk_rows': 4096,
+                          'dtype': "float32"},
+    },
+    'compact': {    # smallest files for archiving
+        'spectra': {'compression': "gzip", 'compression_opts': 9,
+                    'shuffle': True, 'chunk_rows': 0, 'dtype': "float32"},
+        'evolution': {'compression': "gzip", 'compression_opts': 9,
+                      'shuffle': True, 'chunk_rows': 0, 'dtype': "float32"},
+        'initial_state': {'compression': "gzip", 'compression_opts': 9,
+                          'shuffle': True, 'chunk_rows': 16384,
+                          'dtype': "float32"},
+    },
+}
+
+evolution_filepattern = [
+    "eccentricities_evo", "momentum_anisotropy", "meanpT_estimators",
+    "inverse_Reynolds_number", "averaged_phase_diagram_trajectory",
+    "global_conservation_laws", "global_angular_momentum", "vorticity_evo",
+    "FO_nBvseta",
+]
+initial_state_filepattern = [
+    "epsilon-u-Hydro", "Tmunu", "NcollList", "NpartList", "NpartdNdy",
+    "NgluonEstimators", "ekt_tIn01_tOut08", "strings", "spectators",
+    "participants_event", "ed_etas_distribution", "nB_etas_distribution",
+    "ecc_ed", "events_summary",
+]
+
+
+def get_dataset_class(dataset_name):
+    """This function returns the dataset class from the dataset name"""
+    for pattern_i in evolution_filepattern:
+        if pattern_i in dataset_name:
+            return "evolution"
+    for pattern_i in initial_state_filepattern:
+        if pattern_i in dataset_name:
+            return "initial_state"
+    return "spectra"
+
+
+def get_dataset_options(profile_name, dataset_class, data):
+    """This function returns the data converted to the precision of the
+       storage profile and the keyword arguments for create_dataset
+    """
+    if profile_name not in hdf5_storage_profiles:
+        print("\U000026A0  Unknown hdf5 storage profile {}, ".format(
+            profile_name) + "use legacy", flush=True)
+        profile_name = "legacy"
+    settings = hdf5_storage_profiles[profile_name][dataset_class]
+    data = np.asarray(data)
+    if settings['dtype'] is not None and data.dtype.kind == "f":
+        data = data.astype(settings['dtype'])
+    if data.ndim == 0 or data.size == 0:
+        # scalar and empty datasets do not support filters
+        return data, {}
+    options = {'compression': settings['compression']}
+    if settings['compression_opts'] is not None:
+        options['compression_opts'] = settings['compression_opts']
+    if settings['shuffle']:
+        options['shuffle'] = True
+    if settings['chunk_rows'] > 0:
+        options['chunks'] = ((min(settings['chunk_rows'], data.shape[0]),)
+                             + data.shape[1:])
+    return data, options
+
+
+def create_dataset_with_profile(group, dataset_name, data,
+                                profile_name="legacy", dataset_class=None):
+    """This function creates a dataset in the hdf5 group with the settings
+       of the storage profile. The dataset class is derived from the
+       dataset name if it is not given.
+    """
+    if dataset_class is None:
+        dataset_class = get_dataset_class(dataset_name)
+    data, options = get_dataset_options(profile_name, dataset_class, data)
+    return group.create_dataset(dataset_name, data=data, **options)
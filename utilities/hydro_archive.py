@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""This module archives the saved hydro results in a compact binary format
+
+   Every binary hydro output file, e.g. surface_eps_0.18.dat or
+   evolution_all_xyeta.dat, is converted to filename.f32z:
+       magic number b"IEBEF32" + format version (8 bytes)
+       header length (uint32) + JSON header with the original file name,
+           the format (binary), and the codec
+       chunks: raw length (uint32), compressed length (uint32), and the
+           zlib stream of the float32 values with the bytes of every
+           value shuffled into four planes
+       end marker: raw length 0 (uint32) and the CRC32 of the raw values
+   MUSIC writes the binary files in float32, so they are restored byte by
+   byte. Text tables are left untouched.
+
+   The codes of the package (iSS, the photon emission) and the analysis
+   scripts only read the original files, restore the archives before
+   running them.
+"""
+
+import sys
+import json
+import zlib
+import struct
+from os import path, remove, replace, walk
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+archive_suffix = ".f32z"
+archive_magic = b"IEBEF32\x01"
+archive_chunk_bytes = 16*1024*1024
+
+
+def is_text_file(filename):
+    """This function checks whether a file is a text file from its first
+       bytes
+    """
+    with open(filename, "rb") as f:
+        head = f.read(4096)
+    try:
+        head.decode("ascii")
+    except UnicodeDecodeError:
+        return False
+    return all(char_i >= 32 or char_i in b"\t\n\r" for char_i in head)
+
+
+def shuffle_bytes(raw, inverse=False):
+    """This function (un)shuffles the bytes of float32 values into four
+       planes, which makes them compress much better
+    """
+    if len(raw) % 4 != 0:
+        return raw
+    data = np.frombuffer(raw, dtype=np.uint8)
+    if inverse:
+        return data.reshape(4, -1).T.tobytes()
+    return data.reshape(-1, 4).T.tobytes()
+
+
+def write_archive(archive_name, header, raw_chunks, level=1):
+    """This function writes the raw float32 chunks with the header into
+       archive_name, through a temporary file
+    """
+    header_bytes = json.dumps(header).encode()
+    crc = 0
+    tmp_name = archive_name + ".part"
+    with open(tmp_name, "wb") as f:
+        f.write(archive_magic)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        for raw in raw_chunks:
+            crc = zlib.crc32(raw, crc)
+            compressed = zlib.compress(shuffle_bytes(raw), level)
+            f.write(struct.pack("<II", len(raw), len(compressed)))
+            f.write(compressed)
+        f.write(struct.pack("<II", 0, crc & 0xffffffff))
+    replace(tmp_name, archive_name)
+
+
+def read_binary_chunks(filename):
+    """This function yields the content of a binary file in chunks"""
+    with open(filename, "rb") as f:
+        while True:
+            raw = f.read(archive_chunk_bytes)
+            if not raw:
+                return
+            yield raw
+
+
+def archive_file(filename, level=1, remove_flag=True):
+    """This function converts one binary hydro output file into the
+       archive format. It returns the archive name, or None if the file is
+       a text file, which is not archived.
+    """
+    if is_text_file(filename):
+        return None
+    archive_name = filename + archive_suffix
+    header = {'source': path.basename(filename), 'codec': "zlib",
+              'level': level, 'shuffle': True,
+              'n_bytes': path.getsize(filename), 'format': "binary"}
+    write_archive(archive_name, header, read_binary_chunks(filename), level)
+    if remove_flag:
+        remove(filename)
+    return archive_name
+
+
+def read_archive_header(f):
+    """This function reads the header of an open archive"""
+    if f.read(len(archive_magic)) != archive_magic:
+        raise ValueError("not a hydro archive")
+    header_length = struct.unpack("<I", f.read(4))[0]
+    return json.loads(f.read(header_length).decode())
+
+
+def iter_archive_chunks(f):
+    """This function yields the raw float32 chunks of an open archive after
+       its header and checks the CRC32 at the end
+    """
+    crc = 0
+    while True:
+        n_raw, n_compressed = struct.unpack("<II", f.read(8))
+        if n_raw == 0:
+            if n_compressed != crc & 0xffffffff:
+                raise ValueError("CRC32 mismatch in the hydro archive")
+            return
+        raw = shuffle_bytes(zlib.decompress(f.read(n_compressed)), True)
+        crc = zlib.crc32(raw, crc)
+        yield raw
+
+
+def restore_file(archive_name, remove_flag=True):
+    """This function writes the original file of an archive back"""
+    filename = archive_name[:-len(archive_suffix)]
+    tmp_name = filename + ".part"
+    with open(archive_name, "rb") as f:
+        read_archive_header(f)
+        with open(tmp_name, "wb") as f_out:
+            for raw in iter_archive_chunks(f):
+                f_out.write(raw)
+    replace(tmp_name, filename)
+    if remove_flag:
+        remove(archive_name)
+    return filename
+
+
+def archive_folder(folder, level=1, n_threads=1):
+    """This function archives all the binary .dat files in a hydro results
+       folder with n_threads files at a time, the text tables are kept.
+       It returns the numbers of bytes before and after.
+    """
+    file_list = [path.join(root, filename)
+                 for root, _, filenames in walk(folder)
+                 for filename in filenames if filename.endswith(".dat")]
+    n_bytes_before = sum(path.getsize(file_i) for file_i in file_list)
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        archive_list = list(executor.map(
+            lambda file_i: archive_file(file_i, level), file_list))
+    n_bytes_after = 0
+    for file_i, archive_i in zip(file_list, archive_list):
+        if archive_i is None:
+            n_bytes_after += path.getsize(file_i)
+        else:
+            n_bytes_after += path.getsize(archive_i)
+    return n_bytes_before, n_bytes_after
+
+
+def restore_folder(folder):
+    """This function restores all the archived files in a folder"""
+    for root, _, filenames in walk(folder):
+        for filename in filenames:
+            if filename.endswith(archive_suffix):
+                restore_file(path.join(root, filename))
+
+
+def print_usage():
+    """This function prints out help messages"""
+    print("Usage: {} archive|restore ".format(sys.argv[0])
+          + "hydro_results_folder_or_file [more ...]")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("archive", "restore"):
+        print_usage()
+        exit(0)
+    for path_i in sys.argv[2:]:
+        if sys.argv[1] == "archive":
+            if path.isdir(path_i):
+                n_before, n_after = archive_folder(path_i)
+                print("{}: {:.1f} MB -> {:.1f} MB".format(
+                    path_i, n_before/1024.**2, n_after/1024.**2))
+            else:
+                archive_file(path_i)
+        elif path.isdir(path_i):
+            restore_folder(path_i)
+        else:
+            restore_file(path_i)
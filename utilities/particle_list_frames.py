@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""This module writes and reads the frame-indexed particle lists
+
+   The saved particle list particle_list_{event_id}.gz is a multi-member
+   gzip file with one member (frame) per oversampled event, so it reads
+   like any gzip file, e.g. with zcat or the analysis scripts. The frame
+   index particle_list_{event_id}.idx lists the offset and the length of
+   every frame in the compressed file, its number of particles, and the
+   afterburner sample it comes from, so read_particle_list_frame reads
+   one oversampled event without decompressing the whole file.
+"""
+
+import sys
+import gzip
+from os import path, remove, replace
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# pid, mass, t, x, y, z, E, px, py, pz, four bytes each
+n_record_fields = 10
+
+
+def get_index_filename(gz_filename):
+    """This function returns the name of the frame index of a particle
+       list
+    """
+    return path.splitext(gz_filename)[0] + ".idx"
+
+
+def iter_event_frames(sample_file):
+    """This function yields the raw bytes of every event in a binary
+       particle list (gzipped or not) and its number of particles
+    """
+    with open(sample_file, "rb") as f:
+        magic_number = f.read(2)
+    open_func = gzip.open if magic_number == b"\x1f\x8b" else open
+    with open_func(sample_file, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + 4 <= len(data):
+        n_particles = int(np.frombuffer(data, dtype=np.int32, count=1,
+                                        offset=offset)[0])
+        n_bytes = min(4 + 4*n_record_fields*n_particles, len(data) - offset)
+        yield data[offset:offset + n_bytes], n_particles
+        offset += n_bytes
+
+
+def write_particle_list_frames(sample_files, gz_filename, level=1,
+                               n_threads=2, remove_flag=False):
+    """This function compresses the afterburner samples from the iterable
+       sample_files into the frame-indexed particle list gz_filename as
+       they arrive. The frames of every sample are compressed by n_threads
+       threads. Both files are written to temporary files and renamed at
+       the end.
+       It returns the number of compressed samples.
+    """
+    index_filename = get_index_filename(gz_filename)
+    frame_index = []
+    n_samples = 0
+    offset = 0
+    with open(gz_filename + ".part", "wb") as f, \
+            ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        for sample_file in sample_files:
+            frames = list(iter_event_frames(sample_file))
+            compressed_frames = executor.map(
+                lambda frame_i: gzip.compress(frame_i[0], level, mtime=0),
+                frames)
+            for (_, n_particles), compressed in zip(frames,
+                                                    compressed_frames):
+                f.write(compressed)
+                frame_index.append([offset, len(compressed), n_particles,
+                                    n_samples])
+                offset += len(compressed)
+            n_samples += 1
+            if remove_flag:
+                remove(sample_file)
+    if n_samples == 0:
+        remove(gz_filename + ".part")
+        return 0
+    with open(index_filename + ".part", "wb") as f:
+        np.save(f, np.array(frame_index, dtype=np.int64).reshape(-1, 4))
+    replace(index_filename + ".part", index_filename)
+    replace(gz_filename + ".part", gz_filename)
+    return n_samples
+
+
+def load_frame_index(gz_filename):
+    """This function returns the frame index of a particle list, an array
+       of (offset, compressed length, number of particles, sample id)
+    """
+    return np.load(get_index_filename(gz_filename))
+
+
+def read_particle_list_frame(gz_filename, iframe, frame_index=None):
+    """This function returns the particles of the iframe-th oversampled
+       event as an array of shape (n_particles, 10) with the particle id
+       in the first column
+    """
+    if frame_index is None:
+        frame_index = load_frame_index(gz_filename)
+    offset, n_bytes = frame_index[iframe][:2]
+    with open(gz_filename, "rb") as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(n_bytes))
+    records = np.frombuffer(data, dtype=np.float32,
+                            offset=4).reshape(-1, n_record_fields)
+    particles = records.astype(np.float64)
+    pids = records[:, 0].view(np.int32)
+    if np.all(np.abs(pids) < 10**8):
+        # the particle id is stored as an integer
+        particles[:, 0] = pids
+    return particles
+
+
+def print_usage():
+    """This function prints out help messages"""
+    print("Usage: {} particle_list.gz [frame_id]".format(sys.argv[0]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print_usage()
+        exit(0)
+    frame_index = load_frame_index(sys.argv[1])
+    if len(sys.argv) == 2:
+        print("{}: {} oversampled events from {} samples, {} particles".format(
+            sys.argv[1], len(frame_index), len(set(frame_index[:, 3])),
+            np.sum(frame_index[:, 2])))
+    else:
+        np.savetxt(sys.stdout, read_particle_list_frame(
+            sys.argv[1], int(sys.argv[2]), frame_index), fmt="%.6e")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""This script prints the status of the jobs from their stage manifests
+
+   Every job folder (e.g. playground/event_0) keeps an append-only stage
+   manifest stage_manifest.jsonl with one record per finished stage. This
+   script reads the manifests without touching the results.
+"""
+
+import sys
+import json
+from os import path
+from glob import glob
+
+
+def print_usage():
+    """This function prints out help messages"""
+    print("Usage: {} ".format(sys.argv[0])
+          + "working_folder_or_stage_manifest [more ...]")
+
+
+def load_event_status(manifest_filename):
+    """This function returns the latest status of every stage of every
+       event in a stage manifest
+    """
+    event_status = {}
+    with open(manifest_filename, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            event_status.setdefault(record['event_id'], {})[
+                record['stage']] = record['status']
+    return event_status
+
+
+def print_job_status(path_list):
+    """This function prints the status of all the events of the jobs"""
+    manifest_list = []
+    for path_i in path_list:
+        if path.isdir(path_i):
+            manifest_list += sorted(
+                glob(path.join(path_i, "**", "stage_manifest.jsonl"),
+                     recursive=True))
+        else:
+            manifest_list.append(path_i)
+
+    n_finished = 0
+    n_failed = 0
+    n_running = 0
+    for manifest_filename in manifest_list:
+        job_folder = path.dirname(manifest_filename)
+        for event_id, stages in load_event_status(manifest_filename).items():
+            if stages.get("event") == "success":
+                n_finished += 1
+                continue
+            failed_stages = [stage_i for stage_i, status in stages.items()
+                             if status != "success"]
+            if failed_stages != []:
+                n_failed += 1
+                print("{}: {} failed at {}".format(
+                    job_folder, event_id, ", ".join(failed_stages)))
+            else:
+                n_running += 1
+                print("{}: {} in progress, finished {}".format(
+                    job_folder, event_id, ", ".join(stages.keys())))
+    print("Events finished: {}, failed: {}, in progress: {}".format(
+        n_finished, n_failed, n_running))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print_usage()
+        exit(0)
+    print_job_status(sys.argv[1:])
@@ -127,3 +127,7 @@ for icen in range(len(centrality_cut_list) - 1):
             urqmd_event_name = "particle_list_{}.gz".format(event_id)
             shutil.move(path.join(urqmd_folder, urqmd_event_name),
                         urqmd_directory_path)
+            urqmd_index_name = "particle_list_{}.idx".format(event_id)
+            if path.exists(path.join(urqmd_folder, urqmd_index_name)):
+                shutil.move(path.join(urqmd_folder, urqmd_index_name),
+                            urqmd_directory_path)
@@ -11,6 +11,7 @@ from numpy import *
 import h5py
 import shutil
 import json
+from hdf5_columnar_layout import EventResults
 
 min = __builtins__.min # fix for pollution of global namespace with numpy
 
@@ -214,7 +215,7 @@ for config_key, config in centrality_configs.items():
     centrality_values = []
     valid_events = []
     for ifolder, event_name in enumerate(event_list):
-        event_group = hf.get(event_name)
+        event_group = EventResults(hf.get(event_name))
         cent_value = extract_centrality_variable(event_group, config)
         if cent_value is not None:
             centrality_values.append(cent_value)
@@ -336,6 +337,11 @@ if (hydro_surface_flag or urqmd_flag) and not no_move_flag:
                 source_path = path.join(urqmd_folder, urqmd_event_name)
                 if path.exists(source_path):
                     shutil.move(source_path, urqmd_directory_path)
+                # the frame index of the compressed particle list
+                index_path = path.join(
+                    urqmd_folder, "particle_list_{}.idx".format(event_id))
+                if path.exists(index_path):
+                    shutil.move(index_path, urqmd_directory_path)
 elif no_move_flag:
     print("--no-move flag detected: Skipping all physical file operations (directories and files left unchanged)")
 else:
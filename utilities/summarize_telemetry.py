@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""This script summarizes the stage telemetry of a production
+
+   It reads the telemetry_*.json timelines in the event folders and the
+   telemetry attributes of the event groups in the hdf5 files (single
+   events or collected databases) and prints the wall time, CPU time,
+   peak memory, and bytes written for every stage. The peak memory of the
+   job gives the memory to request for the next submissions, e.g.
+   request_memory on OSG.
+"""
+
+import sys
+import json
+from os import path, walk
+import h5py
+import numpy as np
+
+
+def print_usage():
+    """This function prints out help messages"""
+    print("Usage: {} ".format(sys.argv[0])
+          + "production_folder_or_file [more folders or files ...]")
+
+
+def load_telemetry_from_hdf5(h5_filename):
+    """This function returns the telemetry of all events in a hdf5 file"""
+    telemetry_list = []
+    try:
+        with h5py.File(h5_filename, "r") as hf:
+            for group_name in hf.keys():
+                telemetry = hf[group_name].attrs.get("telemetry", None)
+                if telemetry is None:
+                    continue
+                if isinstance(telemetry, bytes):
+                    telemetry = telemetry.decode()
+                telemetry_list.append(json.loads(telemetry))
+    except OSError:
+        print("can not read {}, skipped".format(h5_filename))
+    return telemetry_list
+
+
+def load_telemetry(path_list):
+    """This function collects the event telemetry from the given folders
+       and files. An event found in both a JSON file and a hdf5 file is
+       only counted once.
+    """
+    file_list = []
+    for path_i in path_list:
+        if path.isdir(path_i):
+            for folder, _, filenames in walk(path_i):
+                for filename in filenames:
+                    file_list.append(path.join(folder, filename))
+        else:
+            file_list.append(path_i)
+
+    telemetry_dict = {}
+    for filename in sorted(file_list):
+        basename = path.basename(filename)
+        if basename.startswith("telemetry_") and basename.endswith(".json"):
+            with open(filename, "r") as f:
+                event_telemetry = json.load(f)
+            telemetry_dict[event_telemetry['event_id']] = event_telemetry
+        elif basename.endswith(".h5"):
+            for event_telemetry in load_telemetry_from_hdf5(filename):
+                telemetry_dict.setdefault(event_telemetry['event_id'],
+                                          event_telemetry)
+    return list(telemetry_dict.values())
+
+
+def summarize_telemetry(telemetry_list):
+    """This function prints the summary of the stage telemetry"""
+    print("Number of events: {}".format(len(telemetry_list)))
+    if telemetry_list == []:
+        return
+    event_wall_time = np.array([event_i['wall_time']
+                                for event_i in telemetry_list])/3600.
+    print("Event wall time (hours): mean = {:.3f}, median = {:.3f}, ".format(
+        np.mean(event_wall_time), np.median(event_wall_time))
+          + "90% = {:.3f}, max = {:.3f}".format(
+              np.percentile(event_wall_time, 90), np.max(event_wall_time)))
+
+    stage_records = {}
+    for event_i in telemetry_list:
+        for record in event_i['stages']:
+            stage_records.setdefault(record['stage'], []).append(record)
+
+    print("{:>18s} {:>7s} {:>10s} {:>10s} {:>10s} {:>10s} {:>9s} "
+          "{:>10s} {:>10s}".format("stage", "n_runs", "wall_mean", "wall_90%",
+                                   "wall_max", "cpu_hours", "cpu/wall",
+                                   "GB_written", "peak_MB"))
+    for stage_name, records in stage_records.items():
+        wall_time = np.array([record['wall_time'] for record in records])
+        cpu_time = np.array([record['cpu_time_children']
+                             + record['cpu_time_driver']
+                             for record in records])
+        write_bytes = np.sum([record['write_bytes'] for record in records])
+        # older telemetry does not have the memory of the stages
+        peak_rss = max(record.get('peak_rss_MB', 0.) for record in records)
+        print("{:>18s} {:7d} {:10.1f} {:10.1f} {:10.1f} {:10.3f} {:9.2f} "
+              "{:10.3f} {:10.1f}".format(
+                  stage_name, len(records), np.mean(wall_time),
+                  np.percentile(wall_time, 90), np.max(wall_time),
+                  np.sum(cpu_time)/3600.,
+                  np.sum(cpu_time)/max(np.sum(wall_time), 1e-6),
+                  write_bytes/1024.**3, peak_rss))
+    max_rss = max(record['max_rss_children_MB']
+                  for event_i in telemetry_list
+                  for record in event_i['stages'])
+    print("Peak memory of a child process: {:.1f} MB".format(max_rss))
+    peak_rss = max(record.get('peak_rss_MB', 0.)
+                   for event_i in telemetry_list
+                   for record in event_i['stages'])
+    if peak_rss > 0:
+        print("Peak memory of all the child processes: "
+              + "{:.1f} MB, suggested request_memory = {:.1f} GB".format(
+                  peak_rss, np.ceil(1.2*peak_rss/1024.*10)/10.))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print_usage()
+        exit(0)
+    summarize_telemetry(load_telemetry(sys.argv[1:]))